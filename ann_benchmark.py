@@ -0,0 +1,118 @@
+# Description: This file reports recall@k and latency of the IVFIndex against exact search.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import time
+import json
+import argparse
+import numpy as np
+from search_engine import ExactSearchEngine
+from ann_index import IVFIndex
+
+
+def synthetic_embeddings(n, dim=512, n_topics=256, seed=0):
+    """
+    Generate clustered unit vectors which resemble sentence embeddings of many papers.
+    :param n: The number of vectors.
+    :param dim: The dimension of the vectors.
+    :param n_topics: The number of clusters.
+    :param seed: The random seed.
+    :return: A 2-D float32 array.
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    data = topics[rng.integers(0, n_topics, n)] + 0.8 * rng.normal(size=(n, dim)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+
+def recall_at_k(approx_ids, exact_ids):
+    """
+    Returns the fraction of the exact top-k results found by the approximate search.
+    """
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx_ids, exact_ids))
+    return hits / exact_ids.size
+
+
+def timed_search(engine, queries, k, **kwargs):
+    """
+    Search the queries one by one and return the ids and the mean latency in milliseconds.
+    """
+    ids = []
+    start = time.perf_counter()
+    for query in queries:
+        ids.append(engine.search(query, k, **kwargs)[1])
+    return np.array(ids), (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def run_report(data, queries, k=5, n_lists=None, nprobes=(1, 4, 8, 16, 32), pq_subvectors=(None, 64), rerank=4):
+    """
+    Compare the IVF index with and without PQ against the exact search.
+    :param data: The embeddings to index.
+    :param queries: The query embeddings.
+    :param k: The number of results per query.
+    :param n_lists: The number of inverted lists (defaults to 4 * sqrt(n)).
+    :param nprobes: The nprobe settings to report.
+    :param pq_subvectors: The PQ settings to report, None for exact vectors.
+    :param rerank: The candidates per result re-scored with the exact vectors; PQ is
+                   reported with and without re-scoring.
+    :return: A list of report rows.
+    """
+    exact = ExactSearchEngine(data)
+    exact_ids, exact_ms = timed_search(exact, queries, k)
+    rows = [{"index": "exact", "nprobe": None, "recall": 1.0, "latency_ms": exact_ms,
+             "build_s": 0.0, "memory_mb": exact.matrix.nbytes / 2 ** 20}]
+    for pq in pq_subvectors:
+        start = time.perf_counter()
+        index = IVFIndex(n_lists=n_lists, pq_subvectors=pq, rerank=rerank).fit(data)
+        build_s = time.perf_counter() - start
+        for rescore in ([0] if pq is None or not rerank else [0, rerank]):
+            name = "ivf" if pq is None else f"ivf-pq{pq}" + (f"-rr{rescore}" if rescore else "")
+            for nprobe in nprobes:
+                ids, ms = timed_search(index, queries, k, nprobe=nprobe, rerank=rescore)
+                rows.append({"index": name, "nprobe": nprobe,
+                             "recall": recall_at_k(ids, exact_ids), "latency_ms": ms,
+                             "build_s": build_s, "memory_mb": index.memory_bytes() / 2 ** 20})
+    return rows
+
+
+def print_report(rows, k):
+    """
+    Print the report as a table.
+    """
+    print(f"{'index':<14} {'nprobe':>6} {f'recall@{k}':>10} {'ms/query':>9} {'build s':>8} {'MB':>8}")
+    for row in rows:
+        nprobe = '-' if row['nprobe'] is None else row['nprobe']
+        print(f"{row['index']:<14} {nprobe:>6} {row['recall']:>10.3f} {row['latency_ms']:>9.3f} "
+              f"{row['build_s']:>8.2f} {row['memory_mb']:>8.1f}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Recall@k vs. latency report of the IVF index.")
+    arg_parser.add_argument("--embeddings", help="A .npy file of embeddings (synthetic data by default).")
+    arg_parser.add_argument("--n", type=int, default=100000, help="Number of synthetic embeddings.")
+    arg_parser.add_argument("--queries", type=int, default=200, help="Number of queries.")
+    arg_parser.add_argument("--k", type=int, default=5)
+    arg_parser.add_argument("--n-lists", type=int, default=None)
+    arg_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    arg_parser.add_argument("--pq", type=int, nargs="*", default=[64],
+                            help="PQ sub-vector settings to report besides the exact IVF lists.")
+    arg_parser.add_argument("--rerank", type=int, default=4,
+                            help="Candidates per result re-scored with the exact vectors after PQ (0 to skip).")
+    arg_parser.add_argument("--json", help="Write the report to this JSON file.")
+    args = arg_parser.parse_args()
+
+    if args.embeddings:
+        data = np.load(args.embeddings).astype(np.float32)
+    else:
+        data = synthetic_embeddings(args.n)
+    rng = np.random.default_rng(1)
+    queries = data[rng.choice(len(data), args.queries, replace=False)]
+    queries = queries + 0.1 * rng.normal(size=queries.shape).astype(np.float32)
+
+    report = run_report(data, queries, k=args.k, n_lists=args.n_lists,
+                        nprobes=args.nprobe, pq_subvectors=[None] + args.pq, rerank=args.rerank)
+    print_report(report, args.k)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,243 @@
+# Description: This file contains the IVFIndex class used for approximate nearest neighbour search.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import logging
+import numpy as np
+from search_engine import normalize, top_k
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def kmeans(data, n_clusters, n_iter=20, seed=0, batch=65536):
+    """
+    Cluster the data with Lloyd's k-means algorithm.
+    :param data: A 2-D float32 array.
+    :param n_clusters: The number of clusters.
+    :param n_iter: The number of iterations.
+    :param seed: The random seed.
+    :param batch: The number of rows assigned at once, to bound memory use.
+    :return: A tuple of (centroids, assignments).
+    """
+    rng = np.random.default_rng(seed)
+    n = len(data)
+    n_clusters = min(n_clusters, n)
+    centroids = data[rng.choice(n, n_clusters, replace=False)].copy()
+    assignments = np.zeros(n, dtype=np.int64)
+    for _ in range(n_iter):
+        assignments = assign(data, centroids, batch=batch)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        sums[nonempty] = np.add.reduceat(data[order], starts[nonempty], axis=0)
+        empty = counts == 0
+        if empty.any():
+            # Reseed empty clusters with random points so no list goes unused.
+            sums[empty] = data[rng.choice(n, int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+    return centroids, assign(data, centroids, batch=batch)
+
+
+def assign(data, centroids, batch=65536):
+    """
+    Assign every row of the data to its closest centroid by Euclidean distance.
+    :param data: A 2-D float32 array.
+    :param centroids: A 2-D float32 array of centroids.
+    :param batch: The number of rows assigned at once.
+    :return: An array with the index of the closest centroid for each row.
+    """
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    out = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), batch):
+        block = data[start:start + batch]
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, the |x|^2 term does not change the argmin.
+        out[start:start + batch] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """
+    This class is used to search large collections of embeddings approximately.
+
+    The embeddings are partitioned into 'n_lists' inverted lists with k-means, and
+    a query only scores the rows of its 'nprobe' closest lists. Optionally, the
+    residual of each row to its list centroid is compressed with product
+    quantization (PQ), which stores 'pq_subvectors' bytes per row instead of the
+    full float32 vector. Since the PQ scores are estimates, the best 'rerank * k'
+    candidates are re-scored with the exact vectors of the fitted embeddings,
+    which are kept by reference (e.g. a memory map) and only read for those
+    rows. It exposes the same search/search_batch interface as
+    ExactSearchEngine, so it can be used by SemanticSearch directly.
+    """
+
+    def __init__(self, n_lists=None, nprobe=8, pq_subvectors=None, rerank=4, n_iter=10,
+                 train_size=32768, seed=0):
+        """
+        Initialize the index.
+        :param n_lists: The number of inverted lists (defaults to 4 * sqrt(n)).
+        :param nprobe: The number of lists scored for each query.
+        :param pq_subvectors: The number of PQ sub-vectors, None to keep exact vectors.
+        :param rerank: With PQ, re-score the best 'rerank * k' candidates with the exact
+                       vectors; 0 or None returns the PQ estimates.
+        :param n_iter: The number of k-means iterations.
+        :param train_size: The maximum number of rows used to train the k-means.
+        :param seed: The random seed.
+        """
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.pq_subvectors = pq_subvectors
+        self.rerank = rerank
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+
+    def __len__(self):
+        return 0 if self.centroids is None else len(self.ids)
+
+    def _train_sample(self, data):
+        if len(data) <= self.train_size:
+            return data
+        rng = np.random.default_rng(self.seed)
+        return data[rng.choice(len(data), self.train_size, replace=False)]
+
+    def fit(self, embeddings):
+        """
+        Build the index from the given embeddings.
+        :param embeddings: A 2-D array of embeddings.
+        :return: self
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings))
+        data = normalize(embeddings)
+        n, dim = data.shape
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(n)))
+
+        self.centroids, _ = kmeans(self._train_sample(data), n_lists,
+                                   n_iter=self.n_iter, seed=self.seed)
+        assignments = assign(data, self.centroids)
+
+        # Lay the rows out list by list, so each list is a contiguous slice.
+        self.ids = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        sorted_data = data[self.ids]
+
+        if self.pq_subvectors:
+            if dim % self.pq_subvectors:
+                raise ValueError(
+                    f"The 'pq_subvectors' parameter must divide the embedding dimension {dim}.")
+            residuals = sorted_data - self.centroids[assignments[self.ids]]
+            self._fit_pq(residuals)
+            self.vectors = None
+            # Not copied, only the re-scored rows are read.
+            self.source = embeddings if self.rerank else None
+        else:
+            self.vectors = sorted_data
+            self.codes = None
+            self.source = None
+        return self
+
+    def _fit_pq(self, residuals):
+        """
+        Train one 256-entry codebook per sub-space and encode the residuals as uint8 codes.
+        """
+        m = self.pq_subvectors
+        sub_dim = residuals.shape[1] // m
+        self.codebooks = np.empty((m, 256, sub_dim), dtype=np.float32)
+        self.codes = np.empty((len(residuals), m), dtype=np.uint8)
+        sample = self._train_sample(residuals)
+        for j in range(m):
+            sub = slice(j * sub_dim, (j + 1) * sub_dim)
+            codebook, _ = kmeans(np.ascontiguousarray(sample[:, sub]), 256,
+                                 n_iter=self.n_iter, seed=self.seed + j)
+            if len(codebook) < 256:
+                codebook = np.vstack([codebook, np.zeros((256 - len(codebook), sub_dim), np.float32)])
+            self.codebooks[j] = codebook
+            self.codes[:, j] = assign(np.ascontiguousarray(residuals[:, sub]), codebook)
+
+    def _score_list(self, query, list_id, lut):
+        start, end = self.offsets[list_id], self.offsets[list_id + 1]
+        if self.codes is None:
+            return self.vectors[start:end] @ query
+        codes = self.codes[start:end]
+        # q.x = q.c + sum_j q_j.codebook_j[code_j], read from the lookup table.
+        return query @ self.centroids[list_id] + lut[np.arange(len(lut)), codes].sum(axis=1)
+
+    def _rerank(self, query, candidates):
+        """
+        Re-score candidate ids with the exact vectors, best first.
+        """
+        order = np.argsort(candidates)
+        # Read the rows in ascending order, which suits a memory-mapped source.
+        vectors = normalize(self.source[candidates[order]])
+        scores = np.empty(len(candidates), dtype=np.float32)
+        scores[order] = vectors @ query
+        best = np.argsort(-scores, kind='stable')
+        return scores[best], candidates[best]
+
+    def search_batch(self, queries, k=5, nprobe=None, rerank=None):
+        """
+        Search the k nearest embeddings of many queries.
+        :param queries: A 2-D array of query embeddings.
+        :param k: The number of results per query.
+        :param nprobe: The number of lists scored per query (defaults to self.nprobe).
+        :param rerank: The re-scored candidates per result with PQ (defaults to self.rerank).
+        :return: A tuple of (scores, indices), both of shape (n_queries, k), best first.
+                 Missing results are padded with -inf scores and -1 indices.
+        """
+        if self.centroids is None:
+            raise ValueError("The index has not been fitted.")
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        rerank = self.rerank if rerank is None else rerank
+        n_candidates = k * rerank if rerank and self.source is not None else k
+        # Probe the lists whose centroids are closest by Euclidean distance, as in assign().
+        centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        _, probes = top_k(queries @ self.centroids.T - 0.5 * centroid_norms, nprobe)
+
+        out_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for qi, query in enumerate(queries):
+            lut = None
+            if self.codes is not None:
+                sub_queries = query.reshape(self.pq_subvectors, -1)
+                lut = np.einsum('md,mcd->mc', sub_queries, self.codebooks)
+            scores = [self._score_list(query, list_id, lut) for list_id in probes[qi]]
+            rows = [np.arange(self.offsets[l], self.offsets[l + 1]) for l in probes[qi]]
+            scores, rows = np.concatenate(scores), np.concatenate(rows)
+            if len(scores) == 0:
+                continue
+            best_scores, best = top_k(scores[None, :], n_candidates)
+            best_scores, best_ids = best_scores[0], self.ids[rows[best[0]]]
+            if n_candidates > k:
+                best_scores, best_ids = self._rerank(query, best_ids)
+                best_scores, best_ids = best_scores[:k], best_ids[:k]
+            out_scores[qi, :len(best_ids)] = best_scores
+            out_ids[qi, :len(best_ids)] = best_ids
+        return out_scores, out_ids
+
+    def search(self, query, k=5, nprobe=None, rerank=None):
+        """
+        Search the k nearest embeddings of one query.
+        :param query: A query embedding.
+        :param k: The number of results.
+        :param nprobe: The number of lists scored (defaults to self.nprobe).
+        :param rerank: The re-scored candidates per result with PQ (defaults to self.rerank).
+        :return: A tuple of (scores, indices), best first.
+        """
+        scores, indices = self.search_batch(np.reshape(query, (1, -1)), k, nprobe=nprobe, rerank=rerank)
+        return scores[0], indices[0]
+
+    def memory_bytes(self):
+        """
+        Returns the number of bytes used by the stored vectors or codes. The
+        embeddings kept for re-scoring belong to the caller and are not counted.
+        """
+        stored = self.vectors if self.codes is None else self.codes
+        return stored.nbytes + self.centroids.nbytes
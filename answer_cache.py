@@ -0,0 +1,203 @@
+# Description: This file contains the caches used by generate_answer for query embeddings and answers.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class LRUCache:
+    """
+    This class is a thread-safe least recently used cache with hit and miss counts.
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        :param max_size: The maximum number of entries.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the value of the key, or None if it is not cached.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def peek(self, key):
+        """
+        Returns the value of the key without counting a hit or miss.
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value):
+        """
+        Store a value, evicting the least recently used entry when the cache is full.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries), "max_size": self.max_size}
+
+
+def normalize_question(question):
+    """
+    Normalize a question for use in cache keys: lowercase, single spaces and
+    without trailing punctuation.
+    """
+    return ' '.join(question.lower().split()).rstrip('?.!。？！ ')
+
+
+class AnswerCache:
+    """
+    This class is used to avoid repeated work in generate_answer. It has two layers:
+
+    - an LRU of query embeddings, so a repeated question is not encoded again;
+    - an LRU of answers keyed by (index version, normalized question, retrieved
+      chunk ids, model parameters), so a repeated question is not sent to the LLM again.
+
+    With 'semantic_threshold' set, a question whose embedding has a cosine
+    similarity of at least the threshold with a previously answered question
+    reuses that answer. All answers are dropped when the index version changes.
+    """
+
+    def __init__(self, max_queries=4096, max_answers=1024, semantic_threshold=None):
+        """
+        :param max_queries: The maximum number of cached query embeddings.
+        :param max_answers: The maximum number of cached answers.
+        :param semantic_threshold: The cosine similarity above which an answer of a
+                                   similar question is reused (None to disable).
+        """
+        self.query_embeddings = LRUCache(max_queries)
+        self.answers = LRUCache(max_answers)
+        self.semantic_threshold = semantic_threshold
+        self.semantic_hits = 0
+        self.index_version = None
+        self.lock = threading.Lock()
+        self._semantic_keys = []
+        self._semantic_vectors = np.empty((0, 0), dtype=np.float32)
+
+    def _check_version(self, index_version):
+        """
+        Drop all answers when the index has changed since they were cached.
+        """
+        with self.lock:
+            if index_version != self.index_version:
+                self.answers.clear()
+                self._semantic_keys = []
+                self._semantic_vectors = np.empty((0, 0), dtype=np.float32)
+                self.index_version = index_version
+
+    def get_embedding(self, question, encoder_id, encode):
+        """
+        Returns the embedding of the question, encoding it only on a cache miss.
+        :param question: The question.
+        :param encoder_id: The name of the encoder, part of the key.
+        :param encode: The function encoding a list of texts on a miss, e.g. SemanticSearch.encode.
+        :return: The normalized embedding of the question.
+        """
+        key = (encoder_id, question)
+        embedding = self.query_embeddings.get(key)
+        if embedding is None:
+            embedding = np.asarray(encode([question]), dtype=np.float32)[0]
+            norm = np.linalg.norm(embedding)
+            embedding = embedding / norm if norm > 0 else embedding
+            self.query_embeddings.put(key, embedding)
+        return embedding
+
+    @staticmethod
+    def make_key(index_version, question, chunk_ids, params):
+        """
+        Build the key of an answer.
+        """
+        return (index_version, normalize_question(question),
+                tuple(int(i) for i in chunk_ids), tuple(sorted(params.items())))
+
+    def get_similar(self, embedding, index_version, params):
+        """
+        Returns the answer of a previously answered question similar to the given one.
+        :param embedding: The normalized embedding of the question.
+        :param index_version: The version of the searched index.
+        :param params: The model parameters.
+        :return: The answer, or None.
+        """
+        if self.semantic_threshold is None:
+            return None
+        self._check_version(index_version)
+        params = tuple(sorted(params.items()))
+        with self.lock:
+            if not self._semantic_keys:
+                return None
+            similarities = self._semantic_vectors @ embedding
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.semantic_threshold:
+                    break
+                key = self._semantic_keys[i]
+                if key[3] == params:
+                    answer = self.answers.peek(key)
+                    if answer is not None:
+                        self.semantic_hits += 1
+                        return answer
+        return None
+
+    def get(self, key):
+        """
+        Returns the cached answer of the key, or None.
+        """
+        self._check_version(key[0])
+        return self.answers.get(key)
+
+    def put(self, key, answer, embedding=None):
+        """
+        Store an answer. The embedding of the question is kept for semantic hits.
+        """
+        self._check_version(key[0])
+        self.answers.put(key, answer)
+        if self.semantic_threshold is not None and embedding is not None:
+            with self.lock:
+                vector = np.asarray(embedding, dtype=np.float32)[None, :]
+                if self._semantic_vectors.size == 0:
+                    self._semantic_vectors = vector
+                else:
+                    self._semantic_vectors = np.vstack([self._semantic_vectors, vector])
+                self._semantic_keys.append(key)
+                # Forget the embeddings of answers which have been evicted.
+                if len(self._semantic_keys) > 2 * self.answers.max_size:
+                    alive = [i for i, k in enumerate(self._semantic_keys) if k in self.answers.entries]
+                    self._semantic_keys = [self._semantic_keys[i] for i in alive]
+                    self._semantic_vectors = self._semantic_vectors[alive]
+
+    def stats(self):
+        """
+        Returns the statistics of both cache layers.
+        """
+        return {"query_embeddings": self.query_embeddings.stats(),
+                "answers": self.answers.stats(),
+                "semantic_hits": self.semantic_hits,
+                "index_version": self.index_version}
@@ -3,8 +3,14 @@
 # Date: 2023-09-02
 # Version: 1.0
 
+import os
+import json
 import arxiv
 import logging
+import tempfile
+from datetime import datetime, timezone
+from arxiv_cache import short_id, strip_version
+from instrumentation import span, count
 
 
 logging.basicConfig(level=logging.INFO)
@@ -16,20 +22,50 @@ class ArxivAPI:
     This class is used to query the arXiv API.
     """
 
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        Initialize the API client.
+        :param cache: An ArxivQueryCache used to serve repeated queries locally (optional).
+        """
         self.client = arxiv.Client(
             page_size=100, delay_seconds=3, num_retries=3)
+        self.cache = cache
 
     def query_by_id_list(self, id_list, max_results=1):
         """
         Query arXiv by id list.
+        IDs found in the cache are served locally and only the missing IDs are fetched.
         :param id_list: List of IDs to query.
         :param max_results: Maximum number of results.
         :return: A list of arXiv results.
         """
         if isinstance(id_list, str):
             id_list = [id_list]
-        return self.execute_query(None, max_results, id_list=id_list)
+        if self.cache is None:
+            return self.execute_query(None, max_results, id_list=id_list)
+
+        found = self.cache.get_entries(id_list)
+        missing = [arxiv_id for arxiv_id in id_list if arxiv_id not in found]
+        if missing:
+            fetched = self.execute_query(None, len(missing), id_list=missing)
+            self.cache.put_entries(fetched)
+            for arxiv_id, result in zip(missing, self._match(missing, fetched)):
+                if result is not None:
+                    found[arxiv_id] = result
+        results = [found[arxiv_id] for arxiv_id in id_list if arxiv_id in found]
+        return results[:max_results]
+
+    @staticmethod
+    def _match(id_list, results):
+        """
+        Match fetched results to the requested IDs, with or without version.
+        """
+        by_id = {}
+        for result in results:
+            sid = short_id(result.entry_id)
+            by_id[sid] = result
+            by_id.setdefault(strip_version(sid), result)
+        return [by_id.get(short_id(arxiv_id)) for arxiv_id in id_list]
 
     def combined_query(self, queries_dict, max_results=1):
         """
@@ -40,7 +76,16 @@ class ArxivAPI:
         """
         query = " AND ".join(
             [f"{key}:{value}" for key, value in queries_dict.items()])
-        return self.execute_query(query, max_results)
+        if self.cache is None:
+            return self.execute_query(query, max_results)
+
+        key = self.cache.query_key(query, max_results)
+        results = self.cache.get_query(key)
+        if results is None:
+            results = self.execute_query(query, max_results)
+            if results:
+                self.cache.put_query(key, results)
+        return results
 
     def execute_query(self, query, max_results, id_list=None):
         """
@@ -65,8 +110,125 @@ class ArxivAPI:
                     sort_by=arxiv.SortCriterion.SubmittedDate,
                     sort_order=arxiv.SortOrder.Descending
                 )
-            results = [item for item in search.results()]
+            with span("arxiv.query"):
+                results = [item for item in search.results()]
+            count("arxiv.results", len(results))
             return results
         except Exception as e:
             logger.error(f"An error occurred while executing the query: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    def query_updated(self, since, query=None, id_list=None, max_results=None, batch=200):
+        """
+        Query the papers updated since a time, bypassing the cache.
+        With an ID list only the listed papers which changed are returned, so
+        the cost depends on the number of changed papers, not on the ID list.
+        Errors are raised rather than logged, so a failed check is not taken for "no changes".
+        :param since: A datetime; None returns the papers regardless of their update time.
+        :param query: A query string the papers must also match (optional).
+        :param id_list: A list of arXiv IDs, queried in batches (optional).
+        :param max_results: Maximum number of results per batch (None for all).
+        :param batch: The number of IDs per request.
+        :return: A list of arXiv results, the most recently updated first.
+        """
+        clauses = []
+        if query:
+            clauses.append(f"({query})")
+        if since is not None:
+            until = datetime.now(timezone.utc)
+            clauses.append(f"lastUpdatedDate:[{since.astimezone(timezone.utc):%Y%m%d%H%M} TO {until:%Y%m%d%H%M}]")
+        batches = [id_list[i:i + batch] for i in range(0, len(id_list), batch)] if id_list else [[]]
+        results = []
+        for ids in batches:
+            search = arxiv.Search(
+                query=" AND ".join(clauses),
+                id_list=ids,
+                max_results=max_results,
+                sort_by=arxiv.SortCriterion.LastUpdatedDate,
+                sort_order=arxiv.SortOrder.Descending
+            )
+            with span("arxiv.query"):
+                results.extend(self.client.results(search))
+        count("arxiv.results", len(results))
+        return results
+
+    def harvest(self, query=None, id_list=None, max_results=None, checkpoint_path=None, reset=False):
+        """
+        Harvest the results of a query page by page.
+        Results are yielded as soon as their page arrives, and the position of the
+        harvest is saved to a checkpoint file after every page, so an interrupted
+        harvest continues where it stopped when called again with the same arguments.
+        Results are sorted by submission date in ascending order, so papers
+        submitted during the harvest do not shift the offsets of the others.
+        :param query: Query string.
+        :param id_list: A list of arXiv IDs (optional).
+        :param max_results: Maximum number of results (None for all).
+        :param checkpoint_path: The path to the checkpoint file (optional).
+        :param reset: Whether to ignore an existing checkpoint.
+        :return: A generator of arXiv results.
+        """
+        state = {"query": query, "id_list": id_list, "max_results": max_results,
+                 "offset": 0, "last_entry_id": None, "done": False}
+        if checkpoint_path and not reset:
+            saved = self._load_checkpoint(checkpoint_path)
+            if saved and all(saved.get(key) == state[key] for key in ("query", "id_list", "max_results")):
+                state = saved
+                logger.info(f"Resuming harvest at offset {state['offset']}.")
+        if state["done"]:
+            return
+
+        search = arxiv.Search(
+            query=query or "",
+            id_list=id_list or [],
+            max_results=max_results,
+            sort_by=arxiv.SortCriterion.SubmittedDate,
+            sort_order=arxiv.SortOrder.Ascending
+        )
+        # Start one result early to check that the listing did not shift.
+        position = max(state["offset"] - 1, 0) if state["last_entry_id"] else state["offset"]
+        page_size = self.client.page_size
+        try:
+            for result in self.client.results(search, offset=position):
+                position += 1
+                if position <= state["offset"]:
+                    if result.entry_id == state["last_entry_id"]:
+                        continue
+                    logger.warning("The listing changed since the checkpoint, the result before the "
+                                   "checkpoint offset is yielded as well.")
+                count("arxiv.results")
+                yield result
+                # The offset is the position in the listing, which only moves forward once per result.
+                state["offset"] = max(state["offset"], position)
+                state["last_entry_id"] = result.entry_id
+                if checkpoint_path and position % page_size == 0:
+                    self._save_checkpoint(checkpoint_path, state)
+        except GeneratorExit:
+            # The consumer stopped early, the result being processed is yielded again on resume.
+            if checkpoint_path:
+                self._save_checkpoint(checkpoint_path, state)
+            raise
+        except Exception as e:
+            logger.error(f"An error occurred during the harvest at offset {state['offset']}: {e}")
+            if checkpoint_path:
+                self._save_checkpoint(checkpoint_path, state)
+            raise
+        state["done"] = True
+        if checkpoint_path:
+            self._save_checkpoint(checkpoint_path, state)
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_path):
+        try:
+            with open(checkpoint_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_path, state):
+        directory = os.path.dirname(checkpoint_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, checkpoint_path)
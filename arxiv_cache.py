@@ -0,0 +1,232 @@
+# Description: This file contains the ArxivQueryCache class used to cache arXiv query results locally.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+import arxiv
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VERSION_PATTERN = re.compile(r'v\d+$')
+
+
+def short_id(entry_id):
+    """
+    Returns the short ID of an arXiv entry ID or URL, e.g. '2308.12345v2'.
+    """
+    return entry_id.split('/abs/')[-1]
+
+
+def strip_version(arxiv_id):
+    """
+    Returns the arXiv ID without its version suffix, e.g. '2308.12345'.
+    """
+    return VERSION_PATTERN.sub('', short_id(arxiv_id))
+
+
+def result_to_dict(result):
+    """
+    Convert an arxiv.Result into a JSON-serializable dictionary.
+    :param result: An arxiv.Result object.
+    :return: A dictionary with the fields of the result.
+    """
+    return {
+        "entry_id": result.entry_id,
+        "updated": result.updated.isoformat(),
+        "published": result.published.isoformat(),
+        "title": result.title,
+        "authors": [author.name for author in result.authors],
+        "summary": result.summary,
+        "comment": result.comment,
+        "journal_ref": result.journal_ref,
+        "doi": result.doi,
+        "primary_category": result.primary_category,
+        "categories": list(result.categories),
+        "links": [{"href": link.href, "title": link.title, "rel": link.rel,
+                   "content_type": link.content_type} for link in result.links],
+    }
+
+
+def dict_to_result(data):
+    """
+    Convert a dictionary created by result_to_dict back into an arxiv.Result.
+    :param data: A dictionary with the fields of the result.
+    :return: An arxiv.Result object.
+    """
+    return arxiv.Result(
+        entry_id=data["entry_id"],
+        updated=datetime.fromisoformat(data["updated"]),
+        published=datetime.fromisoformat(data["published"]),
+        title=data["title"],
+        authors=[arxiv.Result.Author(name) for name in data["authors"]],
+        summary=data["summary"],
+        comment=data["comment"],
+        journal_ref=data["journal_ref"],
+        doi=data["doi"],
+        primary_category=data["primary_category"],
+        categories=data["categories"],
+        links=[arxiv.Result.Link(**link) for link in data["links"]],
+    )
+
+
+class ArxivQueryCache:
+    """
+    This class is used to cache the results of arXiv queries in a SQLite database.
+
+    Entries are stored per arXiv ID, both with and without the version suffix,
+    and query results are stored as the list of IDs they returned, so
+    overlapping queries share the same entries.
+    """
+
+    def __init__(self, db_path="cache/arxiv.sqlite3", ttl=24 * 3600):
+        """
+        Open or create the cache database.
+        :param db_path: The path to the SQLite database.
+        :param ttl: The time to live of cached results in seconds.
+        """
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                              "(id TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS queries "
+                              "(key TEXT PRIMARY KEY, ids TEXT NOT NULL, fetched_at REAL NOT NULL)")
+
+    @staticmethod
+    def query_key(query, max_results, id_list=None):
+        """
+        Build the cache key of a query.
+        """
+        return json.dumps({"query": query, "max_results": max_results, "id_list": id_list},
+                          sort_keys=True)
+
+    def _fresh_after(self):
+        return time.time() - self.ttl
+
+    def _load_entries(self, id_list):
+        found = {}
+        with self.lock:
+            for arxiv_id in id_list:
+                row = self.conn.execute(
+                    "SELECT data FROM entries WHERE id = ? AND fetched_at >= ?",
+                    (short_id(arxiv_id), self._fresh_after())).fetchone()
+                if row is not None:
+                    found[arxiv_id] = dict_to_result(json.loads(row[0]))
+        return found
+
+    def get_entries(self, id_list):
+        """
+        Look up arXiv IDs in the cache.
+        :param id_list: A list of arXiv IDs, with or without version.
+        :return: A dictionary from each cached ID to its arxiv.Result.
+        """
+        found = self._load_entries(id_list)
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(id_list) - len(found)
+        return found
+
+    def put_entries(self, results):
+        """
+        Store arxiv.Results in the cache.
+        :param results: A list of arxiv.Result objects.
+        :return: None
+        """
+        now = time.time()
+        rows = []
+        for result in results:
+            data = json.dumps(result_to_dict(result))
+            sid = short_id(result.entry_id)
+            rows.append((sid, data, now))
+            rows.append((strip_version(sid), data, now))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (id, data, fetched_at) VALUES (?, ?, ?)", rows)
+
+    def get_query(self, key):
+        """
+        Look up the results of a query.
+        :param key: The query key built by query_key.
+        :return: A list of arxiv.Result objects, or None if the query is not cached.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT ids FROM queries WHERE key = ? AND fetched_at >= ?",
+                (key, self._fresh_after())).fetchone()
+        entries = {}
+        if row is not None:
+            ids = json.loads(row[0])
+            entries = self._load_entries(ids)
+        with self.lock:
+            if row is None or len(entries) != len(ids):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return [entries[arxiv_id] for arxiv_id in ids]
+
+    def put_query(self, key, results):
+        """
+        Store the results of a query.
+        :param key: The query key built by query_key.
+        :param results: A list of arxiv.Result objects.
+        :return: None
+        """
+        self.put_entries(results)
+        ids = [short_id(result.entry_id) for result in results]
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO queries (key, ids, fetched_at) VALUES (?, ?, ?)",
+                (key, json.dumps(ids), time.time()))
+
+    def purge(self):
+        """
+        Remove the expired entries and queries.
+        :return: The number of removed rows.
+        """
+        fresh_after = self._fresh_after()
+        with self.lock, self.conn:
+            removed = self.conn.execute("DELETE FROM entries WHERE fetched_at < ?",
+                                        (fresh_after,)).rowcount
+            removed += self.conn.execute("DELETE FROM queries WHERE fetched_at < ?",
+                                         (fresh_after,)).rowcount
+        return removed
+
+    def clear(self):
+        """
+        Remove everything from the cache.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entries")
+            self.conn.execute("DELETE FROM queries")
+
+    def stats(self):
+        """
+        Returns the statistics of the cache.
+        """
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            queries = self.conn.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "queries": queries,
+            "ttl": self.ttl,
+        }
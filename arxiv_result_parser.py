@@ -6,6 +6,7 @@
 import os
 import urllib.request
 import logging
+from instrumentation import span, count
 
 
 logging.basicConfig(level=logging.INFO)
@@ -89,7 +90,9 @@ class ArxivResultParser:
                 os.makedirs(output_path)
 
             file_path = os.path.join(output_path, url.split('/')[-1]) + '.pdf'
-            urllib.request.urlretrieve(url, file_path)
+            with span("download"):
+                urllib.request.urlretrieve(url, file_path)
+            count("download.bytes", os.path.getsize(file_path))
             print("PDF file downloaded successfully!"
                   f"File saved at {file_path}")
             return file_path
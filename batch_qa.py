@@ -0,0 +1,236 @@
+# Description: This file contains the BatchAnswerer class used to answer many questions concurrently.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pdf_semantic_search import generate_prompt, chat_completion
+from context_packer import pack_context, estimate_tokens, estimate_answer_tokens
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def read_questions(source):
+    """
+    Read questions from a text file with one question per line, or from an iterable.
+    Empty lines and lines starting with '#' are skipped.
+    :param source: The path to the file, or an iterable of questions.
+    :return: A list of questions.
+    """
+    if isinstance(source, str):
+        with open(source, encoding='utf-8') as f:
+            lines = f.readlines()
+    else:
+        lines = list(source)
+    questions = [line.strip() for line in lines]
+    return [q for q in questions if q and not q.startswith('#')]
+
+
+class TokenBucket:
+    """
+    This class is a thread-safe token bucket limiting the tokens sent per minute.
+
+    A request reserves its estimated tokens before it is sent and settles the
+    difference once the actual size is known, so the bucket may go into debt,
+    which delays the following requests.
+    """
+
+    def __init__(self, tokens_per_minute):
+        """
+        :param tokens_per_minute: The number of tokens refilled per minute, also the bucket size.
+        """
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n):
+        """
+        Block until n tokens are available and take them. Requests larger than
+        the bucket wait for a full bucket.
+        :param n: The number of tokens.
+        :return: The number of seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                need = min(n, self.capacity)
+                if self.tokens >= need:
+                    self.tokens -= n
+                    return waited
+                delay = (need - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def settle(self, n):
+        """
+        Return n tokens to the bucket, or take -n tokens when n is negative.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + n)
+
+
+def call_with_timeout(func, timeout, *args, **kwargs):
+    """
+    Call a function in a daemon thread and wait at most 'timeout' seconds for it.
+    A call which times out keeps running in the background, its result is dropped,
+    so anything the call holds must be released by the function itself.
+    :return: The result of the function.
+    """
+    if timeout is None:
+        return func(*args, **kwargs)
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"The call did not finish within {timeout}s.")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+class BatchAnswerer:
+    """
+    This class is used to answer many questions about the fitted data at once.
+
+    All questions are encoded and searched with one batched call, then the
+    prompts are sent to the PySparkAI concurrently, bounded by the number of
+    requests in flight and by the tokens sent per minute. Failed requests are
+    retried with exponential backoff. A request which timed out keeps its slot
+    until it actually returns, so it still counts against the concurrency.
+    """
+
+    def __init__(self, ai, recommender, concurrency=4, tokens_per_minute=None,
+                 max_retries=3, backoff=1.0, timeout=120, max_tokens=None,
+                 temperature=0.7, context_tokens=2048):
+        """
+        :param ai: Instance of the PySparkAI.
+        :param recommender: Instance of the fitted SemanticSearch.
+        :param concurrency: The maximum number of requests in flight.
+        :param tokens_per_minute: The maximum number of tokens sent per minute (None for no limit).
+        :param max_retries: The number of retries of a failed request.
+        :param backoff: The delay before the first retry in seconds, doubled after every retry.
+        :param timeout: The timeout of a single request in seconds (None for no timeout).
+        :param max_tokens: Maximum number of tokens to generate (estimated from the packed search results by default).
+        :param temperature: Temperature parameter for generation.
+        :param context_tokens: Token budget of the search results in each prompt (None to include all chunks).
+        """
+        self.ai = ai
+        self.recommender = recommender
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.limiter = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.context_tokens = context_tokens
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "rate_limited_seconds": 0.0}
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def answer_prompt(self, prompt, max_tokens):
+        """
+        Send a prompt to the PySparkAI, retrying failed requests.
+        The rate limit reserves the prompt and 'max_tokens' answer tokens; the
+        unused answer tokens are returned when the request returns, also when
+        it returns after its timeout or with an error.
+        :param prompt: The prompt.
+        :param max_tokens: Maximum number of tokens to generate.
+        :return: The answer, or 'API Error: ...' once all retries have failed.
+        """
+        def request():
+            # Runs until the request returns, even when the caller stopped waiting for it.
+            answer_tokens = 0
+            try:
+                answer = chat_completion(self.ai, prompt, max_tokens=max_tokens, temperature=self.temperature)
+                answer_tokens = estimate_tokens(str(answer))
+                return answer
+            finally:
+                if self.limiter is not None:
+                    self.limiter.settle(max_tokens - answer_tokens)
+                self.slots.release()
+
+        for attempt in range(self.max_retries + 1):
+            self.slots.acquire()
+            if self.limiter is not None:
+                self._count("rate_limited_seconds", self.limiter.acquire(estimate_tokens(prompt) + max_tokens))
+            self._count("requests")
+            try:
+                return call_with_timeout(request, self.timeout)
+            except Exception as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"Request failed ({error}), retrying in {delay:.1f}s.")
+                self._count("retries")
+                time.sleep(delay)
+        self._count("failures")
+        return f'API Error: {str(error)}'
+
+    def iter_answers(self, questions, k=None):
+        """
+        Answer the questions, yielding every answer as soon as it is complete.
+        :param questions: The path to a file with one question per line, or an iterable of questions.
+        :param k: The number of chunks given to each prompt (defaults to n_neighbors given to fit).
+        :return: A generator of (index, question, answer) tuples in completion order.
+        """
+        questions = read_questions(questions)
+        if not questions:
+            return
+        neighbors = self.recommender.search_batch(questions, return_data=False, k=k)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+            for i, (question, rows) in enumerate(zip(questions, neighbors)):
+                rows = rows[rows >= 0]
+                context = pack_context([self.recommender.data[j] for j in rows],
+                                       self.context_tokens, chunk_ids=rows)
+                max_tokens = self.max_tokens or estimate_answer_tokens(context["tokens"])
+                prompt = generate_prompt(question, context["chunks"])
+                futures[executor.submit(self.answer_prompt, prompt, max_tokens)] = i
+            try:
+                for future in as_completed(futures):
+                    i = futures[future]
+                    yield i, questions[i], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def answer_all(self, questions, k=None):
+        """
+        Answer the questions and return the answers in the order of the questions.
+        :param questions: The path to a file with one question per line, or an iterable of questions.
+        :param k: The number of chunks given to each prompt.
+        :return: A list of answers.
+        """
+        questions = read_questions(questions)
+        answers = [None] * len(questions)
+        for i, _, answer in self.iter_answers(questions, k=k):
+            answers[i] = answer
+        return answers
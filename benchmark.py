@@ -0,0 +1,247 @@
+# Description: This file benchmarks text extraction, chunking, encoding and search on synthetic PDFs.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+from pdftotext import PDFTextExtractor
+from encoders import get_encoder
+from pdf_semantic_search import SemanticSearch
+
+
+def make_vocabulary(size=5000, seed=0):
+    """
+    Generate a fixed vocabulary of random lowercase words.
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    lengths = rng.integers(2, 11, size)
+    return [''.join(rng.choice(letters, n)) for n in lengths]
+
+
+def synthetic_words(n, vocabulary, seed=0):
+    """
+    Draw n words with a Zipf-like distribution, as in natural text.
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, len(vocabulary) + 1)
+    ids = rng.choice(len(vocabulary), n, p=weights / weights.sum())
+    return [vocabulary[i] for i in ids]
+
+
+def make_synthetic_pdf(path, pages=50, words_per_page=400, seed=0):
+    """
+    Write a PDF of random text with PyMuPDF.
+    :param path: The path of the PDF.
+    :param pages: The number of pages.
+    :param words_per_page: The number of words per page.
+    :param seed: The random seed.
+    :return: The path of the PDF.
+    """
+    import fitz
+    words = synthetic_words(pages * words_per_page, make_vocabulary(seed=seed), seed=seed)
+    with fitz.open() as doc:
+        for p in range(pages):
+            page = doc.new_page()
+            text = ' '.join(words[p * words_per_page:(p + 1) * words_per_page])
+            page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50),
+                                text, fontsize=8)
+        doc.save(path)
+    return path
+
+
+def synthetic_chunks(n, word_length=150, seed=0):
+    """
+    Generate n chunks formatted like PDFTextExtractor.text_to_chunks.
+    """
+    words = synthetic_words(n * word_length, make_vocabulary(seed=seed), seed=seed)
+    return [f'[Page no. {i // 4 + 1}] "' + ' '.join(words[i * word_length:(i + 1) * word_length]) + '"'
+            for i in range(n)]
+
+
+def median_of(func, repeats):
+    """
+    Run a function several times and return its last result and the median time in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, float(np.median(times))
+
+
+def percentiles(latencies_ms):
+    """
+    Returns the p50, p95 and p99 of latencies.
+    """
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def bench_extraction(pdf_path, repeats=3, workers=None, word_length=150):
+    """
+    Measure pages/s of pdf_to_text and chunks/s of text_to_chunks, from the median of the repeats.
+    :return: A tuple of the results and the extracted chunks.
+    """
+    extractor = PDFTextExtractor(pdf_path)
+    texts, extract_s = median_of(lambda: extractor.pdf_to_text(workers=workers), repeats)
+    chunks, chunk_s = median_of(lambda: extractor.text_to_chunks(texts, word_length=word_length), repeats)
+    results = {
+        "extract.pages": len(texts),
+        "extract.pages_per_s": len(texts) / extract_s,
+        "chunk.chunks": len(chunks),
+        "chunk.chunks_per_s": len(chunks) / chunk_s,
+    }
+    return results, chunks
+
+
+def bench_encoder(name, chunks, repeats=3, batch=256):
+    """
+    Measure embeddings/s of an encoder backend, from the median of the repeats.
+    The first call, which loads the model, is not timed.
+    """
+    encoder = get_encoder(name)
+    encoder.encode(chunks[:batch])
+
+    def encode_all():
+        for i in range(0, len(chunks), batch):
+            encoder.encode(chunks[i:i + batch])
+
+    _, seconds = median_of(encode_all, repeats)
+    return {f"encode.{name}.embeddings_per_s": len(chunks) / seconds}
+
+
+def bench_search(encoder_name, sizes, n_queries=200, k=5, index='exact', seed=0):
+    """
+    Measure the fit time and the search latency of SemanticSearch at several corpus sizes.
+    Queries are words of random chunks, so every query has relevant results.
+    """
+    results = {}
+    recommender = SemanticSearch(encoder=get_encoder(encoder_name))
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        chunks = synthetic_chunks(n, seed=seed)
+        start = time.perf_counter()
+        recommender.fit(chunks, n_neighbors=k, index=index)
+        build_s = time.perf_counter() - start
+        queries = [' '.join(chunks[i].split()[3:15]) for i in rng.integers(0, n, n_queries)]
+        recommender.search(queries[0])
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            recommender.search(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+        prefix = f"search.{encoder_name}.{index}.n={n}"
+        results[f"{prefix}.build_s"] = build_s
+        results.update({f"{prefix}.{key}": value for key, value in percentiles(latencies).items()})
+    return results
+
+
+def run_benchmarks(pages=50, words_per_page=400, sizes=(1000, 10000), n_queries=200,
+                   encoders=('hashing',), repeats=3, workers=None, index='exact', seed=0):
+    """
+    Run all benchmarks.
+    :return: A dictionary with the 'meta' data of the run and the 'results' by metric name.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = make_synthetic_pdf(os.path.join(tmp, 'synthetic.pdf'), pages, words_per_page, seed)
+        extraction, chunks = bench_extraction(pdf_path, repeats=repeats, workers=workers)
+        results.update(extraction)
+    for name in encoders:
+        try:
+            results.update(bench_encoder(name, chunks, repeats=repeats))
+            results.update(bench_search(name, sizes, n_queries=n_queries, index=index, seed=seed))
+        except ImportError as e:
+            print(f"Skipping the '{name}' encoder: {e}", file=sys.stderr)
+    meta = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"pages": pages, "words_per_page": words_per_page, "sizes": list(sizes),
+                   "queries": n_queries, "encoders": list(encoders), "repeats": repeats,
+                   "workers": workers, "index": index, "seed": seed},
+    }
+    return {"meta": meta, "results": results}
+
+
+def higher_is_better(metric):
+    return metric.endswith('_per_s')
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare results with a baseline run.
+    :param results: The 'results' of a run.
+    :param baseline: The 'results' of the baseline run.
+    :param tolerance: The relative slowdown tolerated before a metric counts as a regression.
+    :return: A list of rows with the metric, both values, the relative change and whether it regressed.
+    """
+    rows = []
+    for metric in sorted(set(results) & set(baseline)):
+        new, old = results[metric], baseline[metric]
+        if metric.endswith(('.pages', '.chunks')) or not old:
+            continue
+        change = (new - old) / old
+        slowdown = -change if higher_is_better(metric) else change
+        rows.append({"metric": metric, "baseline": old, "value": new, "change": change,
+                     "regression": slowdown > tolerance})
+    return rows
+
+
+def print_results(results):
+    for metric, value in results.items():
+        print(f"{metric:<50} {value:>14.3f}")
+
+
+def print_comparison(rows):
+    print(f"{'metric':<50} {'baseline':>12} {'value':>12} {'change':>8}")
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['metric']:<50} {row['baseline']:>12.3f} {row['value']:>12.3f} "
+              f"{row['change']:>+8.1%}{flag}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark extraction, chunking, encoding and search.")
+    arg_parser.add_argument("--pages", type=int, default=50, help="Pages of the synthetic PDF.")
+    arg_parser.add_argument("--words-per-page", type=int, default=400)
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                            help="Corpus sizes (chunks) of the search benchmark.")
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--encoders", nargs="+", default=["hashing"], help="Encoder backends to benchmark.")
+    arg_parser.add_argument("--index", default="exact", choices=["exact", "ivf"])
+    arg_parser.add_argument("--repeats", type=int, default=3, help="Runs of each timed benchmark, the median is reported.")
+    arg_parser.add_argument("--workers", type=int, default=None, help="Worker processes of pdf_to_text.")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--json", help="Write the results to this JSON file.")
+    arg_parser.add_argument("--baseline", help="Compare the results with this JSON file of an earlier run.")
+    arg_parser.add_argument("--tolerance", type=float, default=0.1,
+                            help="Relative slowdown tolerated before a metric counts as a regression.")
+    args = arg_parser.parse_args()
+
+    run = run_benchmarks(pages=args.pages, words_per_page=args.words_per_page, sizes=args.sizes,
+                         n_queries=args.queries, encoders=args.encoders, repeats=args.repeats,
+                         workers=args.workers, index=args.index, seed=args.seed)
+    print_results(run["results"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(run["results"], baseline["results"], tolerance=args.tolerance)
+        print()
+        print_comparison(rows)
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,138 @@
+# Description: This file contains the BM25Index class used for lexical retrieval over chunks.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import re
+import numpy as np
+from corpus_index import PAGE_PATTERN
+from search_engine import top_k
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """
+    Split a chunk into lowercase terms, without its '[Page no. N]' prefix.
+    :param text: The chunk text.
+    :return: A list of terms.
+    """
+    return TOKEN_PATTERN.findall(PAGE_PATTERN.sub('', text).lower())
+
+
+class BM25Index:
+    """
+    This class is used to search chunks by their terms with BM25 scoring.
+
+    The postings of all terms are stored in three flat arrays (CSR layout):
+    'offsets[t]:offsets[t + 1]' is the slice of 'doc_ids' and 'tfs' belonging
+    to term t, so the index needs no Python object per posting.
+    """
+
+    def __init__(self, chunks=None, k1=1.5, b=0.75):
+        """
+        Initialize the index.
+        :param chunks: A list of chunks to index (optional).
+        :param k1: The term frequency saturation parameter.
+        :param b: The document length normalization parameter.
+        """
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.n_docs = 0
+        if chunks is not None:
+            self.fit(chunks)
+
+    def __len__(self):
+        return self.n_docs
+
+    def fit(self, chunks):
+        """
+        Build the index from the given chunks.
+        :param chunks: A list of chunks.
+        :return: self
+        """
+        vocabulary = {}
+        term_ids, doc_ids, lengths = [], [], []
+        for doc_id, chunk in enumerate(chunks):
+            terms = tokenize(chunk)
+            lengths.append(len(terms))
+            term_ids.extend(vocabulary.setdefault(term, len(vocabulary)) for term in terms)
+            doc_ids.extend([doc_id] * len(terms))
+        self.vocabulary = vocabulary
+        self.n_docs = len(lengths)
+        self.doc_lengths = np.asarray(lengths, dtype=np.float32)
+        self.avg_length = float(self.doc_lengths.mean()) if self.n_docs else 0.0
+
+        # Count every (term, doc) pair once, sorted by term then doc.
+        keys = np.asarray(term_ids, dtype=np.int64) * max(self.n_docs, 1) + np.asarray(doc_ids, dtype=np.int64)
+        keys, tfs = np.unique(keys, return_counts=True)
+        terms = keys // max(self.n_docs, 1)
+        self.doc_ids = (keys % max(self.n_docs, 1)).astype(np.int32)
+        self.tfs = np.minimum(tfs, np.iinfo(np.uint16).max).astype(np.uint16)
+        df = np.bincount(terms, minlength=len(vocabulary))
+        self.offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        self.idf = np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        return self
+
+    def scores(self, query):
+        """
+        Compute the BM25 score of every chunk for the query.
+        :param query: The query text.
+        :return: An array of scores, one per chunk.
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(self.avg_length, 1e-9))
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            scores[docs] += self.idf[term_id] * tfs * (self.k1 + 1) / (tfs + norm[docs])
+        return scores
+
+    def search(self, query, n=10):
+        """
+        Search the chunks with the highest BM25 scores.
+        :param query: The query text.
+        :param n: The maximum number of results.
+        :return: A tuple of (scores, indices), best first. Chunks without any
+                 query term are not returned.
+        """
+        scores = self.scores(query)
+        best_scores, best = top_k(scores[None, :], n)
+        matched = best_scores[0] > 0
+        return best_scores[0][matched], best[0][matched]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse several rankings with reciprocal rank fusion.
+    :param rankings: A list of arrays of indices, each best first.
+    :param k: The rank offset, larger values flatten the contribution of the top ranks.
+    :return: A tuple of (scores, indices), best first.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, i in enumerate(ranking):
+            fused[int(i)] = fused.get(int(i), 0.0) + 1.0 / (k + rank + 1)
+    order = sorted(fused, key=fused.get, reverse=True)
+    return np.array([fused[i] for i in order]), np.array(order, dtype=np.int64)
+
+
+def linear_fusion(lexical_scores, dense_scores, alpha=0.5):
+    """
+    Fuse lexical and dense scores of the same candidates by a weighted sum of
+    their min-max normalized values.
+    :param lexical_scores: The BM25 scores of the candidates.
+    :param dense_scores: The dense scores of the candidates.
+    :param alpha: The weight of the dense scores.
+    :return: The fused scores.
+    """
+    def scale(x):
+        x = np.asarray(x, dtype=np.float32)
+        span = x.max() - x.min() if len(x) else 0
+        return (x - x.min()) / span if span > 0 else np.ones_like(x)
+    return alpha * scale(dense_scores) + (1 - alpha) * scale(lexical_scores)
@@ -0,0 +1,162 @@
+# Description: This file contains the MinHash LSH index used to remove duplicate chunks before embedding.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import re
+import zlib
+import hashlib
+import numpy as np
+from context_packer import split_chunk, format_chunk
+
+WORD_PATTERN = re.compile(r'\w+')
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def shingle_hashes(words, n=3):
+    """
+    Hash the word n-grams of a chunk.
+    :param words: The lowercase words of the chunk.
+    :param n: The number of words per shingle.
+    :return: A uint64 array of the distinct shingle hashes.
+    """
+    if len(words) <= n:
+        grams = [' '.join(words)]
+    else:
+        grams = [' '.join(words[i:i + n]) for i in range(len(words) - n + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64,
+                                 count=len(grams)))
+
+
+class MinHashLSH:
+    """
+    This class is used to find near-duplicate chunks.
+
+    Every chunk gets a MinHash signature of num_perm values; the share of equal
+    values estimates the Jaccard similarity of the chunks' word trigrams. The
+    signature is cut into bands, and chunks with an equal band land in the same
+    bucket, so only chunks likely to be similar are compared.
+    """
+
+    def __init__(self, num_perm=64, bands=16, seed=1):
+        """
+        :param num_perm: The number of hash functions of a signature.
+        :param bands: The number of bands; more bands find pairs of lower similarity.
+        :param seed: The seed of the hash functions.
+        """
+        if num_perm % bands:
+            raise ValueError("The 'num_perm' parameter must be a multiple of 'bands'.")
+        rng = np.random.default_rng(seed)
+        # Hashes are below 2**32 and a below 2**31, so a * h + b fits in uint64.
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [{} for _ in range(bands)]
+
+    def signature(self, hashes):
+        """
+        Returns the MinHash signature of an array of shingle hashes.
+        """
+        return ((self.a * hashes[None, :] + self.b) % MERSENNE_PRIME).min(axis=1)
+
+    def _band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def insert(self, key, signature):
+        """
+        Add a signature under a key.
+        """
+        for bucket, band in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(band, []).append(key)
+
+    def query(self, signature):
+        """
+        Returns the keys sharing at least one band with the signature, in insertion order.
+        """
+        candidates = {}
+        for bucket, band in zip(self.buckets, self._band_keys(signature)):
+            for key in bucket.get(band, ()):
+                candidates[key] = True
+        return list(candidates)
+
+
+def deduplicate_chunks(chunks, threshold=0.8, num_perm=64, bands=16):
+    """
+    Group exact and near-duplicate chunks, e.g. running headers, licence text
+    or passages repeated in the paper, so that each group is embedded once.
+
+    Chunks are compared by their words, ignoring case, punctuation and the
+    page prefix. The first chunk of a group is kept, and its page prefix lists
+    the pages of all chunks of the group, e.g. '[Page no. 1, 9]', so citations
+    still point at every page.
+    :param chunks: The chunks created by PDFTextExtractor.text_to_chunks.
+    :param threshold: The estimated Jaccard similarity above which chunks are duplicates.
+    :param num_perm: The number of hash functions of a MinHash signature.
+    :param bands: The number of LSH bands.
+    :return: A dictionary with the kept 'chunks', the 'groups' (indices of the
+             input chunks per kept chunk) and the number of input 'chunks_in',
+             'exact' and 'near' duplicates.
+    """
+    lsh = MinHashLSH(num_perm=num_perm, bands=bands)
+    exact = {}
+    signatures = []
+    groups = []
+    pages = []
+    bodies = []
+    report = {"chunks_in": len(chunks), "exact": 0, "near": 0}
+    for i, chunk in enumerate(chunks):
+        chunk_pages, words = split_chunk(chunk)
+        normalized = WORD_PATTERN.findall(' '.join(words).lower())
+        digest = hashlib.blake2b(' '.join(normalized).encode('utf-8'), digest_size=16).digest()
+        group = exact.get(digest)
+        if group is not None:
+            report["exact"] += 1
+        else:
+            signature = lsh.signature(shingle_hashes(normalized)) if normalized else None
+            if signature is not None:
+                for candidate in lsh.query(signature):
+                    if np.mean(signatures[candidate] == signature) >= threshold:
+                        group = candidate
+                        report["near"] += 1
+                        break
+            if group is None:
+                group = len(groups)
+                groups.append([])
+                pages.append([])
+                bodies.append(words)
+                signatures.append(signature)
+                if signature is not None:
+                    lsh.insert(group, signature)
+            exact[digest] = group
+        groups[group].append(i)
+        pages[group].extend(p for p in chunk_pages if p not in pages[group])
+
+    report["chunks"] = [chunks[group[0]] if len(page_list) == 1 and len(group) == 1
+                        else format_chunk(tuple(sorted(page_list)), words)
+                        for group, page_list, words in zip(groups, pages, bodies)]
+    report["groups"] = groups
+    report["duplicates"] = len(chunks) - len(groups)
+    report["text_bytes_saved"] = (sum(len(c.encode('utf-8')) for c in chunks)
+                                  - sum(len(c.encode('utf-8')) for c in report["chunks"]))
+    return report
+
+
+def dedup_savings(report, embeddings):
+    """
+    Compute what deduplication saved for a document.
+    :param report: The report returned by deduplicate_chunks.
+    :param embeddings: The embeddings of the kept chunks.
+    :return: A dictionary with the 'chunks_in', the 'chunks' kept, the 'exact' and
+             'near' duplicates, the 'encoder_calls_saved' (chunks not encoded) and the
+             'index_bytes_saved' (vectors and chunk text not stored).
+    """
+    row_bytes = np.asarray(embeddings[:1]).nbytes
+    return {
+        "chunks_in": report["chunks_in"],
+        "chunks": len(report["chunks"]),
+        "exact": report["exact"],
+        "near": report["near"],
+        "encoder_calls_saved": report["duplicates"],
+        "index_bytes_saved": report["duplicates"] * row_bytes + report["text_bytes_saved"],
+    }
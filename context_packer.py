@@ -0,0 +1,164 @@
+# Description: This file contains the context packer used to fit the search results into a token budget.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import re
+from corpus_index import PAGE_PATTERN, parse_pages
+
+CJK_PATTERN = re.compile('[\u4e00-\u9fff]')
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of LLM tokens of a text without a tokenizer:
+    about one token per CJK character and one per four other characters.
+
+    :param text: The text.
+    :return: Estimated number of tokens.
+    """
+    if text.isascii():
+        return (len(text) + 3) // 4
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_answer_tokens(context_tokens, min_tokens=256, max_tokens=1024, ratio=0.5):
+    """
+    Estimate the number of tokens needed for the answer. The prompt asks for a
+    short answer of the search results, so it scales with the packed context.
+
+    :param context_tokens: The number of tokens of the packed search results.
+    :param min_tokens: The lower bound of the estimate.
+    :param max_tokens: The upper bound of the estimate.
+    :param ratio: The answer tokens per context token.
+    :return: The number of answer tokens to request.
+    """
+    return int(min(max_tokens, max(min_tokens, ratio * context_tokens)))
+
+
+def split_chunk(chunk):
+    """
+    Split a chunk created by PDFTextExtractor.text_to_chunks into its page numbers and words.
+    """
+    body = PAGE_PATTERN.sub('', chunk).strip()
+    if len(body) >= 2 and body[0] == '"' and body[-1] == '"':
+        body = body[1:-1]
+    return parse_pages(chunk), body.split()
+
+
+def format_chunk(page, words):
+    """
+    Format a page number (or a tuple of page numbers) and words like PDFTextExtractor.text_to_chunks does.
+    """
+    pages = page if isinstance(page, tuple) else (page,)
+    return f'[Page no. {", ".join(map(str, pages))}] "' + ' '.join(words) + '"'
+
+
+def _shingles(words, n=3):
+    words = [w.lower() for w in words]
+    if len(words) <= n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def _overlap(left, right, max_words=200):
+    """
+    Returns the number of trailing words of 'left' which start 'right'.
+    """
+    for n in range(min(len(left), len(right), max_words), 0, -1):
+        if left[-n:] == right[:n]:
+            return n
+    return 0
+
+
+def pack_context(chunks, token_budget=None, chunk_ids=None, similarity=0.8, min_overlap=8,
+                 min_tail_tokens=64):
+    """
+    Pack the search results into a token budget.
+
+    Chunks which are mostly contained in a better ranked chunk are dropped.
+    Chunks from the same page which are adjacent (consecutive chunk ids, or
+    the end of one overlapping the start of the other) are merged into one
+    passage without repeating the shared words. The passages are then taken
+    in the order of their best ranked chunk until the budget is spent; the
+    passage which crosses the budget is cut at a word boundary.
+
+    :param chunks: The chunks, best ranked first.
+    :param token_budget: The maximum number of tokens of the packed chunks (None for no limit).
+    :param chunk_ids: The indices of the chunks in the fitted data, used to find adjacent chunks (optional).
+    :param similarity: The share of a chunk's word trigrams found in a better ranked
+                       chunk above which it is dropped as a near duplicate.
+    :param min_overlap: The minimum number of shared words to merge chunks without ids.
+    :param min_tail_tokens: The minimum remaining budget worth filling with a cut passage.
+    :return: A dictionary with the packed 'chunks', their estimated 'tokens', the
+             estimated 'input_tokens' of the given chunks and the number of
+             'dropped', 'merged' and 'truncated' chunks.
+    """
+    chunks = list(chunks)
+    ids = [int(i) for i in chunk_ids] if chunk_ids is not None else [None] * len(chunks)
+    report = {"input_tokens": sum(estimate_tokens(c) + 1 for c in chunks),
+              "dropped": 0, "merged": 0, "truncated": 0}
+
+    # Drop near duplicates of better ranked chunks.
+    kept = []
+    for rank, (chunk, chunk_id) in enumerate(zip(chunks, ids)):
+        page, words = split_chunk(chunk)
+        shingles = _shingles(words)
+        if any(len(shingles & other[4]) >= similarity * len(shingles) for other in kept):
+            report["dropped"] += 1
+            continue
+        kept.append((rank, chunk_id, page, words, shingles))
+
+    # Merge adjacent chunks of the same page into passages, in text order.
+    passages = []
+    by_position = sorted(kept, key=lambda c: (c[2], c[1] if c[1] is not None else -1, c[0]))
+    for rank, chunk_id, page, words, _ in by_position:
+        if passages:
+            last = passages[-1]
+            if last["page"] == page:
+                shared = _overlap(last["words"], words)
+                consecutive = chunk_id is not None and last["last_id"] is not None and chunk_id == last["last_id"] + 1
+                if consecutive or shared >= min_overlap:
+                    last["words"] = last["words"] + words[shared:]
+                    last["last_id"] = chunk_id
+                elif chunk_id is None and _overlap(words, last["words"]) >= min_overlap:
+                    # Without ids the chunks of a page are in rank order, not text order.
+                    last["words"] = words + last["words"][_overlap(words, last["words"]):]
+                else:
+                    last = None
+                if last is not None:
+                    last["rank"] = min(last["rank"], rank)
+                    report["merged"] += 1
+                    continue
+        passages.append({"rank": rank, "page": page, "words": words, "last_id": chunk_id})
+
+    # Take the passages of the best ranked chunks first.
+    packed, tokens = [], 0
+    for passage in sorted(passages, key=lambda p: p["rank"]):
+        text = format_chunk(passage["page"], passage["words"])
+        cost = estimate_tokens(text) + 1
+        if token_budget is None or tokens + cost <= token_budget:
+            packed.append(text)
+            tokens += cost
+            continue
+        remaining = token_budget - tokens
+        if remaining >= min_tail_tokens:
+            words = passage["words"]
+            lo, hi = 0, len(words)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if estimate_tokens(format_chunk(passage["page"], words[:mid])) + 1 <= remaining:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            if lo:
+                text = format_chunk(passage["page"], words[:lo])
+                packed.append(text)
+                tokens += estimate_tokens(text) + 1
+                report["truncated"] += 1
+        break
+
+    report["chunks"] = packed
+    report["tokens"] = tokens
+    return report
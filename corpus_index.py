@@ -0,0 +1,330 @@
+# Description: This file contains the CorpusIndex class used to search across many papers.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import re
+import logging
+import numpy as np
+from search_engine import normalize, top_k
+from metadata_filter import archive_of, to_date, normalize_filters
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Deduplicated chunks list every page they occur on, e.g. '[Page no. 3, 7]'.
+PAGE_PATTERN = re.compile(r'^\[Page no\. (\d+)((?:, \d+)*)\]')
+
+
+def parse_page(chunk):
+    """
+    Parse the page number from a chunk created by PDFTextExtractor.text_to_chunks.
+    :param chunk: The chunk text.
+    :return: The (first) page number, or 0 if the chunk has no page prefix.
+    """
+    match = PAGE_PATTERN.match(chunk)
+    return int(match.group(1)) if match else 0
+
+
+def parse_pages(chunk):
+    """
+    Parse all page numbers from the prefix of a chunk.
+    :param chunk: The chunk text.
+    :return: A tuple of the page numbers, (0,) if the chunk has no page prefix.
+    """
+    match = PAGE_PATTERN.match(chunk)
+    if not match:
+        return (0,)
+    return (int(match.group(1)),) + tuple(int(p) for p in match.group(2).split(', ')[1:])
+
+
+class CorpusIndex:
+    """
+    This class is used to keep the chunks of many papers in one index.
+
+    Vectors are normalized and appended to a preallocated matrix which grows geometrically,
+    so adding a paper costs time proportional to the size of that paper.
+    Removed papers are only marked as deleted; the rows are compacted once
+    more than half of the matrix is dead.
+
+    For filtered search every category, archive and primary category has a
+    boolean row mask, and every row has the publication date of its paper,
+    all kept up to date as papers are added and removed.
+    """
+
+    def __init__(self, capacity=1024, encoder_id=None):
+        """
+        Initialize an empty index.
+        :param capacity: The initial number of rows allocated for vectors.
+        :param encoder_id: The identity of the encoder of the vectors (optional).
+        """
+        self.capacity = capacity
+        self.encoder_id = encoder_id
+        self.vectors = None
+        self.size = 0
+        self.texts = []
+        self.row_doc_ids = []
+        self.pages = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.documents = {}
+        self.dead = 0
+        self.version = 0
+        self.metadata = {}
+        # Facet key, e.g. ('category', 'cs.LG'), to a row mask and its number of rows.
+        self.facets = {}
+        self.facet_counts = {}
+        # The publication date of every row as a proleptic ordinal, 0 if unknown.
+        self.published = np.zeros(capacity, dtype=np.int32)
+        self._filter_cache = {}
+
+    def __len__(self):
+        return self.size - self.dead
+
+    def __contains__(self, doc_id):
+        return doc_id in self.documents
+
+    def _reserve(self, extra, dim):
+        """
+        Make sure there is room for 'extra' more rows.
+        """
+        if self.vectors is None:
+            self.vectors = np.zeros((self.capacity, dim), dtype=np.float32)
+        elif self.vectors.shape[1] != dim:
+            raise ValueError(
+                f"Embedding dimension {dim} does not match the index dimension {self.vectors.shape[1]}.")
+        needed = self.size + extra
+        if needed <= len(self.vectors):
+            return
+        capacity = len(self.vectors)
+        while capacity < needed:
+            capacity *= 2
+        self.vectors = self._grow(self.vectors, capacity)
+        self.pages = self._grow(self.pages, capacity)
+        self.alive = self._grow(self.alive, capacity)
+        self.published = self._grow(self.published, capacity)
+        self.facets = {key: self._grow(mask, capacity) for key, mask in self.facets.items()}
+
+    @staticmethod
+    def _grow(array, capacity):
+        grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add_document(self, doc_id, chunks, embeddings, pages=None, encoder_id=None, metadata=None):
+        """
+        Add the chunks of a paper to the index. A paper which is already
+        indexed is replaced.
+        :param doc_id: The ID of the paper, e.g. the arXiv entry_id.
+        :param chunks: A list of chunks of the paper.
+        :param embeddings: The embeddings of the chunks.
+        :param pages: The page number of each chunk (optional, parsed from the chunks by default).
+        :param encoder_id: The identity of the encoder of the embeddings (optional).
+        :param metadata: The metadata of the paper used by filtered search, see result_metadata (optional).
+        :return: None
+        """
+        if encoder_id is not None:
+            if self.encoder_id is None:
+                self.encoder_id = encoder_id
+            elif encoder_id != self.encoder_id:
+                raise ValueError(
+                    f"The index holds vectors of encoder '{self.encoder_id}', not '{encoder_id}'.")
+        embeddings = normalize(np.atleast_2d(embeddings))
+        if len(chunks) != len(embeddings):
+            raise ValueError("The number of chunks and embeddings must be equal.")
+        if pages is None:
+            pages = [parse_page(c) for c in chunks]
+        if doc_id in self.documents:
+            self.remove_document(doc_id)
+
+        n = len(chunks)
+        self._reserve(n, embeddings.shape[1])
+        rows = np.arange(self.size, self.size + n)
+        self.vectors[rows] = embeddings
+        self.pages[rows] = pages
+        self.alive[rows] = True
+        self.texts.extend(chunks)
+        self.row_doc_ids.extend([doc_id] * n)
+        self.documents[doc_id] = rows
+        self.published[rows] = 0
+        self.size += n
+        self.version += 1
+        if metadata is not None:
+            self._add_facets(doc_id, rows, metadata)
+
+    @staticmethod
+    def _facet_keys(metadata):
+        categories = metadata.get("categories") or []
+        keys = {('category', c) for c in categories}
+        keys.update(('archive', archive_of(c)) for c in categories)
+        if metadata.get("primary_category"):
+            keys.add(('primary', metadata["primary_category"]))
+        return keys
+
+    def _add_facets(self, doc_id, rows, metadata):
+        self.metadata[doc_id] = metadata
+        if metadata.get("published"):
+            self.published[rows] = to_date(metadata["published"]).toordinal()
+        for key in self._facet_keys(metadata):
+            mask = self.facets.get(key)
+            if mask is None:
+                mask = self.facets[key] = np.zeros(len(self.alive), dtype=bool)
+            mask[rows] = True
+            self.facet_counts[key] = self.facet_counts.get(key, 0) + len(rows)
+
+    def _remove_facets(self, doc_id, rows):
+        metadata = self.metadata.pop(doc_id, None)
+        if metadata is None:
+            return
+        for key in self._facet_keys(metadata):
+            mask = self.facets.get(key)
+            if mask is None:
+                continue
+            mask[rows] = False
+            self.facet_counts[key] -= len(rows)
+            if not self.facet_counts[key]:
+                del self.facets[key], self.facet_counts[key]
+
+    def remove_document(self, doc_id):
+        """
+        Remove a paper from the index.
+        :param doc_id: The ID of the paper.
+        :return: None
+        """
+        rows = self.documents.pop(doc_id, None)
+        if rows is None:
+            raise KeyError(f"The document '{doc_id}' is not in the index.")
+        self.alive[rows] = False
+        self.dead += len(rows)
+        self.version += 1
+        self._remove_facets(doc_id, rows)
+        if self.dead > self.size // 2:
+            self.compact()
+
+    def compact(self):
+        """
+        Drop the rows of removed papers from the index.
+        :return: None
+        """
+        keep = np.flatnonzero(self.alive[:self.size])
+        n = len(keep)
+        self.vectors[:n] = self.vectors[keep]
+        self.pages[:n] = self.pages[keep]
+        self.alive[:n] = True
+        self.alive[n:] = False
+        self.published[:n] = self.published[keep]
+        for mask in self.facets.values():
+            mask[:n] = mask[keep]
+            mask[n:] = False
+        self.texts = [self.texts[i] for i in keep]
+        self.row_doc_ids = [self.row_doc_ids[i] for i in keep]
+        self.documents = {}
+        for row, doc_id in enumerate(self.row_doc_ids):
+            self.documents.setdefault(doc_id, []).append(row)
+        self.documents = {doc_id: np.asarray(rows) for doc_id, rows in self.documents.items()}
+        self.size = n
+        self.dead = 0
+        self._filter_cache = {}
+
+    def _filter_mask(self, categories, archives, primary_only, after, before):
+        """
+        Returns the row mask of a normalized filter, or None if it matches everything.
+        """
+        mask = None
+        if categories or archives:
+            kind = 'primary' if primary_only else 'category'
+            keys = [(kind, c) for c in categories] + [('archive', a) for a in archives]
+            mask = np.zeros(self.size, dtype=bool)
+            for key in keys:
+                if key in self.facets:
+                    mask |= self.facets[key][:self.size]
+        if after is not None or before is not None:
+            published = self.published[:self.size]
+            dated = published > 0
+            if after is not None:
+                dated &= published >= after.toordinal()
+            if before is not None:
+                dated &= published <= before.toordinal()
+            mask = dated if mask is None else mask & dated
+        if mask is not None:
+            mask &= self.alive[:self.size]
+        return mask
+
+    def _filter(self, filters):
+        """
+        Returns the sorted rows and the runs of consecutive rows, as (start, end)
+        pairs, matching a filter, computed once per version of the index.
+        """
+        spec = normalize_filters(filters)
+        cached = self._filter_cache.get(spec)
+        if cached is not None and cached[0] == self.version:
+            return cached[1], cached[2]
+        mask = self._filter_mask(*spec)
+        if mask is None:
+            rows = runs = None
+        else:
+            rows = np.flatnonzero(mask)
+            # The rows of a paper are consecutive, so a filter selects a few long runs.
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            runs = list(zip(rows[np.r_[0, breaks]], rows[np.r_[breaks - 1, len(rows) - 1]] + 1)) if len(rows) else []
+        if len(self._filter_cache) >= 64:
+            self._filter_cache.clear()
+        self._filter_cache[spec] = (self.version, rows, runs)
+        return rows, runs
+
+    def filter_rows(self, filters):
+        """
+        Returns the rows of the papers matching a filter.
+        :param filters: The filter, see normalize_filters.
+        :return: A sorted array of row ids, or None if the filter matches every row.
+        """
+        return self._filter(filters)[0]
+
+    def search_batch(self, query_embeddings, k=5, filters=None):
+        """
+        Search the index for the chunks closest to each query by cosine similarity.
+        :param query_embeddings: A 2-D array of query embeddings.
+        :param k: The number of results per query.
+        :param filters: Only search the papers matching this filter, see normalize_filters (optional).
+        :return: A list with the results of every query, each result holding
+                 the chunk text, doc_id, page and score.
+        """
+        queries = normalize(np.atleast_2d(query_embeddings))
+        rows, runs = self._filter(filters) if filters else (None, None)
+        if len(self) == 0 or (rows is not None and len(rows) == 0):
+            return [[] for _ in range(len(queries))]
+        if rows is not None:
+            # Score only the matching rows, one slice (a view, not a copy) per run.
+            scores = np.empty((len(rows), len(queries)), dtype=np.float32)
+            offset = 0
+            for start, end in runs:
+                np.matmul(self.vectors[start:end], queries.T, out=scores[offset:offset + end - start])
+                offset += end - start
+            top_scores, top = top_k(scores.T, min(k, len(rows)))
+            top_rows = rows[top]
+        else:
+            scores = queries @ self.vectors[:self.size].T
+            if self.dead:
+                scores[:, ~self.alive[:self.size]] = -np.inf
+            top_scores, top_rows = top_k(scores, min(k, len(self)))
+        return [[{"text": self.texts[i],
+                  "doc_id": self.row_doc_ids[i],
+                  "page": int(self.pages[i]),
+                  "score": float(score)} for score, i in zip(score_row, row)]
+                for score_row, row in zip(top_scores, top_rows)]
+
+    def search(self, query_embedding, k=5, filters=None):
+        """
+        Search the index for the chunks closest to the query by cosine similarity.
+        :param query_embedding: The embedding of the query.
+        :param k: The number of results.
+        :param filters: Only search the papers matching this filter, see normalize_filters (optional).
+        :return: A list of results with the chunk text, doc_id, page and score.
+        """
+        return self.search_batch(np.reshape(query_embedding, (1, -1)), k=k, filters=filters)[0]
+
+    def get_document_chunks(self, doc_id):
+        """
+        Returns the chunks of a paper in the index.
+        """
+        return [self.texts[i] for i in self.documents[doc_id]]
@@ -0,0 +1,270 @@
+# Description: This file contains the CorpusManifest and CorpusRefresher classes used to keep a local corpus current.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+from arxiv_api import ArxivAPI
+from arxiv_cache import VERSION_PATTERN, short_id, strip_version
+from pdf_downloader import PDFDownloader
+from embedding_cache import EmbeddingCache
+from ingest_pipeline import IngestPipeline
+from metadata_filter import result_metadata
+from mmap_store import MmapIndex
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def version_of(entry_id):
+    """
+    Returns the version number of an arXiv entry ID, e.g. 2 for '2308.12345v2' (0 without version).
+    """
+    match = VERSION_PATTERN.search(short_id(entry_id))
+    return int(match.group(0)[1:]) if match else 0
+
+
+class CorpusManifest:
+    """
+    This class is used to record what has been indexed, per paper: the
+    versioned entry_id, the updated time, the PDF hash, the index segment and
+    the metadata, together with the time of the last refresh.
+
+    The manifest is a JSON file which is replaced atomically on save, so it
+    always points at complete index segments.
+    """
+
+    def __init__(self, path):
+        """
+        Load the manifest, or start an empty one.
+        :param path: The path to the manifest file.
+        """
+        self.path = path
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self.papers = data.get("papers", {})
+        self.last_refresh = data.get("last_refresh")
+        self.pending = data.get("pending", [])
+        self.query = data.get("query")
+
+    def __len__(self):
+        return len(self.papers)
+
+    def __contains__(self, arxiv_id):
+        return strip_version(arxiv_id) in self.papers
+
+    def get(self, arxiv_id):
+        """
+        Returns the entry of a paper, looked up without version, or None.
+        """
+        return self.papers.get(strip_version(arxiv_id))
+
+    def set(self, arxiv_id, entry):
+        self.papers[strip_version(arxiv_id)] = entry
+
+    def save(self):
+        """
+        Write the manifest atomically.
+        """
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        data = {"last_refresh": self.last_refresh, "query": self.query,
+                "pending": self.pending, "papers": self.papers}
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w", encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class CorpusRefresher:
+    """
+    This class is used to keep a local corpus of papers current.
+
+    A refresh asks arXiv only for the papers updated since the last refresh,
+    and re-indexes only those whose version or PDF content changed. A paper
+    which was only updated in its metadata keeps its index segment. New
+    segments, named after the version and PDF hash, are written next to the
+    old ones, and the manifest is switched to them in one atomic write before
+    the old segments are deleted.
+    """
+
+    def __init__(self, recommender, index_dir="cache/corpus", arxiv_api=None, downloader=None,
+                 overlap=timedelta(days=1), **pipeline_options):
+        """
+        :param recommender: The SemanticSearch whose corpus index is kept current.
+        :param index_dir: The directory of the index segments and 'manifest.json'.
+        :param arxiv_api: The ArxivAPI used to ask for updates.
+        :param downloader: The PDFDownloader (one writing to 'download/' by default).
+        :param overlap: How far before the last refresh updates are asked for, since
+                        arXiv may list an update some time after its timestamp.
+        :param pipeline_options: Further arguments of the IngestPipeline, e.g. download_workers.
+        """
+        self.recommender = recommender
+        self.index_dir = index_dir
+        self.arxiv_api = arxiv_api or ArxivAPI()
+        self.downloader = downloader or PDFDownloader("download/")
+        self.overlap = overlap
+        self.pipeline_options = pipeline_options
+        self.manifest = CorpusManifest(os.path.join(index_dir, "manifest.json"))
+
+    def load_corpus(self):
+        """
+        Add every paper of the manifest to the corpus index of the recommender
+        from its index segment, without extracting or embedding anything.
+        :return: The number of papers loaded.
+        """
+        loaded = 0
+        for entry in self.manifest.papers.values():
+            try:
+                segment = MmapIndex(os.path.join(self.index_dir, entry["segment"]))
+            except (OSError, ValueError) as e:
+                logger.error(f"The index segment of {entry['entry_id']} could not be opened: {e}")
+                continue
+            self.recommender.corpus.add_document(
+                entry["entry_id"], list(segment.texts), segment.get_vectors(slice(None)),
+                encoder_id=segment.encoder_id, metadata=entry.get("metadata"))
+            loaded += 1
+        return loaded
+
+    def _content_changed(self, result, entry):
+        """
+        Check whether the PDF of a paper differs from the indexed one. The PDF
+        is fetched again, since the cached file is the one which was indexed.
+        """
+        path = self.downloader.download(PDFDownloader._url(result), fresh=True)
+        return path is None or EmbeddingCache.file_hash(path) != entry["pdf_hash"]
+
+    def refresh(self, query=None, id_list=None, max_results=None):
+        """
+        Bring the corpus up to date.
+        :param query: A dictionary of queries, as taken by ArxivAPI.combined_query, whose
+                      new and updated papers are added (defaults to the query of the last refresh).
+        :param id_list: A list of arXiv IDs to add or update.
+        :param max_results: The maximum number of results of the query.
+        :return: A report with the number of papers 'checked', the 'new', 'updated' and
+                 'metadata_only' papers, the number of 'unchanged' papers, the 'failed'
+                 papers and the report of the ingest pipeline ('pipeline', None if nothing changed).
+        """
+        started = datetime.now(timezone.utc)
+        manifest = self.manifest
+        if query is not None:
+            manifest.query = query
+        since = None
+        if manifest.last_refresh is not None:
+            since = datetime.fromisoformat(manifest.last_refresh) - self.overlap
+
+        # The tracked papers and the query are only asked for updates since the
+        # last refresh; new IDs and papers which failed before are asked for in full.
+        results = {}
+        tracked = list(manifest.papers)
+        requested = [arxiv_id for arxiv_id in id_list or [] if arxiv_id not in manifest]
+        retry = [arxiv_id for arxiv_id in manifest.pending if arxiv_id not in requested]
+        checks = []
+        if tracked and since is not None:
+            checks.append((None, tracked, since))
+        if manifest.query:
+            query_string = " AND ".join(f"{key}:{value}" for key, value in manifest.query.items())
+            checks.append((query_string, None, since))
+        if requested or retry:
+            checks.append((None, requested + retry, None))
+        for query_string, ids, check_since in checks:
+            for result in self.arxiv_api.query_updated(check_since, query=query_string, id_list=ids,
+                                                       max_results=max_results if query_string else None):
+                results.setdefault(strip_version(short_id(result.entry_id)), result)
+
+        report = {"checked": len(results), "new": [], "updated": [], "metadata_only": [],
+                  "unchanged": 0, "failed": [], "pipeline": None}
+        changed = []
+        for arxiv_id, result in results.items():
+            entry = manifest.get(arxiv_id)
+            if entry is not None and entry["entry_id"] == result.entry_id:
+                if entry["updated"] == result.updated.isoformat():
+                    report["unchanged"] += 1
+                    continue
+                if not self._content_changed(result, entry):
+                    entry["updated"] = result.updated.isoformat()
+                    entry["metadata"] = result_metadata(result)
+                    report["metadata_only"].append(result.entry_id)
+                    continue
+            changed.append(result)
+
+        stale = []
+        if changed:
+            pipeline = IngestPipeline(self.recommender, arxiv_api=self.arxiv_api, downloader=self.downloader,
+                                      index_dir=self.index_dir, **self.pipeline_options)
+            report["pipeline"] = pipeline.run(results=changed)
+            by_entry_id = {result.entry_id: result for result in changed}
+            for doc_id, document in report["pipeline"]["documents"].items():
+                result = by_entry_id[doc_id]
+                old = manifest.get(doc_id)
+                manifest.set(doc_id, {
+                    "entry_id": doc_id,
+                    "version": version_of(doc_id),
+                    "updated": result.updated.isoformat(),
+                    "pdf_hash": document["pdf_hash"],
+                    "segment": document["segment"],
+                    "chunks": document["chunks"],
+                    "metadata": result_metadata(result),
+                })
+                report["new" if old is None else "updated"].append(doc_id)
+                if old is None:
+                    continue
+                # The corpus only holds the old version if load_corpus or an earlier refresh added it.
+                if old["entry_id"] != doc_id and old["entry_id"] in self.recommender.corpus:
+                    self.recommender.remove_document(old["entry_id"])
+                if old["segment"] != document["segment"]:
+                    stale.append(old["segment"])
+            report["failed"] = report["pipeline"]["failed"]
+
+        manifest.pending = [strip_version(short_id(failure["doc_id"])) for failure in report["failed"]]
+        manifest.last_refresh = started.isoformat()
+        manifest.save()
+        # The manifest points at the new segments now, the old ones can go.
+        for segment in stale:
+            shutil.rmtree(os.path.join(self.index_dir, segment), ignore_errors=True)
+        return report
+
+
+def print_report(report):
+    """
+    Print the report of a refresh.
+    """
+    print(f"Checked {report['checked']} papers: {len(report['new'])} new, {len(report['updated'])} updated, "
+          f"{len(report['metadata_only'])} metadata only, {report['unchanged']} unchanged, "
+          f"{len(report['failed'])} failed.")
+    for doc_id in report["new"] + report["updated"]:
+        print(f"INDEXED {doc_id}")
+    for failure in report["failed"]:
+        print(f"FAILED {failure['doc_id']} ({failure['stage']}): {failure['error']}")
+
+
+if __name__ == "__main__":
+    from pdf_semantic_search import SemanticSearch
+    from encoders import get_encoder
+
+    arg_parser = argparse.ArgumentParser(description="Refresh the local corpus with new and updated arXiv papers.")
+    arg_parser.add_argument("--index-dir", default="cache/corpus", help="The directory of the segments and manifest.")
+    arg_parser.add_argument("--query", help="A query such as 'au: Author name, cat: cs.LG' whose papers are tracked.")
+    arg_parser.add_argument("--id-list", nargs="+", help="arXiv IDs to add to the corpus.")
+    arg_parser.add_argument("--max-results", type=int, default=100)
+    arg_parser.add_argument("--encoder", default="use", help="The encoder backend: 'use' or 'hashing'.")
+    arg_parser.add_argument("--dedup", action="store_true", help="Merge duplicate chunks of a paper before embedding.")
+    args = arg_parser.parse_args()
+
+    query = None
+    if args.query:
+        query = dict(part.split(": ", 1) for part in args.query.split(", "))
+    refresher = CorpusRefresher(SemanticSearch(encoder=get_encoder(args.encoder)), index_dir=args.index_dir,
+                                dedup=args.dedup)
+    refresher.load_corpus()
+    print_report(refresher.refresh(query=query, id_list=args.id_list, max_results=args.max_results))
@@ -0,0 +1,182 @@
+# Description: This file contains the EmbeddingCache class used to persist text embeddings on disk.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    This class is used to store the embeddings of PDF chunks on disk, so that
+    a paper which has been indexed before does not need to be encoded again.
+
+    Every entry is a single .npy file named '<file hash>_<params hash>.npy',
+    where the params hash covers the chunking parameters and the encoder identity.
+    """
+
+    def __init__(self, cache_dir="cache/embeddings", max_bytes=512 * 1024 * 1024):
+        """
+        Initialize the cache.
+        :param cache_dir: The directory used to store the embeddings.
+        :param max_bytes: The maximum total size of the cache in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_hash(path, block_size=1 << 20):
+        """
+        Compute the SHA-256 hash of a file's content.
+        :param path: The path to the file.
+        :param block_size: The size of the blocks read from the file.
+        :return: The hex digest of the file content.
+        """
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def make_key(file_hash, word_length, start_page, encoder_id, dedup=False):
+        """
+        Build the cache key of a PDF.
+        :param file_hash: The content hash of the PDF file.
+        :param word_length: The number of words in each chunk.
+        :param start_page: The start page used for extraction.
+        :param encoder_id: The identity of the encoder producing the embeddings.
+        :param dedup: Whether duplicate chunks were removed before embedding.
+        :return: The cache key.
+        """
+        params = {"word_length": word_length, "start_page": start_page, "encoder": encoder_id}
+        if dedup:
+            # Only added when set, so the keys of earlier entries stay valid.
+            params["dedup"] = True
+        params = json.dumps(params, sort_keys=True)
+        params_hash = hashlib.sha256(params.encode("utf-8")).hexdigest()[:16]
+        return f"{file_hash}_{params_hash}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        """
+        Load the embeddings stored under the given key.
+        :param key: The cache key.
+        :return: The embeddings, or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            embeddings = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        # Touch the file so that eviction keeps the recently used entries.
+        os.utime(path, None)
+        self.hits += 1
+        return embeddings
+
+    def put(self, key, embeddings):
+        """
+        Store the embeddings under the given key.
+        :param key: The cache key.
+        :param embeddings: The embeddings to store.
+        :return: None
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asarray(embeddings))
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            logger.error(f"An error occurred while writing the embedding cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def invalidate(self, key=None, file_hash=None):
+        """
+        Remove entries from the cache.
+        :param key: Remove the entry with this key.
+        :param file_hash: Remove all entries of the PDF with this content hash.
+        :return: The number of removed entries.
+        """
+        if key is None and file_hash is None:
+            raise ValueError("Either 'key' or 'file_hash' must be given.")
+        removed = 0
+        for _, _, path in self._entries():
+            name = os.path.basename(path)[:-len(".npy")]
+            if name == key or (file_hash is not None and name.startswith(file_hash + "_")):
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        :return: The number of removed entries.
+        """
+        entries = self._entries()
+        for _, _, path in entries:
+            os.remove(path)
+        return len(entries)
+
+    def stats(self):
+        """
+        Returns the statistics of the cache.
+        """
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,169 @@
+# Description: This file contains the text encoders used by the semantic search.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import re
+import zlib
+import hashlib
+import numpy as np
+from model_registry import get_model
+
+USE_URL = 'https://tfhub.dev/google/universal-sentence-encoder/4'
+
+
+class Encoder:
+    """
+    The interface of the text encoders.
+
+    'name' identifies the encoder and its settings. It is stored with every
+    cached or saved embedding, so vectors of different encoders are never mixed.
+    """
+
+    name = None
+    dim = None
+
+    def encode(self, texts):
+        """
+        Encode texts into vectors.
+        :param texts: A list of texts.
+        :return: A float32 array of shape (len(texts), dim).
+        """
+        raise NotImplementedError
+
+    def __call__(self, texts):
+        return self.encode(texts)
+
+
+class USEEncoder(Encoder):
+    """
+    The universal-sentence-encoder from TensorFlow Hub.
+    """
+
+    dim = 512
+
+    def __init__(self, url=USE_URL):
+        """
+        :param url: The TensorFlow Hub URL of the model.
+        """
+        self.url = url
+        # The URL alone identifies the model, which keeps existing cache entries valid.
+        self.name = url
+
+    def encode(self, texts):
+        return np.asarray(get_model(self.url)(list(texts)), dtype=np.float32)
+
+
+class HashingEncoder(Encoder):
+    """
+    A pure NumPy encoder which runs offline.
+
+    Every word is split into character n-grams, which are hashed into a large
+    sparse feature space and weighted by sublinear TF (and IDF once fit_idf has
+    been called). The sparse features are projected to a dense vector by adding
+    each weight with a fixed random sign to a fixed random one of 'dim' buckets.
+    """
+
+    WORD_PATTERN = re.compile(r'\w+')
+
+    def __init__(self, dim=512, ngram_range=(3, 5), n_features=2 ** 20, seed=0,
+                 max_cached_words=1000000):
+        """
+        :param dim: The dimension of the output vectors.
+        :param ngram_range: The minimum and maximum length of the character n-grams.
+        :param n_features: The size of the hashed feature space, a power of two.
+        :param seed: The seed of the random projection.
+        :param max_cached_words: The maximum number of words whose features are cached.
+        """
+        if n_features & (n_features - 1):
+            raise ValueError("The 'n_features' parameter must be a power of two.")
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.n_features = n_features
+        self.seed = seed
+        self.max_cached_words = max_cached_words
+        rng = np.random.default_rng(seed)
+        self.buckets = rng.integers(0, dim, n_features).astype(np.int64)
+        self.signs = rng.choice(np.array([-1.0, 1.0], dtype=np.float32), n_features)
+        self.idf = None
+        self._word_cache = {}
+
+    @property
+    def name(self):
+        name = (f"hashing-v1:dim={self.dim}:ngrams={self.ngram_range[0]}-{self.ngram_range[1]}"
+                f":features={self.n_features}:seed={self.seed}")
+        if self.idf is not None:
+            name += ":idf=" + hashlib.sha1(self.idf.tobytes()).hexdigest()[:12]
+        return name
+
+    def _word_features(self, word):
+        features = self._word_cache.get(word)
+        if features is None:
+            padded = f' {word} '
+            grams = {padded}
+            for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+                grams.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+            features = np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams),
+                                   dtype=np.int64, count=len(grams)) & (self.n_features - 1)
+            if len(self._word_cache) >= self.max_cached_words:
+                self._word_cache.clear()
+            self._word_cache[word] = features
+        return features
+
+    def _text_features(self, text):
+        words = self.WORD_PATTERN.findall(text.lower())
+        if not words:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._word_features(w) for w in words])
+
+    def _sparse(self, texts):
+        """
+        Returns the rows, features and term frequencies of the texts.
+        """
+        features = [self._text_features(t) for t in texts]
+        rows = np.repeat(np.arange(len(features)), [len(f) for f in features])
+        keys = rows * self.n_features + np.concatenate(features) if len(rows) else rows
+        keys, tf = np.unique(keys, return_counts=True)
+        return keys // self.n_features, keys % self.n_features, tf
+
+    def fit_idf(self, texts):
+        """
+        Compute the IDF weights of the hashed features from a corpus.
+        Note that this changes the name of the encoder.
+        :param texts: A list of texts.
+        :return: self
+        """
+        _, features, _ = self._sparse(texts)
+        df = np.bincount(features, minlength=self.n_features)
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def encode(self, texts):
+        texts = list(texts)
+        rows, features, tf = self._sparse(texts)
+        weights = (1 + np.log(tf)) * self.signs[features]
+        if self.idf is not None:
+            weights *= self.idf[features]
+        out = np.bincount(rows * self.dim + self.buckets[features], weights=weights,
+                          minlength=len(texts) * self.dim).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (out / norms).astype(np.float32)
+
+
+ENCODERS = {
+    'use': USEEncoder,
+    'hashing': HashingEncoder,
+}
+
+
+def get_encoder(name, **kwargs):
+    """
+    Create an encoder by its short name.
+    :param name: 'use' or 'hashing'.
+    :param kwargs: Keyword arguments of the encoder class.
+    :return: An Encoder.
+    """
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder '{name}', expected one of {sorted(ENCODERS)}.")
+    return ENCODERS[name](**kwargs)
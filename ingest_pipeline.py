@@ -0,0 +1,299 @@
+# Description: This file contains the IngestPipeline class used to index many papers without interaction.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import re
+import time
+import queue
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from arxiv_api import ArxivAPI
+from arxiv_cache import ArxivQueryCache, short_id
+from pdf_downloader import PDFDownloader
+from pdftotext import extract_page_range, iter_chunks
+from embedding_cache import EmbeddingCache
+from mmap_store import write_index
+from metadata_filter import result_metadata
+from chunk_dedup import deduplicate_chunks
+from instrumentation import span, count
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def extract_chunks(pdf_path, start_page=1, word_length=150):
+    """
+    Extract the chunks of a PDF file. This runs in the worker processes of the pipeline.
+    :param pdf_path: The path to the PDF file.
+    :param start_page: The start page number.
+    :param word_length: The number of words in each chunk.
+    :return: A tuple of the number of pages and the list of chunks.
+    """
+    import fitz
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        end_page = doc.page_count
+    texts = extract_page_range(pdf_path, start_page, end_page)
+    return len(texts), list(iter_chunks(texts, word_length, start_page))
+
+
+def segment_name(doc_id, pdf_hash=None):
+    """
+    Returns the directory name of the index segment of a paper, e.g. '2308.12345v2',
+    or '2308.12345v2-1f3a9c0e7b2d' with the PDF hash, so that a re-indexed PDF of the
+    same version gets a new segment instead of overwriting the one in use.
+    """
+    name = re.sub(r'[^\w.-]', '_', short_id(doc_id))
+    return f"{name}-{pdf_hash[:12]}" if pdf_hash else name
+
+
+class IngestPipeline:
+    """
+    This class is used to download, extract, embed and index many papers at once.
+
+    Every stage runs in its own worker threads, connected to the next stage by
+    a bounded queue, so downloading, PDF parsing (in worker processes) and
+    encoding overlap. A full queue blocks the stage in front of it, which keeps
+    the number of papers held in memory bounded. A paper which fails in any
+    stage is dropped and recorded, the other papers continue.
+    """
+
+    STAGES = ('download', 'extract', 'embed', 'index')
+
+    def __init__(self, recommender, arxiv_api=None, downloader=None, download_workers=4,
+                 extract_workers=2, embed_workers=1, queue_size=4, start_page=1,
+                 word_length=150, index_dir=None, dedup=False):
+        """
+        :param recommender: The SemanticSearch whose encoder, embedding cache and corpus index are used.
+        :param arxiv_api: The ArxivAPI used to run queries (a cached one by default).
+        :param downloader: The PDFDownloader (one writing to 'download/' by default).
+        :param download_workers: The number of concurrent downloads.
+        :param extract_workers: The number of worker processes parsing PDFs.
+        :param embed_workers: The number of threads encoding chunks.
+        :param queue_size: The maximum number of papers waiting in front of each stage.
+        :param start_page: The start page for reading the PDFs.
+        :param word_length: The number of words in each chunk.
+        :param index_dir: A directory where every paper is also written as a memory-mapped index segment (optional).
+        :param dedup: Whether to merge exact and near-duplicate chunks of a paper before embedding.
+        """
+        self.recommender = recommender
+        self.arxiv_api = arxiv_api or ArxivAPI(cache=ArxivQueryCache())
+        self.downloader = downloader or PDFDownloader("download/", max_concurrency=download_workers)
+        self.workers = {'download': download_workers, 'extract': extract_workers,
+                        'embed': embed_workers, 'index': 1}
+        self.queue_size = queue_size
+        self.start_page = start_page
+        self.word_length = word_length
+        self.index_dir = index_dir
+        self.dedup = dedup
+        self.lock = threading.Lock()
+
+    def _download(self, paper):
+        path = self.downloader.download(PDFDownloader._url(paper["result"]))
+        if path is None:
+            raise IOError("The download failed.")
+        paper["path"] = path
+        return paper
+
+    def _extract(self, paper, pool):
+        pages, chunks = pool.submit(extract_chunks, paper["path"], self.start_page,
+                                    self.word_length).result()
+        if not chunks:
+            raise ValueError("No text could be extracted.")
+        count("pages", pages)
+        count("chunks", len(chunks))
+        if self.dedup:
+            paper["dedup"] = deduplicate_chunks(chunks)
+            chunks = paper["dedup"]["chunks"]
+        paper["chunks"] = chunks
+        paper["pdf_hash"] = EmbeddingCache.file_hash(paper["path"])
+        paper["cache_key"] = EmbeddingCache.make_key(
+            paper["pdf_hash"], self.word_length, self.start_page,
+            self.recommender.encoder_id, dedup=self.dedup)
+        return paper
+
+    def _embed(self, paper):
+        paper["embeddings"] = self.recommender.embed_with_cache(paper["chunks"], cache_key=paper["cache_key"])
+        self.recommender.record_dedup(paper["doc_id"], paper.pop("dedup", None), paper["embeddings"])
+        return paper
+
+    def _index(self, paper):
+        self.recommender.corpus.add_document(paper["doc_id"], paper["chunks"], paper["embeddings"],
+                                             encoder_id=self.recommender.encoder_id,
+                                             metadata=paper.get("metadata"))
+        if self.index_dir is not None:
+            paper["segment"] = segment_name(paper["doc_id"], paper["pdf_hash"])
+            write_index(os.path.join(self.index_dir, paper["segment"]),
+                        paper["embeddings"], paper["chunks"], encoder_id=self.recommender.encoder_id)
+        return paper
+
+    def _work(self, stage, func, in_queue, out_queue):
+        """
+        The loop of a worker thread: process papers until the stop marker arrives.
+        """
+        while True:
+            paper = in_queue.get()
+            if paper is _STOP:
+                return
+            start = time.perf_counter()
+            try:
+                with span(f"pipeline.{stage}"):
+                    paper = func(paper)
+            except Exception as e:
+                logger.error(f"Paper {paper['doc_id']} failed in the {stage} stage: {e}")
+                with self.lock:
+                    self.report["failed"].append({"doc_id": paper["doc_id"], "stage": stage, "error": str(e)})
+                paper = None
+            with self.lock:
+                stats = self.report["stages"][stage]
+                stats["busy_s"] += time.perf_counter() - start
+                stats["papers"] += paper is not None
+            if paper is None:
+                continue
+            if out_queue is not None:
+                out_queue.put(paper)
+            else:
+                with self.lock:
+                    self.report["indexed"].append(paper["doc_id"])
+                    self.report["chunks"] += len(paper["chunks"])
+                    self.report["documents"][paper["doc_id"]] = {
+                        "pdf_hash": paper["pdf_hash"], "segment": paper.get("segment"),
+                        "chunks": len(paper["chunks"])}
+                    savings = self.recommender.dedup_reports.get(paper["doc_id"])
+                    if self.dedup and savings is not None:
+                        self.report["encoder_calls_saved"] += savings["encoder_calls_saved"]
+                        self.report["index_bytes_saved"] += savings["index_bytes_saved"]
+
+    def _produce(self, results, in_queue):
+        """
+        Feed the results into the first stage as they arrive from arXiv. The
+        stage threads are already running, so they work on the first papers
+        while a harvest is still fetching later pages.
+        """
+        try:
+            for result in results:
+                try:
+                    metadata = result_metadata(result)
+                except AttributeError:
+                    metadata = None
+                in_queue.put({"doc_id": result.entry_id, "result": result, "metadata": metadata})
+        except Exception as e:
+            logger.error(f"The arXiv query failed: {e}")
+            with self.lock:
+                self.report["failed"].append({"doc_id": None, "stage": "query", "error": str(e)})
+
+    def run(self, query=None, id_list=None, max_results=10, results=None, order='newest'):
+        """
+        Run the pipeline for the results of a query, an ID list or given results.
+        :param query: A dictionary of queries, as taken by ArxivAPI.combined_query.
+        :param id_list: A list of arXiv IDs.
+        :param max_results: The maximum number of results of the query.
+        :param results: An iterable of arXiv results, used instead of a query.
+        :param order: 'newest' indexes the newest max_results papers, fetched through the
+                      query cache of the ArxivAPI before the first paper is downloaded;
+                      'oldest' streams the results with ArxivAPI.harvest, oldest first and
+                      page by page, so downloading starts with the first page.
+        :return: A report with the 'indexed' doc_ids, the 'documents' (PDF hash, index
+                 segment and number of chunks per indexed doc_id), the 'failed' papers
+                 with their stage and error, the number of 'chunks', the 'encoder_calls_saved'
+                 and 'index_bytes_saved' by deduplication, the 'elapsed_s' and the
+                 busy time and papers of every stage.
+        """
+        self.report = {"indexed": [], "documents": {}, "failed": [], "chunks": 0, "encoder_calls_saved": 0,
+                       "index_bytes_saved": 0, "elapsed_s": 0.0,
+                       "stages": {stage: {"workers": self.workers[stage], "busy_s": 0.0, "papers": 0}
+                                  for stage in self.STAGES}}
+        start = time.perf_counter()
+        if results is None:
+            if order == 'newest':
+                if id_list is not None:
+                    results = self.arxiv_api.query_by_id_list(id_list, max_results=max_results)
+                else:
+                    results = self.arxiv_api.combined_query(query, max_results=max_results)
+            elif order == 'oldest':
+                query_string = None
+                if query is not None:
+                    query_string = " AND ".join(f"{key}:{value}" for key, value in query.items())
+                results = self.arxiv_api.harvest(query=query_string, id_list=id_list, max_results=max_results)
+            else:
+                raise ValueError("The 'order' parameter must be 'newest' or 'oldest'.")
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.STAGES]
+        threads = []
+        with ProcessPoolExecutor(max_workers=self.workers['extract']) as pool:
+            funcs = {'download': self._download, 'extract': lambda paper: self._extract(paper, pool),
+                     'embed': self._embed, 'index': self._index}
+            for n, stage in enumerate(self.STAGES):
+                out_queue = queues[n + 1] if n + 1 < len(queues) else None
+                threads.append([threading.Thread(target=self._work, name=f"{stage}-{i}",
+                                                 args=(stage, funcs[stage], queues[n], out_queue), daemon=True)
+                                for i in range(self.workers[stage])])
+                for thread in threads[-1]:
+                    thread.start()
+
+            self._produce(results, queues[0])
+            # Stop each stage once the stage in front of it has finished.
+            for n, stage in enumerate(self.STAGES):
+                for _ in threads[n]:
+                    queues[n].put(_STOP)
+                for thread in threads[n]:
+                    thread.join()
+
+        self.report["elapsed_s"] = time.perf_counter() - start
+        return self.report
+
+
+def print_report(report):
+    """
+    Print the report of a pipeline run.
+    """
+    print(f"Indexed {len(report['indexed'])} papers ({report['chunks']} chunks) "
+          f"in {report['elapsed_s']:.2f}s, {len(report['failed'])} failed.")
+    if report["encoder_calls_saved"]:
+        print(f"Deduplication saved {report['encoder_calls_saved']} encoder calls "
+              f"and {report['index_bytes_saved'] / 1024:.1f} KiB of index memory.")
+    print(f"{'stage':<10} {'workers':>7} {'papers':>7} {'busy s':>9} {'busy s/worker':>14}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<10} {stats['workers']:>7} {stats['papers']:>7} {stats['busy_s']:>9.2f} "
+              f"{stats['busy_s'] / stats['workers']:>14.2f}")
+    for failure in report["failed"]:
+        print(f"FAILED {failure['doc_id']} ({failure['stage']}): {failure['error']}")
+
+
+if __name__ == "__main__":
+    from pdf_semantic_search import SemanticSearch
+    from encoders import get_encoder
+
+    arg_parser = argparse.ArgumentParser(description="Download, extract, embed and index arXiv papers.")
+    source = arg_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--query", help="A query such as 'au: Author name, ti: Paper title'.")
+    source.add_argument("--id-list", nargs="+", help="arXiv IDs.")
+    arg_parser.add_argument("--max-results", type=int, default=10)
+    arg_parser.add_argument("--order", choices=["newest", "oldest"], default="newest",
+                            help="Index the newest results (cached query) or stream the oldest first.")
+    arg_parser.add_argument("--encoder", default="use", help="The encoder backend: 'use' or 'hashing'.")
+    arg_parser.add_argument("--download-workers", type=int, default=4)
+    arg_parser.add_argument("--extract-workers", type=int, default=2)
+    arg_parser.add_argument("--embed-workers", type=int, default=1)
+    arg_parser.add_argument("--queue-size", type=int, default=4)
+    arg_parser.add_argument("--index-dir", help="Write every paper as a memory-mapped index segment to this directory.")
+    arg_parser.add_argument("--dedup", action="store_true", help="Merge duplicate chunks of a paper before embedding.")
+    args = arg_parser.parse_args()
+
+    query = None
+    if args.query:
+        query = dict(part.split(": ", 1) for part in args.query.split(", "))
+    pipeline = IngestPipeline(SemanticSearch(encoder=get_encoder(args.encoder)),
+                              download_workers=args.download_workers,
+                              extract_workers=args.extract_workers,
+                              embed_workers=args.embed_workers,
+                              queue_size=args.queue_size,
+                              index_dir=args.index_dir,
+                              dedup=args.dedup)
+    print_report(pipeline.run(query=query, id_list=args.id_list, max_results=args.max_results, order=args.order))
@@ -0,0 +1,243 @@
+# Description: This file contains the named spans and counters used to profile a run.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import re
+import json
+import time
+import threading
+from functools import wraps
+
+_enabled = False
+_record_events = False
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_events = []
+_started = None
+MAX_EVENTS = 100000
+
+
+class _NullSpan:
+    """
+    The span returned while instrumentation is disabled; it does nothing.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    A timed section of code, recorded when the 'with' block exits.
+    """
+
+    __slots__ = ('name', 'attrs', 'start')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _record(self.name, self.start, time.perf_counter() - self.start, self.attrs, exc_type is not None)
+        return False
+
+
+def _record(name, start, duration, attrs, failed):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            _spans[name] = stats = {"calls": 0, "errors": 0, "total_s": 0.0, "max_s": 0.0}
+        stats["calls"] += 1
+        stats["errors"] += failed
+        stats["total_s"] += duration
+        stats["max_s"] = max(stats["max_s"], duration)
+        if _record_events and len(_events) < MAX_EVENTS:
+            event = {"type": "span", "name": name, "start_s": start - _started,
+                     "duration_s": duration, "thread": threading.current_thread().name}
+            if failed:
+                event["error"] = True
+            if attrs:
+                event["attrs"] = attrs
+            _events.append(event)
+
+
+def span(name, **attrs):
+    """
+    Time a block of code under a name:
+
+        with span("extract", path=pdf_path):
+            ...
+
+    While instrumentation is disabled a shared no-op object is returned, so
+    the cost is one function call.
+    :param name: The name of the span, e.g. the stage of the pipeline.
+    :param attrs: Attributes stored with the span in the event log.
+    :return: A context manager.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def timed(name):
+    """
+    Decorator which records every call of the function as a span.
+    :param name: The name of the span.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Add a value to a counter, e.g. the number of pages or bytes.
+    :param name: The name of the counter.
+    :param value: The value to add.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def enable(record_events=True):
+    """
+    Start recording spans and counters.
+    :param record_events: Whether to keep every span for export_jsonl, not only the totals.
+    """
+    global _enabled, _record_events, _started
+    with _lock:
+        if _started is None:
+            _started = time.perf_counter()
+        _record_events = record_events
+        _enabled = True
+
+
+def disable():
+    """
+    Stop recording. The recorded data is kept until reset is called.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Drop all recorded spans, counters and events.
+    """
+    global _started
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _events.clear()
+        _started = time.perf_counter() if _enabled else None
+
+
+def snapshot():
+    """
+    Returns a copy of the recorded totals.
+    :return: A dictionary with the 'spans' by name, the 'counters' by name and the
+             'wall_s' elapsed since recording started.
+    """
+    with _lock:
+        return {"spans": {name: dict(stats) for name, stats in _spans.items()},
+                "counters": dict(_counters),
+                "wall_s": time.perf_counter() - _started if _started is not None else 0.0}
+
+
+def export_jsonl(path):
+    """
+    Write the recorded spans, one JSON object per line, followed by the counters.
+    :param path: The path of the JSON-lines file.
+    """
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+        for name, value in counters.items():
+            f.write(json.dumps({"type": "counter", "name": name, "value": value}) + '\n')
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def prometheus_text(prefix='arxiv_spark'):
+    """
+    Format the recorded totals in the Prometheus text exposition format.
+    :param prefix: The prefix of the metric names.
+    :return: The metrics as a string.
+    """
+    data = snapshot()
+    lines = [f"# HELP {prefix}_span_seconds_total Total time spent in each span.",
+             f"# TYPE {prefix}_span_seconds_total counter"]
+    lines += [f'{prefix}_span_seconds_total{{span="{name}"}} {stats["total_s"]:.6f}'
+              for name, stats in sorted(data["spans"].items())]
+    lines += [f"# HELP {prefix}_span_calls_total Number of times each span was entered.",
+              f"# TYPE {prefix}_span_calls_total counter"]
+    lines += [f'{prefix}_span_calls_total{{span="{name}"}} {stats["calls"]}'
+              for name, stats in sorted(data["spans"].items())]
+    lines += [f"# HELP {prefix}_span_errors_total Number of spans which raised an exception.",
+              f"# TYPE {prefix}_span_errors_total counter"]
+    lines += [f'{prefix}_span_errors_total{{span="{name}"}} {stats["errors"]}'
+              for name, stats in sorted(data["spans"].items())]
+    for name, value in sorted(data["counters"].items()):
+        metric = f"{prefix}_{_metric_name(name)}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    return '\n'.join(lines) + '\n'
+
+
+def export_prometheus(path, prefix='arxiv_spark'):
+    """
+    Write the recorded totals to a file in the Prometheus text format.
+    :param path: The path of the file.
+    :param prefix: The prefix of the metric names.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text(prefix))
+
+
+def print_report():
+    """
+    Print the time spent in each span and the counters. Spans nest and may
+    run in parallel, so the shares of the wall time can add up to more than 100%.
+    """
+    data = snapshot()
+    wall = data["wall_s"] or 1e-9
+    print(f"{'stage':<24} {'calls':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'% wall':>7}")
+    for name, stats in sorted(data["spans"].items(), key=lambda item: -item[1]["total_s"]):
+        mean_ms = stats["total_s"] * 1000 / stats["calls"]
+        print(f"{name:<24} {stats['calls']:>7} {stats['total_s']:>9.3f} {mean_ms:>9.2f} "
+              f"{stats['max_s'] * 1000:>9.2f} {stats['total_s'] * 100 / wall:>6.1f}%")
+    print(f"{'wall time':<24} {'':>7} {data['wall_s']:>9.3f}")
+    if data["counters"]:
+        print()
+        for name, value in sorted(data["counters"].items()):
+            print(f"{name:<24} {value:>17,}")
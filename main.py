@@ -3,27 +3,46 @@
 # Date: 2023-09-02
 # Version: 1.0
 
+import time
+START_TIME = time.perf_counter()
+
 from arxiv_api import ArxivAPI
+from arxiv_cache import ArxivQueryCache
 from arxiv_result_parser import ArxivResultParser
-from pdftotext import PDFTextExtractor
+from pdf_downloader import PDFDownloader
 from pdf_semantic_search import SemanticSearch, get_credentials_from_user, generate_answer
 from welcome import welcome_page
+from model_registry import warm_up
+from encoders import USE_URL
+from answer_cache import AnswerCache
+from batch_qa import BatchAnswerer
+import instrumentation
 from pysparkai import PySparkAI
+import argparse
 import os
 
 class MainApplication:
     """
     This class is the main application of the project.
     """
-    def __init__(self):
+    def __init__(self, questions=None, concurrency=4, tokens_per_minute=None, dedup=False):
         """
         Constructor of the class.
-        :param: None
+        :param questions: A file with one question per line, answered in batch instead of the conversation (optional).
+        :param concurrency: The maximum number of concurrent requests in batch mode.
+        :param tokens_per_minute: The maximum number of tokens sent per minute in batch mode.
+        :param dedup: Whether to merge duplicate chunks of a paper before embedding.
         :return: None
         """
-        self.arxiv_api = ArxivAPI()
+        self.arxiv_api = ArxivAPI(cache=ArxivQueryCache())
+        self.downloader = PDFDownloader("download/")
         self.recommender = None
         self.credentials = None
+        self.answer_cache = AnswerCache()
+        self.questions = questions
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.dedup = dedup
 
     def transform_input(self, input_str):
         """
@@ -55,6 +74,9 @@ class MainApplication:
         :return: None
         """
         welcome_page()
+        print(f"Cold start: {time.perf_counter() - START_TIME:.2f}s\n")
+        # Load the encoder in the background while the user types the query.
+        warm_up(USE_URL)
         print("Would you like to query by keywords or by ID list? (type 'keywords' or 'id_list')")
         query_type = input().strip().lower()
 
@@ -70,6 +92,10 @@ class MainApplication:
             print("Invalid input. Please start over.")
             return
 
+        if len(query_result) > 1:
+            # Fetch all PDFs concurrently up front, process_result then finds them on disk.
+            self.downloader.download_many(query_result)
+
         for result in query_result:
             self.process_result(result)
 
@@ -85,11 +111,14 @@ class MainApplication:
         pdf_url = parser.get_pdf_url()
         print(f'PDF URL: {pdf_url}')
         
-        output_path = "download/" + os.path.basename(pdf_url)
+        output_path = os.path.join("download", PDFDownloader.file_name(pdf_url))
         print(f'Output path: {output_path}\n')
 
         if not os.path.exists(output_path):
-            output_path = parser.download_pdf(pdf_url, "download/")
+            output_path = self.downloader.download(pdf_url)
+            if output_path is None:
+                print(f"Failed to download {pdf_url}, skipping this paper.\n")
+                return
             print(f"Downloaded PDF file to {output_path}.\n")
         else:
             print(f"File {output_path} already exists, skipping download.\n")
@@ -106,12 +135,28 @@ class MainApplication:
         )
         self.recommender = SemanticSearch()
 
-        extractor = PDFTextExtractor(output_path)
-        texts = extractor.pdf_to_text()
-        chunks = extractor.text_to_chunks(texts)
-        self.recommender.fit(chunks)
+        self.recommender.load_recommender(output_path, dedup=self.dedup)
+
+        if self.questions:
+            self.answer_questions(ai)
+        else:
+            self.start_conversation(ai)
 
-        self.start_conversation(ai)
+    def answer_questions(self, ai):
+        """
+        Answer all questions of the questions file concurrently.
+        :param ai: the AI
+        :return: None
+        """
+        answerer = BatchAnswerer(ai, self.recommender, concurrency=self.concurrency,
+                                 tokens_per_minute=self.tokens_per_minute)
+        start = time.perf_counter()
+        count = 0
+        for i, question, answer in answerer.iter_answers(self.questions):
+            count += 1
+            print(f"[{i + 1}] Question: {question}\nAnswer: {answer}\n")
+        print(f"(answered {count} questions in {time.perf_counter() - start:.2f}s, "
+              f"{answerer.stats['retries']} retries, {answerer.stats['failures']} failures)\n")
 
     def start_conversation(self, ai):
         """
@@ -124,9 +169,33 @@ class MainApplication:
             if question.lower() in ['quit', 'exit']:
                 break
             else:
-                answer = generate_answer(question, ai, self.recommender)
+                start = time.perf_counter()
+                answer = generate_answer(question, ai, self.recommender, cache=self.answer_cache)
                 print(f"Answer: {answer}\n")
+                print(f"(answered in {time.perf_counter() - start:.2f}s)\n")
 
 if __name__ == "__main__":
-    app = MainApplication()
-    app.start()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Chat with arXiv papers using Spark AI.")
+    arg_parser.add_argument('--questions', help="answer the questions in this file (one per line) instead of chatting")
+    arg_parser.add_argument('--concurrency', type=int, default=4, help="concurrent requests in batch mode")
+    arg_parser.add_argument('--tokens-per-minute', type=int, default=None, help="token rate limit in batch mode")
+    arg_parser.add_argument('--dedup', action='store_true', help="merge duplicate chunks of a paper before embedding")
+    arg_parser.add_argument('--profile', action='store_true', help="print the time spent in each stage at exit")
+    arg_parser.add_argument('--profile-jsonl', help="write every profiled span to this JSON-lines file")
+    arg_parser.add_argument('--profile-prometheus', help="write the profile totals to this file in Prometheus text format")
+    args = arg_parser.parse_args()
+    profiling = args.profile or args.profile_jsonl or args.profile_prometheus
+    if profiling:
+        instrumentation.enable(record_events=bool(args.profile_jsonl))
+    app = MainApplication(questions=args.questions, concurrency=args.concurrency,
+                          tokens_per_minute=args.tokens_per_minute, dedup=args.dedup)
+    try:
+        app.start()
+    finally:
+        if args.profile:
+            print()
+            instrumentation.print_report()
+        if args.profile_jsonl:
+            instrumentation.export_jsonl(args.profile_jsonl)
+        if args.profile_prometheus:
+            instrumentation.export_prometheus(args.profile_prometheus)
\ No newline at end of file
@@ -0,0 +1,105 @@
+# Description: This file contains the paper metadata and filters used by the category-filtered search.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+from datetime import date, datetime
+from functools import lru_cache
+
+TAXONOMY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'category_taxonomy.json')
+
+
+@lru_cache(maxsize=None)
+def load_taxonomy(path=TAXONOMY_PATH):
+    """
+    Load the arXiv category taxonomy.
+    :param path: The path to category_taxonomy.json.
+    :return: A dictionary from each category, e.g. 'cs.LG', to its archive, e.g. 'Computer Science'.
+    """
+    with open(path, encoding='utf-8') as f:
+        taxonomy = json.load(f)
+
+    def leaves(node):
+        for key, value in node.items():
+            if isinstance(value, dict):
+                yield from leaves(value)
+            else:
+                yield key
+
+    return {category: archive for archive, node in taxonomy.items() for category in leaves(node)}
+
+
+def archive_of(category, taxonomy=None):
+    """
+    Returns the archive of a category. Categories missing from the taxonomy,
+    e.g. 'hep-th', take the archive of a known category with the same prefix.
+    :param category: The category, e.g. 'stat.ML'.
+    :param taxonomy: The mapping returned by load_taxonomy (loaded by default).
+    :return: The name of the archive, or 'Other'.
+    """
+    taxonomy = taxonomy if taxonomy is not None else load_taxonomy()
+    if category in taxonomy:
+        return taxonomy[category]
+    prefix = category.split('.')[0]
+    for known, archive in taxonomy.items():
+        if known.split('.')[0] == prefix:
+            return archive
+    return 'Other'
+
+
+def to_date(value):
+    """
+    Convert a date, datetime, ISO string or year into a date.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, int):
+        return date(value, 1, 1)
+    return datetime.fromisoformat(str(value)).date()
+
+
+def result_metadata(result):
+    """
+    Build the metadata of an indexed paper from an arXiv result or an ArxivResultParser.
+    :param result: An arxiv.Result or ArxivResultParser.
+    :return: A dictionary with the title, authors, categories, primary category and published date.
+    """
+    result = getattr(result, 'result', result)
+    return {
+        "title": result.title,
+        "authors": [author.name for author in result.authors],
+        "primary_category": result.primary_category,
+        "categories": list(result.categories),
+        "published": to_date(result.published).isoformat(),
+    }
+
+
+def normalize_filters(filters):
+    """
+    Check a filter and convert it into a hashable form.
+
+    A filter is a dictionary with any of:
+    - 'categories': a list of categories, e.g. ['cs.LG', 'stat.ML'];
+    - 'archives': a list of archives, e.g. ['Computer Science'];
+    - 'primary_only': match the categories against the primary category only;
+    - 'published_after' / 'published_before': inclusive dates, ISO strings or years.
+
+    Papers match if they are in any of the categories or archives, and were
+    published within the dates.
+    :param filters: The filter.
+    :return: A tuple of (categories, archives, primary_only, after, before).
+    """
+    unknown = set(filters) - {'categories', 'archives', 'primary_only', 'published_after', 'published_before'}
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {sorted(unknown)}.")
+    after = filters.get('published_after')
+    before = filters.get('published_before')
+    return (frozenset(filters.get('categories') or ()),
+            frozenset(filters.get('archives') or ()),
+            bool(filters.get('primary_only', False)),
+            to_date(after) if after is not None else None,
+            to_date(before) if before is not None else None)
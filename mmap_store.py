@@ -0,0 +1,287 @@
+# Description: This file contains the classes used to store an index in memory-mapped files.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from search_engine import normalize, top_k
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DTYPES = ('float32', 'float16', 'int8')
+FORMAT_VERSION = 1
+
+# An index directory holds the following files:
+#   meta.json      - count, dim, dtype, encoder identity and format version
+#   vectors.bin    - the normalized vectors, row-major, in the stored dtype
+#   quant.npy      - per-dimension (scale, offset) of the int8 variant
+#   offsets.npy    - int64 offsets of every text in texts.bin (count + 1 entries)
+#   texts.bin      - the UTF-8 encoded chunk texts, concatenated
+
+
+class MmapIndexWriter:
+    """
+    This class is used to write an index directory batch by batch, so the
+    vectors never need to be held in memory all at once.
+    """
+
+    def __init__(self, path, dim, dtype='float16', encoder_id=None, quant=None):
+        """
+        Create a new index directory. Files are written to '<path>.tmp' and
+        moved into place by close(), so readers never see a partial index.
+        :param path: The index directory.
+        :param dim: The dimension of the vectors.
+        :param dtype: 'float32', 'float16' or 'int8'.
+        :param encoder_id: The identity of the encoder producing the vectors.
+        :param quant: Per-dimension (scale, offset) arrays for int8, defaults to the
+                      [-1, 1] range of normalized vectors.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"The 'dtype' parameter must be one of {DTYPES}.")
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.dim = dim
+        self.dtype = dtype
+        self.encoder_id = encoder_id
+        if dtype == 'int8':
+            if quant is None:
+                quant = (np.full(dim, 1 / 127, np.float32), np.zeros(dim, np.float32))
+            self.scale, self.offset = (np.asarray(a, dtype=np.float32) for a in quant)
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.vectors_file = open(os.path.join(self.tmp_path, 'vectors.bin'), 'wb')
+        self.texts_file = open(os.path.join(self.tmp_path, 'texts.bin'), 'wb')
+        self.offsets = [0]
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, embeddings, texts):
+        """
+        Append a batch of vectors and their texts.
+        :param embeddings: A 2-D array of embeddings.
+        :param texts: A list of texts, one per embedding.
+        :return: None
+        """
+        if len(embeddings) != len(texts):
+            raise ValueError("The number of texts and embeddings must be equal.")
+        vectors = normalize(np.atleast_2d(embeddings))
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}.")
+        if self.dtype == 'int8':
+            codes = np.rint((vectors - self.offset) / self.scale)
+            vectors = np.clip(codes, -127, 127).astype(np.int8)
+        else:
+            vectors = vectors.astype(self.dtype)
+        self.vectors_file.write(vectors.tobytes())
+        for text in texts:
+            encoded = text.encode('utf-8')
+            self.texts_file.write(encoded)
+            self.offsets.append(self.offsets[-1] + len(encoded))
+        self.count += len(texts)
+
+    def close(self):
+        """
+        Finish the index and move it into place.
+        :return: The index path.
+        """
+        self.vectors_file.close()
+        self.texts_file.close()
+        np.save(os.path.join(self.tmp_path, 'offsets.npy'), np.asarray(self.offsets, dtype=np.int64))
+        if self.dtype == 'int8':
+            np.save(os.path.join(self.tmp_path, 'quant.npy'), np.stack([self.scale, self.offset]))
+        meta = {"format_version": FORMAT_VERSION, "count": self.count, "dim": self.dim,
+                "dtype": self.dtype, "encoder": self.encoder_id}
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(self.path):
+            old_path = self.path + '.old'
+            os.replace(self.path, old_path)
+            os.replace(self.tmp_path, self.path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """
+        Discard the partially written index.
+        """
+        self.vectors_file.close()
+        self.texts_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def write_index(path, embeddings, texts, dtype='float16', encoder_id=None):
+    """
+    Write embeddings and texts to an index directory. For int8, the per-dimension
+    scale and offset are fitted to the range of the given embeddings.
+    :param path: The index directory.
+    :param embeddings: A 2-D array of embeddings.
+    :param texts: A list of texts, one per embedding.
+    :param dtype: 'float32', 'float16' or 'int8'.
+    :param encoder_id: The identity of the encoder producing the vectors.
+    :return: The index path.
+    """
+    vectors = normalize(np.atleast_2d(embeddings))
+    quant = None
+    if dtype == 'int8':
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        offset = (high + low) / 2
+        scale = np.maximum((high - low) / 254, 1e-8)
+        quant = (scale, offset)
+    with MmapIndexWriter(path, vectors.shape[1], dtype=dtype,
+                         encoder_id=encoder_id, quant=quant) as writer:
+        writer.append(vectors, texts)
+    return path
+
+
+class MmapTexts:
+    """
+    This class is a read-only sequence of the texts of an index, decoded on access.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return bytes(self.blob[start:end]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class MmapVectors:
+    """
+    This class is a read-only view of the vectors of an index as float32, so
+    int8 codes are dequantized on access and never handed out as they are.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def shape(self):
+        return self.index.vectors.shape
+
+    def __getitem__(self, rows):
+        return self.index.get_vectors(rows)
+
+    def __array__(self, dtype=None, copy=None):
+        vectors = self.index.get_vectors(slice(None))
+        return vectors if dtype is None else vectors.astype(dtype)
+
+
+class MmapIndex:
+    """
+    This class is used to open an index directory without reading it into memory.
+
+    The vectors and texts are memory-mapped read-only, so opening is near-instant
+    and worker processes opening the same index share the pages through the OS
+    page cache. Search scans the vectors block by block, so only one block is
+    converted to float32 at a time.
+    """
+
+    def __init__(self, path, block_size=65536):
+        """
+        Open an index directory.
+        :param path: The index directory.
+        :param block_size: The number of rows scored at once during search.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format version: {self.meta.get('format_version')}.")
+        self.path = path
+        self.block_size = block_size
+        self.dtype = self.meta['dtype']
+        self.encoder_id = self.meta['encoder']
+        count, dim = self.meta['count'], self.meta['dim']
+        if count:
+            self.vectors = np.memmap(os.path.join(path, 'vectors.bin'), dtype=self.dtype,
+                                     mode='r', shape=(count, dim))
+        else:
+            self.vectors = np.zeros((0, dim), dtype=self.dtype)
+        if self.dtype == 'int8':
+            self.scale, self.offset = np.load(os.path.join(path, 'quant.npy'))
+        offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        blob_path = os.path.join(path, 'texts.bin')
+        blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) else b''
+        self.texts = MmapTexts(offsets, blob)
+        self.float_vectors = MmapVectors(self)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def get_vectors(self, rows):
+        """
+        Returns the float32 vectors of the given rows.
+        """
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.dtype == 'int8':
+            vectors = vectors * self.scale + self.offset
+        return vectors
+
+    def search_batch(self, queries, k=5):
+        """
+        Search the k nearest vectors of many queries by cosine similarity.
+        :param queries: A 2-D array of query embeddings.
+        :param k: The number of results per query.
+        :return: A tuple of (scores, indices), both of shape (n_queries, k), best first.
+        """
+        queries = normalize(np.atleast_2d(queries))
+        if self.dtype == 'int8':
+            # q.(c * scale + offset) = (q * scale).c + q.offset
+            weights, bias = queries * self.scale, queries @ self.offset
+        else:
+            weights, bias = queries, 0.0
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.vectors[start:start + self.block_size], dtype=np.float32)
+            scores = weights @ block.T
+            block_scores, block_ids = top_k(scores, k)
+            best_scores = np.hstack([best_scores, block_scores])
+            best_ids = np.hstack([best_ids, block_ids + start])
+            best_scores, order = top_k(best_scores, k)
+            best_ids = np.take_along_axis(best_ids, order, axis=1)
+        if self.dtype == 'int8':
+            best_scores = best_scores + bias[:, None]
+        return best_scores, best_ids
+
+    def search(self, query, k=5):
+        """
+        Search the k nearest vectors of one query.
+        :param query: A query embedding.
+        :param k: The number of results.
+        :return: A tuple of (scores, indices), best first.
+        """
+        scores, indices = self.search_batch(np.reshape(query, (1, -1)), k)
+        return scores[0], indices[0]
@@ -0,0 +1,98 @@
+# Description: This file contains the model registry used to load every encoder once per process.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import time
+import logging
+import threading
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_models = {}
+_loaders = {}
+_locks = {}
+_registry_lock = threading.Lock()
+load_times = {}
+
+
+def load_hub_model(url):
+    """
+    Load a model from TensorFlow Hub. TensorFlow is only imported here, so
+    modules using the registry start without paying for the TensorFlow import.
+    :param url: The URL of the model.
+    :return: The loaded model.
+    """
+    import tensorflow_hub as hub
+    return hub.load(url)
+
+
+def register_loader(name, loader):
+    """
+    Register the function used to load a model.
+    :param name: The name of the model.
+    :param loader: A function without arguments returning the model.
+    :return: None
+    """
+    with _registry_lock:
+        _loaders[name] = loader
+
+
+def _lock_for(name):
+    with _registry_lock:
+        return _locks.setdefault(name, threading.Lock())
+
+
+def get_model(name):
+    """
+    Returns the model with the given name, loading it on first use.
+    Concurrent callers wait for the same load instead of loading the model twice.
+    Names without a registered loader are loaded from TensorFlow Hub.
+    :param name: The name of the model.
+    :return: The loaded model.
+    """
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _lock_for(name):
+        if name not in _models:
+            loader = _loaders.get(name) or (lambda: load_hub_model(name))
+            start = time.perf_counter()
+            _models[name] = loader()
+            load_times[name] = time.perf_counter() - start
+            logger.info(f"Loaded model '{name}' in {load_times[name]:.2f}s.")
+        return _models[name]
+
+
+def is_loaded(name):
+    """
+    Returns whether the model with the given name has been loaded.
+    """
+    return name in _models
+
+
+def warm_up(name):
+    """
+    Load a model in a background thread, e.g. while the user is typing the query.
+    :param name: The name of the model.
+    :return: The started thread.
+    """
+    def load():
+        try:
+            get_model(name)
+        except Exception as e:
+            logger.error(f"An error occurred while warming up the model '{name}': {e}")
+
+    thread = threading.Thread(target=load, name=f"warm-up {name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def unload(name):
+    """
+    Drop a loaded model, so the next get_model call loads it again.
+    """
+    with _lock_for(name):
+        _models.pop(name, None)
@@ -0,0 +1,294 @@
+# Description: This file contains the PDFDownloader class used to download many PDF files concurrently.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from instrumentation import span, count
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class HTTPStatusError(IOError):
+    """
+    An HTTP error response. Client errors other than 408 (Request Timeout) and
+    429 (Too Many Requests) are permanent and not retried.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.permanent = 400 <= status < 500 and status not in (408, 429)
+
+
+class PDFDownloader:
+    """
+    This class is used to download the PDF files of many arXiv results.
+
+    - Every worker thread keeps one keep-alive connection per host, so
+      consecutive downloads from arxiv.org reuse the same connection.
+    - A semaphore limits the number of concurrent requests.
+    - Interrupted downloads are kept as '.part' files and resumed with
+      HTTP Range requests.
+    - Finished files are stored once in a content-addressed cache
+      ('<cache_dir>/<sha256>.pdf') and linked to the output path, so
+      repeated runs do not touch the network.
+    """
+
+    def __init__(self, output_path="download/", cache_dir="cache/pdf", max_concurrency=4,
+                 timeout=60, retries=3, block_size=1 << 16):
+        """
+        Initialize the downloader.
+        :param output_path: The directory where the PDF files are saved.
+        :param cache_dir: The directory of the content-addressed cache.
+        :param max_concurrency: The maximum number of concurrent requests.
+        :param timeout: The socket timeout in seconds.
+        :param retries: The number of attempts for each file.
+        :param block_size: The size of the blocks read from the response.
+        """
+        self.output_path = output_path
+        self.cache_dir = cache_dir
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.block_size = block_size
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.stats = {"cache_hits": 0, "downloads": 0, "resumed": 0,
+                      "bytes_downloaded": 0, "failures": 0}
+        os.makedirs(output_path, exist_ok=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_index(self):
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    @staticmethod
+    def file_name(url):
+        """
+        Returns the file name used for a PDF URL, the same as ArxivResultParser.download_pdf.
+        """
+        return url.split('/')[-1] + '.pdf'
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, digest + ".pdf")
+
+    def cached_path(self, url):
+        """
+        Returns the cached file of a URL, or None if it has not been downloaded.
+        """
+        with self.lock:
+            digest = self.index.get(url)
+        if digest is not None and os.path.exists(self._blob_path(digest)):
+            return self._blob_path(digest)
+        return None
+
+    def _connection(self, scheme, netloc):
+        """
+        Returns the keep-alive connection of this thread to the given host.
+        """
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+        key = (scheme, netloc)
+        if key not in connections:
+            cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connections[key] = cls(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def _url_lock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def _close_connections(self):
+        for connection in getattr(self.local, "connections", {}).values():
+            connection.close()
+        self.local.connections = {}
+
+    def _drop_connection(self, scheme, netloc):
+        connection = getattr(self.local, "connections", {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _fetch(self, url, part_path, max_redirects=5):
+        """
+        Download a URL into a '.part' file, resuming it if it exists.
+        """
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            path = parts.path + ("?" + parts.query if parts.query else "")
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"User-Agent": "PDF-SparkCHAT", "Connection": "keep-alive"}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                # The server may have closed the idle connection, reconnect once.
+                self._drop_connection(parts.scheme, parts.netloc)
+                connection = self._connection(parts.scheme, parts.netloc)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            if response.status == 416:
+                # The part file already holds the whole body.
+                response.read()
+                return
+            if response.status == 206 and offset:
+                mode = "ab"
+                self._count("resumed")
+            elif response.status == 200:
+                mode = "wb"
+            else:
+                response.read()
+                raise HTTPStatusError(response.status, f"HTTP {response.status} {response.reason} for {url}")
+
+            with open(part_path, mode) as f:
+                for block in iter(lambda: response.read1(self.block_size), b""):
+                    f.write(block)
+                    self._count("bytes_downloaded", len(block))
+                    count("download.bytes", len(block))
+            if response.length:
+                raise http.client.IncompleteRead(b"", response.length)
+            # Mark the response as consumed so the connection can be reused.
+            response.close()
+            return
+        raise IOError(f"Too many redirects for {url}")
+
+    def _publish(self, blob_path, url):
+        """
+        Link or copy the cached file to the output path atomically.
+        """
+        file_path = os.path.join(self.output_path, self.file_name(url))
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.output_path)
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            shutil.copyfile(blob_path, tmp_path)
+        os.replace(tmp_path, file_path)
+        return file_path
+
+    def download(self, url, fresh=False):
+        """
+        Download a PDF file, serving it from the cache if possible.
+        :param url: The URL of the PDF file.
+        :param fresh: Whether to fetch the file again even if it is cached, e.g. to
+                      detect a file replaced on the server. The cache is updated.
+        :return: The path to the downloaded PDF file, or None on failure.
+        """
+        with self._url_lock(url):
+            return self._download(url, fresh)
+
+    def _download(self, url, fresh=False):
+        blob_path = None if fresh else self.cached_path(url)
+        if blob_path is not None:
+            self._count("cache_hits")
+            count("download.cache_hits")
+            return self._publish(blob_path, url)
+
+        part_path = os.path.join(self.cache_dir,
+                                 hashlib.sha256(url.encode("utf-8")).hexdigest() + ".part")
+        if fresh and os.path.exists(part_path):
+            # A leftover part may belong to the old file, so it must not be resumed.
+            os.remove(part_path)
+        error = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.semaphore, span("download"):
+                    self._fetch(url, part_path)
+                error = None
+                break
+            except HTTPStatusError as e:
+                # The response was read in full, so the connection stays usable.
+                error = e
+                logger.warning(f"Attempt {attempt} to download {url} failed: {e}")
+                if e.permanent:
+                    break
+            except Exception as e:
+                error = e
+                self._close_connections()
+                logger.warning(f"Attempt {attempt} to download {url} failed: {e}")
+        if error is not None:
+            self._count("failures")
+            logger.error(f"An error occurred while downloading the PDF: {url}")
+            return None
+
+        sha = hashlib.sha256()
+        with open(part_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        blob_path = self._blob_path(digest)
+        os.replace(part_path, blob_path)
+        with self.lock:
+            self.index[url] = digest
+            self._save_index()
+        self._count("downloads")
+        return self._publish(blob_path, url)
+
+    def iter_download(self, results):
+        """
+        Download the PDF files of many results concurrently.
+        :param results: A list of arXiv results, ArxivResultParser objects or PDF URLs.
+        :return: A generator of (result, file_path) tuples in order of completion.
+                 file_path is None if the download failed.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(self.download, self._url(result)): result
+                       for result in results}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def download_many(self, results):
+        """
+        Download the PDF files of many results concurrently.
+        :param results: A list of arXiv results, ArxivResultParser objects or PDF URLs.
+        :return: A list of file paths in the order of the results (None for failures).
+        """
+        results = list(results)
+        paths = dict((id(result), path) for result, path in self.iter_download(results))
+        return [paths[id(result)] for result in results]
+
+    @staticmethod
+    def _url(result):
+        if isinstance(result, str):
+            return result
+        if hasattr(result, "get_pdf_url"):
+            return result.get_pdf_url()
+        return result.pdf_url
@@ -4,9 +4,19 @@
 # Version: 1.0
 
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
-import tensorflow_hub as hub
-from pdftotext import PDFTextExtractor
+from itertools import islice
+from pdftotext import PDFTextExtractor, iter_chunks
+from encoders import USEEncoder
+from embedding_cache import EmbeddingCache
+from text_cache import PageTextCache
+from corpus_index import CorpusIndex
+from search_engine import ExactSearchEngine, normalize
+from bm25_index import BM25Index, reciprocal_rank_fusion, linear_fusion
+from ann_index import IVFIndex
+from mmap_store import MmapIndex, MmapIndexWriter, write_index
+from chunk_dedup import deduplicate_chunks, dedup_savings
+from context_packer import pack_context, estimate_tokens, estimate_answer_tokens
+from instrumentation import span, count, timed, is_enabled
 import os
 
 recommender = None
@@ -21,45 +31,194 @@ class SemanticSearch:
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
-            cls._instance = super().__new__(cls, *args, **kwargs)
+            cls._instance = super().__new__(cls)
         return cls._instance
 
-    def __init__(self):
-        self.use = hub.load(
-            'https://tfhub.dev/google/universal-sentence-encoder/4')
+    def __init__(self, cache=None, encoder=None, text_cache=None):
+        """
+        :param cache: EmbeddingCache used to store the embeddings (optional).
+        :param encoder: Encoder used to embed the texts, the universal-sentence-encoder by default.
+        :param text_cache: PageTextCache used to store the extracted text of the PDF pages (optional).
+        """
+        # __new__ returns the singleton, so __init__ runs on every SemanticSearch() call.
+        # Only the first call initializes the state, later calls keep the fitted data.
+        if getattr(self, '_initialized', False):
+            if cache is not None:
+                self.cache = cache
+            if text_cache is not None:
+                self.text_cache = text_cache
+            if encoder is not None and encoder.name != self.encoder_id:
+                # Vectors of different encoders must not be mixed.
+                self.encoder = encoder
+                self.corpus = CorpusIndex()
+                self.fitted = False
+                # Cached answers and their question embeddings belong to the old encoder.
+                self.index_version += 1
+            return
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.text_cache = text_cache if text_cache is not None else PageTextCache()
+        self.encoder = encoder if encoder is not None else USEEncoder()
+        self.corpus = CorpusIndex()
         self.fitted = False
+        self.index_version = 0
+        # What removing duplicate chunks saved, per PDF path or doc_id.
+        self.dedup_reports = {}
+        self._initialized = True
+
+    @property
+    def encoder_id(self):
+        """
+        The identity of the encoder, recorded with cached and saved embeddings.
+        """
+        return self.encoder.name
+
+    def encode(self, texts):
+        """
+        Encode texts with the encoder.
 
-    def fit(self, data, batch=1000, n_neighbors=5):
+        :param texts: List of texts.
+        :return: The embeddings of the texts.
+        """
+        with span("embed"):
+            embeddings = self.encoder.encode(texts)
+        count("embeddings", len(texts))
+        return embeddings
+
+    def fit(self, data, batch=1000, n_neighbors=5, cache_key=None, index='exact', index_params=None):
         """
         Fit the model with the given data.
 
         :param data: List of text data.
         :param batch: Batch size for processing.
-        :param n_neighbors: Number of neighbors to use for NearestNeighbors.
+        :param n_neighbors: Default number of neighbors returned by search.
+        :param cache_key: Key of the embedding cache entry for the data (optional).
+        :param index: 'exact' for exact search or 'ivf' for the approximate IVFIndex.
+        :param index_params: Keyword arguments of the IVFIndex, e.g. nprobe and pq_subvectors.
         """
         self.data = data
-        self.embeddings = self.get_text_embedding(data, batch=batch)
-        n_neighbors = min(n_neighbors, len(self.embeddings))
-        self.nn = NearestNeighbors(n_neighbors=n_neighbors)
-        self.nn.fit(self.embeddings)
+        self.embeddings = self.embed_with_cache(data, batch=batch, cache_key=cache_key)
+        self.n_neighbors = n_neighbors
+        with span("index.fit", index=index):
+            if index == 'exact':
+                self.engine = ExactSearchEngine(self.embeddings, metric='cosine')
+            elif index == 'ivf':
+                self.engine = IVFIndex(**(index_params or {})).fit(self.embeddings)
+            else:
+                raise ValueError("The 'index' parameter must be 'exact' or 'ivf'.")
+        self.lexical = None
+        self.index_version += 1
         self.fitted = True
 
-    def search(self, text, return_data=True):
+    @timed("search")
+    def search(self, text, return_data=True, k=None, mode='dense', candidates=100,
+               fusion='rrf', alpha=0.5):
         """
         Search the fitted data for the nearest neighbors of the given text.
 
         :param text: Text to search for.
         :param return_data: Whether to return the data or just the indices.
+        :param k: Number of neighbors (defaults to n_neighbors given to fit).
+        :param mode: 'dense' for embedding search, 'lexical' for BM25 search, or 'hybrid'
+                     to re-score the BM25 candidates with their embeddings.
+        :param candidates: Number of BM25 candidates re-scored in hybrid mode.
+        :param fusion: How hybrid mode ranks the candidates: 'rrf' (reciprocal rank fusion),
+                       'linear' (weighted sum of normalized scores) or 'dense' (dense scores only).
+        :param alpha: Weight of the dense scores for the 'linear' fusion.
         :return: List of nearest neighbors or their indices.
         """
-        inp_emb = self.use([text])
-        neighbors = self.nn.kneighbors(inp_emb, return_distance=False)[0]
+        k = k or self.n_neighbors
+        if mode == 'dense':
+            inp_emb = self.encode([text])
+            neighbors = self.engine.search(np.asarray(inp_emb)[0], k=k)[1]
+            neighbors = neighbors[neighbors >= 0]
+        elif mode == 'lexical':
+            neighbors = self.lexical_index().search(text, n=k)[1]
+        elif mode == 'hybrid':
+            neighbors = self._hybrid_search(text, k, candidates, fusion, alpha)
+        else:
+            raise ValueError("The 'mode' parameter must be 'dense', 'lexical' or 'hybrid'.")
 
         if return_data:
             return [self.data[i] for i in neighbors]
         else:
             return neighbors
 
+    @timed("search")
+    def search_embedding(self, embedding, k=None):
+        """
+        Search the fitted data for the nearest neighbors of an already encoded text.
+
+        :param embedding: Embedding of the text.
+        :param k: Number of neighbors (defaults to n_neighbors given to fit).
+        :return: Indices of the nearest neighbors.
+        """
+        neighbors = self.engine.search(np.asarray(embedding), k=k or self.n_neighbors)[1]
+        return neighbors[neighbors >= 0]
+
+    def lexical_index(self):
+        """
+        Returns the BM25 index of the fitted data, building it on first use.
+        """
+        if self.lexical is None:
+            self.lexical = BM25Index(self.data)
+        return self.lexical
+
+    def _candidate_vectors(self, rows):
+        if hasattr(self.engine, 'get_vectors'):
+            return self.engine.get_vectors(rows)
+        return normalize(np.asarray(self.embeddings[rows]))
+
+    def _hybrid_search(self, text, k, candidates, fusion, alpha):
+        """
+        Re-score the BM25 candidates of the text with their embeddings. When
+        fewer than k chunks contain a query term, the best dense results fill
+        the candidates up to k; without any BM25 candidate, it is a dense search.
+        """
+        lexical_scores, lexical_rows = self.lexical_index().search(text, n=candidates)
+        query = normalize(self.encode([text]))[0]
+        if len(lexical_rows) == 0:
+            neighbors = self.engine.search(query, k=k)[1]
+            return neighbors[neighbors >= 0]
+        rows = lexical_rows
+        if len(rows) < k:
+            dense_rows = self.engine.search(query, k=k + len(rows))[1]
+            extra = dense_rows[(dense_rows >= 0) & ~np.isin(dense_rows, rows)][:k - len(rows)]
+            # The dense candidates contain no query term, so their lexical score is 0.
+            rows = np.concatenate([rows, extra]).astype(np.int64)
+            lexical_scores = np.concatenate([lexical_scores, np.zeros(len(extra), dtype=np.float32)])
+        dense_scores = self._candidate_vectors(rows) @ query
+        if fusion == 'rrf':
+            dense_ranking = rows[np.argsort(-dense_scores, kind='stable')]
+            neighbors = reciprocal_rank_fusion([lexical_rows, dense_ranking])[1]
+        elif fusion == 'linear':
+            fused = linear_fusion(lexical_scores, dense_scores, alpha=alpha)
+            neighbors = rows[np.argsort(-fused, kind='stable')]
+        elif fusion == 'dense':
+            neighbors = rows[np.argsort(-dense_scores, kind='stable')]
+        else:
+            raise ValueError("The 'fusion' parameter must be 'rrf', 'linear' or 'dense'.")
+        return neighbors[:k]
+
+    @timed("search")
+    def search_batch(self, texts, return_data=True, k=None, batch=1000):
+        """
+        Search the fitted data for the nearest neighbors of many texts at once.
+        All texts are encoded together and scored with a single matrix multiply.
+
+        :param texts: List of texts to search for.
+        :param return_data: Whether to return the data or just the indices.
+        :param k: Number of neighbors per text (defaults to n_neighbors given to fit).
+        :param batch: Batch size for encoding the texts.
+        :return: List with the nearest neighbors or their indices for every text.
+        """
+        inp_embs = self.get_text_embedding(texts, batch=batch)
+        neighbors = self.engine.search_batch(inp_embs, k=k or self.n_neighbors)[1]
+
+        if return_data:
+            return [[self.data[i] for i in row if i >= 0] for row in neighbors]
+        else:
+            return neighbors
+
     def get_text_embedding(self, texts, batch=1000):
         """
         Get the text embeddings for the given texts.
@@ -68,24 +227,208 @@ class SemanticSearch:
         :param batch: Batch size for processing.
         :return: List of text embeddings.
         """
-        embeddings = np.vstack([self.use(texts[i: i + batch])
+        embeddings = np.vstack([self.encode(texts[i: i + batch])
                                for i in range(0, len(texts), batch)])
         return embeddings
 
-    def load_recommender(self, path, start_page=1):
+    def iter_text_embeddings(self, texts, batch=256):
+        """
+        Get the text embeddings of an iterable of texts in fixed-size batches.
+        Only one batch of texts is held at a time.
+
+        :param texts: Iterable of texts.
+        :param batch: Batch size for processing.
+        :return: Generator of (batch of texts, batch of embeddings) tuples.
+        """
+        texts = iter(texts)
+        while True:
+            batch_texts = list(islice(texts, batch))
+            if not batch_texts:
+                return
+            yield batch_texts, self.encode(batch_texts)
+
+    def build_index(self, path, index_path, start_page=1, word_length=150, overlap=0,
+                    batch=256, dtype='float16'):
+        """
+        Stream a PDF into a memory-mapped index and open it: pages are chunked as
+        they are extracted and embedded in fixed-size batches, so peak memory
+        depends on the batch size rather than the size of the document.
+
+        :param path: Path to the PDF.
+        :param index_path: Path of the index directory.
+        :param start_page: Start page for reading the PDF.
+        :param word_length: Number of words in each chunk.
+        :param overlap: Number of words shared by consecutive chunks.
+        :param batch: Batch size for processing.
+        :param dtype: Storage type of the vectors: 'float32', 'float16' or 'int8'.
+        :return: Number of chunks indexed.
+        """
+        extractor = PDFTextExtractor(path, cache=self.text_cache)
+        chunks = iter_chunks(extractor.iter_pages(start_page=start_page),
+                             word_length=word_length, start_page=start_page, overlap=overlap)
+        writer = None
+        try:
+            for batch_chunks, embeddings in self.iter_text_embeddings(chunks, batch=batch):
+                if writer is None:
+                    writer = MmapIndexWriter(index_path, embeddings.shape[1], dtype=dtype,
+                                             encoder_id=self.encoder_id)
+                writer.append(embeddings, batch_chunks)
+        except Exception:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is None:
+            raise ValueError(f"No text could be extracted from '{path}'.")
+        writer.close()
+        self.open_index(index_path)
+        return writer.count
+
+    def save_index(self, path, dtype='float16'):
+        """
+        Save the fitted embeddings and chunks as a memory-mapped index directory.
+
+        :param path: Path of the index directory.
+        :param dtype: Storage type of the vectors: 'float32', 'float16' or 'int8'.
+        :return: Path of the index directory.
+        """
+        if not self.fitted:
+            raise ValueError("The model has not been fitted.")
+        return write_index(path, self.embeddings, self.data, dtype=dtype, encoder_id=self.encoder_id)
+
+    def open_index(self, path, n_neighbors=5):
+        """
+        Open a memory-mapped index directory written by save_index.
+        The vectors and chunks are not read into memory.
+
+        :param path: Path of the index directory.
+        :param n_neighbors: Default number of neighbors returned by search.
+        """
+        index = MmapIndex(path)
+        if index.encoder_id != self.encoder_id:
+            raise ValueError(
+                f"The index was built with encoder '{index.encoder_id}', not '{self.encoder_id}'.")
+        self.data = index.texts
+        # Dequantized on access, so int8 codes are never read as vectors.
+        self.embeddings = index.float_vectors
+        self.n_neighbors = n_neighbors
+        self.engine = index
+        self.lexical = None
+        self.index_version += 1
+        self.fitted = True
+
+    def embed_with_cache(self, data, batch=1000, cache_key=None):
+        """
+        Get the text embeddings for the given texts, using the embedding cache when a key is given.
+
+        :param data: List of text data.
+        :param batch: Batch size for processing.
+        :param cache_key: Key of the embedding cache entry for the data (optional).
+        :return: The text embeddings.
+        """
+        embeddings = None
+        if cache_key is not None:
+            embeddings = self.cache.get(cache_key)
+            if embeddings is not None and len(embeddings) != len(data):
+                self.cache.invalidate(key=cache_key)
+                embeddings = None
+        if embeddings is None:
+            embeddings = self.get_text_embedding(data, batch=batch)
+            if cache_key is not None:
+                self.cache.put(cache_key, embeddings)
+        return embeddings
+
+    def _load_chunks(self, path, start_page, word_length, dedup=False):
+        """
+        Extract the chunks of the given PDF and build their embedding cache key.
+
+        :param path: Path to the PDF.
+        :param start_page: Start page for reading the PDF.
+        :param word_length: Number of words in each chunk.
+        :param dedup: Whether to merge exact and near-duplicate chunks before embedding.
+        :return: Tuple of the chunks, the cache key and the deduplication report (None without dedup).
+        """
+        extractor = PDFTextExtractor(path, cache=self.text_cache)
+        texts = extractor.pdf_to_text(start_page=start_page)
+        chunks = extractor.text_to_chunks(
+            texts, word_length=word_length, start_page=start_page)
+        report = None
+        if dedup:
+            with span("dedup"):
+                report = deduplicate_chunks(chunks)
+            chunks = report["chunks"]
+        cache_key = EmbeddingCache.make_key(
+            self.text_cache.file_hash(path), word_length, start_page, self.encoder_id, dedup=dedup)
+        return chunks, cache_key, report
+
+    def record_dedup(self, name, report, embeddings):
+        """
+        Record the encoder calls and index memory saved by deduplication.
+        """
+        if report is None:
+            return
+        savings = self.dedup_reports[name] = dedup_savings(report, embeddings)
+        count("dedup.encoder_calls_saved", savings["encoder_calls_saved"])
+        count("dedup.index_bytes_saved", savings["index_bytes_saved"])
+
+    def load_recommender(self, path, start_page=1, word_length=150, dedup=False):
         """
         Load the recommender with data from the given PDF path.
+        The embeddings are served from the embedding cache when the same PDF
+        has already been loaded with the same parameters.
 
         :param path: Path to the PDF.
         :param start_page: Start page for reading the PDF.
+        :param word_length: Number of words in each chunk.
+        :param dedup: Whether to merge duplicate chunks, e.g. repeated headers, before embedding.
+                      The savings are recorded in dedup_reports[path].
         :return: Message indicating the status of the loading process.
         """
-        extractor = PDFTextExtractor(path)
-        texts = extractor.pdf_to_text(start_page=start_page)
-        chunks = extractor.text_to_chunks(texts, start_page=start_page)
-        self.fit(chunks)
+        chunks, cache_key, report = self._load_chunks(path, start_page, word_length, dedup)
+        self.fit(chunks, cache_key=cache_key)
+        self.record_dedup(path, report, self.embeddings)
         return 'Corpus Loaded.'
 
+    def add_document(self, doc_id, path, start_page=1, word_length=150, metadata=None, dedup=False):
+        """
+        Add a PDF to the multi-document corpus index without touching the other papers.
+
+        :param doc_id: ID of the paper, e.g. the arXiv entry_id.
+        :param path: Path to the PDF.
+        :param start_page: Start page for reading the PDF.
+        :param word_length: Number of words in each chunk.
+        :param metadata: Metadata of the paper used by filtered search, see result_metadata (optional).
+        :param dedup: Whether to merge duplicate chunks before embedding.
+                      The savings are recorded in dedup_reports[doc_id].
+        :return: Number of chunks added.
+        """
+        chunks, cache_key, report = self._load_chunks(path, start_page, word_length, dedup)
+        embeddings = self.embed_with_cache(chunks, cache_key=cache_key)
+        self.corpus.add_document(doc_id, chunks, embeddings, encoder_id=self.encoder_id, metadata=metadata)
+        self.record_dedup(doc_id, report, embeddings)
+        return len(chunks)
+
+    def remove_document(self, doc_id):
+        """
+        Remove a paper from the multi-document corpus index.
+
+        :param doc_id: ID of the paper.
+        """
+        self.corpus.remove_document(doc_id)
+
+    @timed("search")
+    def search_corpus(self, text, k=5, filters=None):
+        """
+        Search all papers in the corpus index for the nearest neighbors of the given text.
+
+        :param text: Text to search for.
+        :param k: Number of results.
+        :param filters: Only search papers matching the filter, e.g.
+                        {"categories": ["cs.LG", "stat.ML"], "published_after": "2023-01-01"}.
+        :return: List of results with the chunk text, doc_id, page and score.
+        """
+        inp_emb = self.encode([text])
+        return self.corpus.search(np.asarray(inp_emb)[0], k=k, filters=filters)
+
 
 def get_credentials_from_user():
     """
@@ -104,30 +447,59 @@ def get_credentials_from_user():
     return APP_ID, API_KEY, API_SECRET, SPARK_URL, DOMAIN
 
 
-def generate_prompt(question, topn_chunks):
+PROMPT_INSTRUCTIONS = (
+    "Instructions: Compose a comprehensive reply to the query using the search results given. "
+    "Cite each reference using [ Page Number] notation (every result has this number at the beginning). "
+    "Citation should be done at the end of each sentence. If the search results mention multiple subjects "
+    "with the same name, create separate answers for each. Only include information found in the results and "
+    "don't add any additional information. Make sure the answer is correct and don't output false content. "
+    "If the text does not relate to the query, simply state 'Text Not Found in PDF'. Ignore outlier "
+    "search results which has nothing to do with the question. Only answer what is asked. The "
+    "answer should be short and concise. Answer step-by-step. "
+)
+
+
+def generate_prompt(question, topn_chunks, token_budget=None, chunk_ids=None):
     """
     Generate a prompt for the AI to generate an answer.
 
     :param question: The query.
     :param topn_chunks: Top n chunks from the search.
+    :param token_budget: Token budget of the search results, see pack_context (None to include all chunks).
+    :param chunk_ids: Indices of the chunks in the fitted data, used to merge adjacent chunks (optional).
     :return: Generated prompt.
     """
-    prompt = 'search results:\n\n'
-    for c in topn_chunks:
-        prompt += c + '\n\n'
+    if token_budget is not None:
+        topn_chunks = pack_context(topn_chunks, token_budget, chunk_ids=chunk_ids)["chunks"]
+    parts = ['search results:\n\n']
+    parts.extend(c + '\n\n' for c in topn_chunks)
     # Add instructions to the prompt
-    prompt += (
-        "Instructions: Compose a comprehensive reply to the query using the search results given. "
-        "Cite each reference using [ Page Number] notation (every result has this number at the beginning). "
-        "Citation should be done at the end of each sentence. If the search results mention multiple subjects "
-        "with the same name, create separate answers for each. Only include information found in the results and "
-        "don't add any additional information. Make sure the answer is correct and don't output false content. "
-        "If the text does not relate to the query, simply state 'Text Not Found in PDF'. Ignore outlier "
-        "search results which has nothing to do with the question. Only answer what is asked. The "
-        "answer should be short and concise. Answer step-by-step. \n\nQuery: {question}\nAnswer: "
-    )
+    parts.append(PROMPT_INSTRUCTIONS)
+    parts.append(f"\n\nQuery: {question}\nAnswer: ")
+    return ''.join(parts)
+
 
-    return prompt
+def chat_completion(ai, prompt, max_tokens=4096, temperature=0.7):
+    """
+    Send the prompt to the PySparkAI and return the generated message.
+    Errors are raised to the caller.
+
+    :param ai: Instance of the PySparkAI.
+    :param prompt: The prompt for generating the text.
+    :param max_tokens: Maximum number of tokens to generate.
+    :param temperature: Temperature parameter for generation.
+    :return: Generated text.
+    """
+    messages = [{"content": prompt, "role": "user"}]
+    with span("llm"):
+        completion = ai.chat(
+            messages, temperature=temperature, max_tokens=max_tokens)
+    message = completion['choices'][0]['message']
+    if is_enabled():
+        count("llm.requests")
+        count("llm.prompt_tokens", estimate_tokens(prompt))
+        count("llm.answer_tokens", estimate_tokens(str(message)))
+    return message
 
 
 def generate_text(ai, prompt, max_tokens=4096, temperature=0.7):
@@ -141,25 +513,47 @@ def generate_text(ai, prompt, max_tokens=4096, temperature=0.7):
     :return: Generated text.
     """
     try:
-        messages = [{"content": prompt, "role": "user"}]
-        completion = ai.chat(
-            messages, temperature=temperature, max_tokens=max_tokens)
-        message = completion['choices'][0]['message']
+        message = chat_completion(ai, prompt, max_tokens=max_tokens, temperature=temperature)
     except Exception as e:
         message = f'API Error: {str(e)}'
     return message
 
 
-def generate_answer(question, ai, recommender):
+@timed("answer")
+def generate_answer(question, ai, recommender, cache=None, max_tokens=None, temperature=0.7,
+                    context_tokens=2048):
     """
     Generate an answer to the given question using the semantic search and PySparkAI.
 
     :param question: The question to answer.
     :param ai: Instance of the PySparkAI.
     :param recommender: Instance of the SemanticSearch.
+    :param cache: AnswerCache used to reuse query embeddings and answers (optional).
+    :param max_tokens: Maximum number of tokens to generate (estimated from the packed search results by default).
+    :param temperature: Temperature parameter for generation.
+    :param context_tokens: Token budget of the search results in the prompt (None to include all chunks).
     :return: Generated answer.
     """
-    topn_chunks = recommender.search(question)
-    prompt = generate_prompt(question, topn_chunks)
-    answer = generate_text(ai, prompt)
-    return answer
\ No newline at end of file
+    if cache is None:
+        neighbors = recommender.search(question, return_data=False)
+    else:
+        embedding = cache.get_embedding(question, recommender.encoder_id, recommender.encode)
+        neighbors = recommender.search_embedding(embedding)
+
+    context = pack_context([recommender.data[i] for i in neighbors], context_tokens, chunk_ids=neighbors)
+    max_tokens = max_tokens or estimate_answer_tokens(context["tokens"])
+    if cache is None:
+        prompt = generate_prompt(question, context["chunks"])
+        return generate_text(ai, prompt, max_tokens=max_tokens, temperature=temperature)
+
+    params = {"max_tokens": max_tokens, "temperature": temperature, "context_tokens": context_tokens}
+    key = cache.make_key(recommender.index_version, question, neighbors, params)
+    answer = cache.get(key)
+    if answer is None:
+        answer = cache.get_similar(embedding, recommender.index_version, params)
+    if answer is None:
+        prompt = generate_prompt(question, context["chunks"])
+        answer = generate_text(ai, prompt, max_tokens=max_tokens, temperature=temperature)
+        if not str(answer).startswith('API Error'):
+            cache.put(key, answer, embedding=embedding)
+    return answer
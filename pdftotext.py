@@ -5,9 +5,97 @@
 
 
 import re
-import fitz
 import os
 import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from instrumentation import count, timed
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+# The settings the extracted text depends on; they are part of the page text cache key.
+EXTRACTION_SETTINGS = {"mode": "text", "preprocess": 1}
+
+
+def preprocess_text(text):
+    """
+    Preprocess the text extracted from a PDF page.
+    :param text: The text extracted from the PDF page.
+    :return: The preprocessed text.
+    """
+    # '\s' also matches the newlines.
+    return WHITESPACE_PATTERN.sub(' ', text)
+
+
+def check_page_range(start_page, end_page, total_pages):
+    """
+    Check that the page range lies within the document.
+    :param start_page: The start page number.
+    :param end_page: The end page number.
+    :param total_pages: The total number of pages of the document.
+    :return: None
+    """
+    if not isinstance(start_page, int) or start_page < 1 or start_page > total_pages:
+        raise ValueError(
+            "The 'start_page' parameter must be a positive integer and less than or equal to the total number of pages.")
+
+    if not isinstance(end_page, int) or end_page < 1 or end_page > total_pages:
+        raise ValueError(
+            "The 'end_page' parameter must be a positive integer and less than or equal to the total number of pages.")
+
+
+def extract_page_range(pdf_path, start_page, end_page):
+    """
+    Extract the preprocessed text of a page range. This runs in the worker
+    processes of the parallel extraction.
+    :param pdf_path: The path to the PDF file.
+    :param start_page: The start page number.
+    :param end_page: The end page number (inclusive).
+    :return: A list of text, one per page.
+    """
+    import fitz
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        return [preprocess_text(doc.load_page(i).get_text("text"))
+                for i in range(start_page - 1, end_page)]
+
+
+def extract_first_range(pdf_path, start_page, end_page, pages_per_task):
+    """
+    Count the pages of a PDF and extract the text of its first page range.
+    This runs in the worker processes, so no PDF is opened by the caller.
+    :param pdf_path: The path to the PDF file.
+    :param start_page: The start page number.
+    :param end_page: The end page number (defaults to the last page).
+    :param pages_per_task: The number of pages of the first range.
+    :return: A tuple of the end page number and the texts of the first range.
+    """
+    import fitz
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        last_page = doc.page_count if end_page is None else end_page
+        check_page_range(start_page, last_page, doc.page_count)
+        return last_page, [preprocess_text(doc.load_page(i).get_text("text"))
+                           for i in range(start_page - 1, min(start_page + pages_per_task - 1, last_page))]
+
+
+def split_page_range(start_page, end_page, pages_per_task):
+    """
+    Split a page range into consecutive ranges of at most 'pages_per_task' pages.
+    :return: A list of (start_page, end_page) tuples in page order.
+    """
+    return [(first, min(first + pages_per_task - 1, end_page))
+            for first in range(start_page, end_page + 1, pages_per_task)]
+
+
+def contiguous_ranges(pages):
+    """
+    Group sorted page numbers into ranges of consecutive pages.
+    :return: A list of (start_page, end_page) tuples in page order.
+    """
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return [tuple(r) for r in ranges]
 
 
 class PDFTextExtractor:
@@ -15,10 +103,11 @@ class PDFTextExtractor:
     The class is used to extract text from PDF files.
     """
 
-    def __init__(self, pdf_path):
+    def __init__(self, pdf_path, cache=None):
         """
         Initialize with a PDF file path.
         :param pdf_path: The path to the PDF file.
+        :param cache: PageTextCache used to store the text of the pages (optional).
         """
         self._init_logger()
         if not os.path.exists(pdf_path):
@@ -28,6 +117,8 @@ class PDFTextExtractor:
             self.logger.error("The specified file is not a PDF.")
             raise ValueError("The specified file is not a PDF.")
         self.pdf_path = pdf_path
+        self.cache = cache
+        self._cache_key = None
 
     def _init_logger(self):
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -44,73 +135,206 @@ class PDFTextExtractor:
         :param text: The text extracted from the PDF file.
         :return: The preprocessed text.
         """
-        text = text.replace('\n', ' ')
-        text = re.sub('\s+', ' ', text)
-        return text
+        return preprocess_text(text)
 
-    def pdf_to_text(self, start_page=1, end_page=None):
+    def _cache_lookup(self):
+        """
+        Returns the cache key and the cached page count of the PDF (None if it is not cached).
         """
-        Extract text from the PDF file.
+        if self.cache is None:
+            return None, None
+        if self._cache_key is None:
+            self._cache_key = self.cache.document_key(self.pdf_path, EXTRACTION_SETTINGS)
+        return self._cache_key, self.cache.page_count(self._cache_key)
+
+    def _extract_pages(self, pages, workers, pages_per_task):
+        """
+        Parse the given pages of the PDF file.
+        :param pages: Sorted page numbers.
+        :return: A dictionary from page number to text.
+        """
+        ranges = [task for first, last in contiguous_ranges(pages)
+                  for task in split_page_range(first, last, pages_per_task)]
+        if workers is None or workers <= 1 or len(ranges) <= 1:
+            import fitz
+            with fitz.open(self.pdf_path, filetype="pdf") as doc:
+                return {page: self.preprocess(doc.load_page(page - 1).get_text("text")) for page in pages}
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = executor.map(extract_page_range, [self.pdf_path] * len(ranges),
+                                 *zip(*ranges))
+            return {page: text for (first, _), part in zip(ranges, parts)
+                    for page, text in enumerate(part, first)}
+
+    @timed("extract")
+    def pdf_to_text(self, start_page=1, end_page=None, workers=None, pages_per_task=16):
+        """
+        Extract text from the PDF file. With a cache, only the pages which are
+        not cached yet are parsed.
         :param start_page: The start page number.
         :param end_page: The end page number.
+        :param workers: The number of worker processes; None or 1 extracts in this process.
+        :param pages_per_task: The number of pages extracted by one worker task.
         :return: A list of text.
         """
-        with fitz.open(self.pdf_path, filetype="pdf") as doc:
-            total_pages = doc.page_count
+        key, total_pages = self._cache_lookup()
+        if total_pages is None:
+            import fitz
+            with fitz.open(self.pdf_path, filetype="pdf") as doc:
+                total_pages = doc.page_count
 
-            if end_page is None:
-                end_page = total_pages
+        if end_page is None:
+            end_page = total_pages
 
-            if not isinstance(start_page, int) or start_page < 1 or start_page > total_pages:
-                raise ValueError(
-                    "The 'start_page' parameter must be a positive integer and less than or equal to the total number of pages.")
+        check_page_range(start_page, end_page, total_pages)
 
-            if not isinstance(end_page, int) or end_page < 1 or end_page > total_pages:
-                raise ValueError(
-                    "The 'end_page' parameter must be a positive integer and less than or equal to the total number of pages.")
+        pages = range(start_page, end_page + 1)
+        texts = self.cache.get_pages(key, pages) if key is not None else {}
+        missing = [page for page in pages if page not in texts]
+        if missing:
+            parsed = self._extract_pages(missing, workers, pages_per_task)
+            if key is not None:
+                self.cache.put_pages(key, total_pages, parsed)
+            texts.update(parsed)
+        count("pages", len(pages))
+        if key is not None:
+            count("text_cache.hits", len(pages) - len(missing))
+            count("text_cache.misses", len(missing))
+        return [texts[page] for page in pages]
 
-            text_list = []
+    def iter_pages(self, start_page=1, end_page=None):
+        """
+        Extract text from the PDF file page by page. With a cache, the PDF is
+        only opened once a page is not cached; the cached pages are looked up
+        at once and the parsed ones are stored in one transaction at the end.
+        :param start_page: The start page number.
+        :param end_page: The end page number.
+        :return: A generator of text, one per page.
+        """
+        import fitz
+        key, total_pages = self._cache_lookup()
+        doc = None
+        parsed = {}
+        try:
+            if total_pages is None:
+                doc = fitz.open(self.pdf_path, filetype="pdf")
+                total_pages = doc.page_count
+
+            if end_page is None:
+                end_page = total_pages
 
-            for i in range(start_page - 1, end_page):
-                text = doc.load_page(i).get_text("text")
-                text = self.preprocess(text)
-                text_list.append(text)
+            check_page_range(start_page, end_page, total_pages)
 
-        return text_list
+            pages = range(start_page, end_page + 1)
+            cached = self.cache.get_pages(key, pages) if key is not None else {}
+            for page in pages:
+                text = cached.get(page)
+                if text is None:
+                    if doc is None:
+                        doc = fitz.open(self.pdf_path, filetype="pdf")
+                    text = parsed[page] = self.preprocess(doc.load_page(page - 1).get_text("text"))
+                count("pages")
+                yield text
+        finally:
+            # Also store the pages parsed before the caller stopped iterating.
+            if key is not None and parsed:
+                self.cache.put_pages(key, total_pages, parsed)
+            if doc is not None:
+                doc.close()
 
-    def text_to_chunks(self, texts, word_length=150, start_page=1):
+    @timed("chunk")
+    def text_to_chunks(self, texts, word_length=150, start_page=1, overlap=0):
         """
         Split the text into chunks.
         :param texts: A list of text.
         :param word_length: The maximum number of words in each chunk.
         :param start_page: The start page number.
+        :param overlap: The number of words shared by consecutive chunks.
         :return: A list of chunks.
         """
-        text_toks = [t.split(' ') for t in texts]
-        chunks = []
-
-        for idx, words in enumerate(text_toks):
-            chunks += self._create_chunks(words, idx,
-                                          word_length, start_page, text_toks)
+        chunks = list(iter_chunks(texts, word_length, start_page, overlap))
+        count("chunks", len(chunks))
         return chunks
 
-    def _create_chunks(self, words, idx, word_length, start_page, text_toks):
-        """
-        Create chunks from the text.
-        :param words: A list of words.
-        :param idx: The index of the text.
-        :param word_length: The maximum number of words in each chunk.
-        :param start_page: The start page number.
-        :param text_toks: A list of text.
-        :return: A list of chunks.
-        """
-        chunks = []
-        for i in range(0, len(words), word_length):
-            chunk = words[i: i + word_length]
-            if ((i + word_length) > len(words)) and (len(chunk) < word_length) and (len(text_toks) != (idx + 1)):
-                text_toks[idx + 1] = chunk + text_toks[idx + 1]
-                continue
-            chunk = ' '.join(chunk).strip()
-            chunk = f'[Page no. {idx+start_page}]' + ' ' + '"' + chunk + '"'
-            chunks.append(chunk)
-        return chunks
\ No newline at end of file
+
+def iter_chunks(texts, word_length=150, start_page=1, overlap=0):
+    """
+    Split the text into chunks as the pages arrive.
+    The words left over at the end of a page are carried to the next page,
+    so only the last page may produce a chunk shorter than word_length.
+    :param texts: An iterable of text, one per page.
+    :param word_length: The maximum number of words in each chunk.
+    :param start_page: The start page number.
+    :param overlap: The number of words shared by consecutive chunks.
+    :return: A generator of chunks.
+    """
+    if not isinstance(overlap, int) or overlap < 0 or overlap >= word_length:
+        raise ValueError(
+            "The 'overlap' parameter must be a non-negative integer less than 'word_length'.")
+    stride = word_length - overlap
+    texts = iter(texts)
+    text = next(texts, None)
+    carry = []
+    idx = 0
+    while text is not None:
+        # Look one page ahead to know whether the leftover words can be carried.
+        next_text = next(texts, None)
+        words = text.split(' ')
+        if carry:
+            words = carry + words
+            carry = []
+        for i in range(0, len(words), stride):
+            if i + word_length > len(words):
+                if next_text is not None:
+                    carry = words[i:]
+                    break
+            chunk = ' '.join(words[i: i + word_length]).strip()
+            yield f'[Page no. {idx+start_page}]' + ' ' + '"' + chunk + '"'
+            if i + word_length >= len(words):
+                break
+        text = next_text
+        idx += 1
+
+
+def extract_many(pdf_paths, workers=None, pages_per_task=16, start_page=1, end_page=None):
+    """
+    Extract the text of many PDF files concurrently with a process pool.
+    Large documents are split into page ranges, so one long paper does not
+    keep a single worker busy while the others are idle.
+    :param pdf_paths: A list of paths to PDF files.
+    :param workers: The number of worker processes (defaults to the number of CPUs).
+    :param pages_per_task: The number of pages extracted by one worker task.
+    :param start_page: The start page number of every document.
+    :param end_page: The end page number of every document (defaults to the last page).
+    :return: A generator of (pdf_path, texts) tuples in order of completion, the
+             texts of each document in page order. texts is None if the document failed.
+    """
+    logger = logging.getLogger(PDFTextExtractor.__name__)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # The first task of a document counts its pages, the other ranges are submitted once it is done.
+        pending = {executor.submit(extract_first_range, pdf_path, start_page, end_page, pages_per_task): (pdf_path, 0)
+                   for pdf_path in pdf_paths}
+        parts = {}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pdf_path, n = pending.pop(future)
+                if n and pdf_path not in parts:
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"An error occurred while extracting '{pdf_path}': {e}")
+                    parts.pop(pdf_path, None)
+                    yield pdf_path, None
+                    continue
+                if n == 0:
+                    last_page, texts = result
+                    ranges = split_page_range(start_page, last_page, pages_per_task)
+                    parts[pdf_path] = [texts] + [None] * (len(ranges) - 1)
+                    for m, (first, last) in enumerate(ranges[1:], 1):
+                        pending[executor.submit(extract_page_range, pdf_path, first, last)] = (pdf_path, m)
+                else:
+                    parts[pdf_path][n] = result
+                if all(part is not None for part in parts[pdf_path]):
+                    yield pdf_path, [text for part in parts.pop(pdf_path) for text in part]
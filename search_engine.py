@@ -0,0 +1,106 @@
+# Description: This file contains the ExactSearchEngine class used for batched top-k vector search.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import numpy as np
+
+
+METRICS = ('cosine', 'ip')
+
+
+def normalize(vectors):
+    """
+    Normalize vectors to unit length.
+    :param vectors: A 1-D or 2-D array of vectors.
+    :return: A contiguous float32 array of unit vectors.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    Select the k highest scores of every row with argpartition.
+    :param scores: A 2-D array of scores, one row per query.
+    :param k: The number of results per query.
+    :return: A tuple of (scores, indices), both of shape (n_queries, k), best first.
+    """
+    n = scores.shape[1]
+    k = min(k, n)
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(scores.dtype), empty.astype(np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    indices = np.take_along_axis(part, order, axis=1)
+    return np.take_along_axis(part_scores, order, axis=1), indices
+
+
+class ExactSearchEngine:
+    """
+    This class is used to search a matrix of embeddings exactly.
+
+    The embeddings are kept as one contiguous float32 matrix, pre-normalized for
+    the cosine metric, so that a batch of queries is scored with a single
+    matrix multiply.
+    """
+
+    def __init__(self, embeddings=None, metric='cosine'):
+        """
+        Initialize the engine.
+        :param embeddings: The embeddings to search (optional).
+        :param metric: 'cosine' or 'ip' (inner product).
+        """
+        if metric not in METRICS:
+            raise ValueError(f"The 'metric' parameter must be one of {METRICS}.")
+        self.metric = metric
+        self.matrix = None
+        if embeddings is not None:
+            self.fit(embeddings)
+
+    def __len__(self):
+        return 0 if self.matrix is None else len(self.matrix)
+
+    def _prepare(self, vectors):
+        if self.metric == 'cosine':
+            return normalize(vectors)
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def fit(self, embeddings):
+        """
+        Set the embeddings to search.
+        :param embeddings: A 2-D array of embeddings.
+        :return: self
+        """
+        self.matrix = self._prepare(np.atleast_2d(embeddings))
+        return self
+
+    def search_batch(self, queries, k=5):
+        """
+        Search the k nearest embeddings of many queries at once.
+        :param queries: A 2-D array of query embeddings.
+        :param k: The number of results per query.
+        :return: A tuple of (scores, indices), both of shape (n_queries, k), best first.
+        """
+        if self.matrix is None:
+            raise ValueError("The search engine has not been fitted.")
+        queries = self._prepare(np.atleast_2d(queries))
+        scores = queries @ self.matrix.T
+        return top_k(scores, k)
+
+    def search(self, query, k=5):
+        """
+        Search the k nearest embeddings of one query.
+        :param query: A query embedding.
+        :param k: The number of results.
+        :return: A tuple of (scores, indices), best first.
+        """
+        scores, indices = self.search_batch(np.reshape(query, (1, -1)), k)
+        return scores[0], indices[0]
@@ -0,0 +1,401 @@
+# Description: This file contains the local HTTP service which keeps the encoder and indexes resident.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from pdftotext import PDFTextExtractor
+from search_engine import ExactSearchEngine, normalize
+from mmap_store import MmapIndex
+from context_packer import pack_context, estimate_answer_tokens
+from pdf_semantic_search import generate_prompt, generate_text
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ReadWriteLock:
+    """
+    A lock which lets many readers or one writer in. Waiting writers block new
+    readers, so a writer is not starved by a steady stream of searches.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writing or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+
+    def release_write(self):
+        with self.cond:
+            self.writing = False
+            self.cond.notify_all()
+
+    def read(self):
+        return _Locked(self.acquire_read, self.release_read)
+
+    def write(self):
+        return _Locked(self.acquire_write, self.release_write)
+
+
+class _Locked:
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class QueryBatcher:
+    """
+    This class coalesces the queries of concurrent requests into one encoder call.
+
+    The first waiting query opens a batch; queries arriving within 'max_wait_ms'
+    join it, up to 'max_batch' queries.
+    """
+
+    def __init__(self, encoder, max_wait_ms=5, max_batch=64):
+        """
+        :param encoder: The Encoder used for the queries.
+        :param max_wait_ms: How long a batch waits for more queries, in milliseconds.
+        :param max_batch: The maximum number of queries per batch.
+        """
+        self.encoder = encoder
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.batch_sizes = deque(maxlen=10000)
+        self.thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self.thread.start()
+
+    def encode(self, text):
+        """
+        Encode one query, waiting for the batch it joins.
+        :param text: The query text.
+        :return: The normalized embedding of the query.
+        """
+        future = Future()
+        self.queue.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.batch_sizes.append(len(batch))
+            try:
+                embeddings = normalize(self.encoder.encode([text for text, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        sizes = np.asarray(self.batch_sizes)
+        if not len(sizes):
+            return {"batches": 0}
+        return {"batches": len(sizes), "queries": int(sizes.sum()), "mean": float(sizes.mean()),
+                "p50": float(np.percentile(sizes, 50)), "max": int(sizes.max())}
+
+
+class ResidentIndex:
+    """
+    An index held by the service, guarded by a read/write lock.
+    """
+
+    def __init__(self, name, engine, texts, source):
+        self.name = name
+        self.engine = engine
+        self.texts = texts
+        self.source = source
+        self.lock = ReadWriteLock()
+        self.loaded_at = time.time()
+
+
+class SearchService:
+    """
+    This class keeps an encoder and several indexes in memory and serves
+    search and answer requests from many threads.
+
+    Indexes are built outside of their lock and swapped in under the write
+    lock, so re-indexing a paper blocks its searches only for the swap.
+    """
+
+    def __init__(self, encoder, ai=None, max_wait_ms=5, max_batch=64):
+        """
+        :param encoder: The Encoder of the queries and the indexed chunks.
+        :param ai: Instance of the PySparkAI used by answer requests (optional).
+        :param max_wait_ms: How long a query batch waits for more queries, in milliseconds.
+        :param max_batch: The maximum number of queries per batch.
+        """
+        self.encoder = encoder
+        self.ai = ai
+        self.batcher = QueryBatcher(encoder, max_wait_ms=max_wait_ms, max_batch=max_batch)
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def load(self, name, path, word_length=150):
+        """
+        Load or reload an index from a PDF file or a memory-mapped index directory.
+        :param name: The name of the index.
+        :param path: The path to a PDF file or an index directory written by write_index.
+        :param word_length: The number of words in each chunk of a PDF.
+        :return: The number of chunks.
+        """
+        if os.path.isdir(path):
+            engine = MmapIndex(path)
+            if engine.encoder_id != self.encoder.name:
+                raise ValueError(f"The index was built with encoder '{engine.encoder_id}', not '{self.encoder.name}'.")
+            texts = engine.texts
+        else:
+            extractor = PDFTextExtractor(path)
+            texts = extractor.text_to_chunks(extractor.pdf_to_text(), word_length=word_length)
+            embeddings = np.vstack([self.encoder.encode(texts[i:i + 256]) for i in range(0, len(texts), 256)])
+            engine = ExactSearchEngine(embeddings)
+        with self.lock:
+            index = self.indexes.get(name)
+            if index is None:
+                self.indexes[name] = ResidentIndex(name, engine, texts, path)
+                return len(texts)
+        with index.lock.write():
+            index.engine, index.texts, index.source = engine, texts, path
+            index.loaded_at = time.time()
+        return len(texts)
+
+    def _index(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            raise KeyError(f"Unknown index '{name}'.")
+        return index
+
+    def _record(self, endpoint, start):
+        with self.lock:
+            self.latencies.setdefault(endpoint, deque(maxlen=10000)).append(
+                (time.perf_counter() - start) * 1000)
+
+    def search(self, name, query, k=5):
+        """
+        Search an index.
+        :param name: The name of the index.
+        :param query: The query text.
+        :param k: The number of results.
+        :return: A list of results with the chunk 'text', its 'row' and 'score'.
+        """
+        start = time.perf_counter()
+        index = self._index(name)
+        embedding = self.batcher.encode(query)
+        with index.lock.read():
+            scores, rows = index.engine.search(embedding, k)
+            results = [{"text": index.texts[int(i)], "row": int(i), "score": float(s)}
+                       for s, i in zip(scores, rows) if i >= 0]
+        self._record("search", start)
+        return results
+
+    def answer(self, name, question, k=5, context_tokens=2048, temperature=0.7):
+        """
+        Answer a question about an index with the PySparkAI.
+        :param name: The name of the index.
+        :param question: The question.
+        :param k: The number of chunks searched.
+        :param context_tokens: The token budget of the search results in the prompt.
+        :param temperature: Temperature parameter for generation.
+        :return: The answer.
+        """
+        if self.ai is None:
+            raise RuntimeError("No Spark AI credentials were configured.")
+        start = time.perf_counter()
+        results = self.search(name, question, k=k)
+        context = pack_context([r["text"] for r in results], context_tokens,
+                               chunk_ids=[r["row"] for r in results])
+        prompt = generate_prompt(question, context["chunks"])
+        answer = generate_text(self.ai, prompt, max_tokens=estimate_answer_tokens(context["tokens"]),
+                               temperature=temperature)
+        self._record("answer", start)
+        return answer
+
+    def stats(self):
+        """
+        Returns the latency percentiles per endpoint, the query batch sizes and the indexes.
+        """
+        with self.lock:
+            latencies = {endpoint: np.asarray(values) for endpoint, values in self.latencies.items()}
+            indexes = dict(self.indexes)
+        report = {"latency_ms": {}, "batch_size": self.batcher.stats(),
+                  "indexes": {name: {"chunks": len(index.texts), "source": index.source,
+                                     "loaded_at": index.loaded_at}
+                              for name, index in indexes.items()}}
+        for endpoint, values in latencies.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            report["latency_ms"][endpoint] = {"requests": len(values), "p50": float(p50),
+                                              "p95": float(p95), "p99": float(p99)}
+        return report
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP interface of the SearchService:
+
+    - POST /search  {"index": ..., "query": ..., "k": 5}
+    - POST /answer  {"index": ..., "question": ...}
+    - POST /indexes {"name": ..., "path": ...} loads or reloads an index
+    - GET  /stats
+    """
+
+    service = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, self.service.stats())
+        else:
+            self._send(404, {"error": f"Unknown path '{self.path}'."})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            def field(name):
+                if name not in request:
+                    raise ValueError(f"Missing field '{name}'.")
+                return request[name]
+
+            if self.path == "/search":
+                data = {"results": self.service.search(field("index"), field("query"), k=int(request.get("k", 5)))}
+            elif self.path == "/answer":
+                data = {"answer": self.service.answer(field("index"), field("question"), k=int(request.get("k", 5)))}
+            elif self.path == "/indexes":
+                data = {"chunks": self.service.load(field("name"), field("path"))}
+            else:
+                self._send(404, {"error": f"Unknown path '{self.path}'."})
+                return
+        except KeyError as e:
+            self._send(404, {"error": e.args[0]})
+            return
+        except (ValueError, FileNotFoundError) as e:
+            self._send(400, {"error": str(e)})
+            return
+        except RuntimeError as e:
+            self._send(503, {"error": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"An error occurred while serving {self.path}: {e}")
+            self._send(500, {"error": str(e)})
+            return
+        self._send(200, data)
+
+
+class ServiceServer(ThreadingHTTPServer):
+    """
+    A threading HTTP server with a listen backlog for many concurrent clients.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    """
+    Serve the service over HTTP until interrupted.
+    :param service: The SearchService.
+    :param host: The host to bind.
+    :param port: The port to bind.
+    :return: None
+    """
+    handler = type("Handler", (ServiceHandler,), {"service": service})
+    server = ServiceServer((host, port), handler)
+    logger.info(f"Serving on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    from encoders import get_encoder
+
+    arg_parser = argparse.ArgumentParser(description="Serve search and answer requests with resident indexes.")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--encoder", default="use", help="The encoder backend: 'use' or 'hashing'.")
+    arg_parser.add_argument("--index", action="append", default=[], metavar="NAME=PATH",
+                            help="An index to load: a PDF file or an index directory. May be repeated.")
+    arg_parser.add_argument("--batch-wait-ms", type=float, default=5)
+    arg_parser.add_argument("--max-batch", type=int, default=64)
+    args = arg_parser.parse_args()
+
+    ai = None
+    credentials = [os.environ.get(name) for name in ('APP_ID', 'API_KEY', 'API_SECRET', 'SPARK_URL', 'DOMAIN')]
+    if all(credentials):
+        from pysparkai import PySparkAI
+        ai = PySparkAI(app_id=credentials[0], api_key=credentials[1], api_secret=credentials[2],
+                       spark_url=credentials[3], domain=credentials[4])
+    else:
+        logger.info("Spark AI credentials are not set in the environment, /answer is disabled.")
+
+    service = SearchService(get_encoder(args.encoder), ai=ai, max_wait_ms=args.batch_wait_ms,
+                            max_batch=args.max_batch)
+    for spec in args.index:
+        name, path = spec.split("=", 1)
+        logger.info(f"Loaded index '{name}' with {service.load(name, path)} chunks.")
+    serve(service, args.host, args.port)
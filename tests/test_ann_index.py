@@ -0,0 +1,23 @@
+# Description: This file contains the tests of the re-scoring of the product-quantized IVFIndex.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import numpy as np
+from ann_index import IVFIndex
+from ann_benchmark import synthetic_embeddings, recall_at_k
+from search_engine import ExactSearchEngine
+
+
+def test_pq_rerank_recall():
+    data = synthetic_embeddings(4000, dim=64, n_topics=32)
+    rng = np.random.default_rng(1)
+    queries = data[rng.choice(len(data), 50, replace=False)] + 0.1 * rng.normal(size=(50, 64)).astype(np.float32)
+    exact_ids = ExactSearchEngine(data).search_batch(queries, k=10)[1]
+
+    index = IVFIndex(n_lists=32, nprobe=32, pq_subvectors=8, rerank=4).fit(data)
+    estimated = recall_at_k(index.search_batch(queries, k=10, rerank=0)[1], exact_ids)
+    scores, ids = index.search_batch(queries, k=10)
+    assert recall_at_k(ids, exact_ids) >= max(0.9, estimated)
+    # The re-scored results carry their exact cosine scores.
+    np.testing.assert_allclose(scores[0], data[ids[0]] @ (queries[0] / np.linalg.norm(queries[0])), rtol=1e-4)
@@ -0,0 +1,58 @@
+# Description: This file contains the tests of the AnswerCache used by generate_answer.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import pytest
+import instrumentation
+from answer_cache import AnswerCache
+from encoders import get_encoder
+from embedding_cache import EmbeddingCache
+from text_cache import PageTextCache
+from pdf_semantic_search import SemanticSearch, generate_answer
+
+
+class FakeAI:
+
+    def __init__(self):
+        self.calls = 0
+
+    def chat(self, messages, temperature=0.7, max_tokens=None):
+        self.calls += 1
+        return {'choices': [{'message': f"answer {self.calls}"}]}
+
+
+@pytest.fixture
+def recommender(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    SemanticSearch._instance = None
+    recommender = SemanticSearch(cache=EmbeddingCache(str(tmp_path / "embeddings")),
+                                 text_cache=PageTextCache(str(tmp_path / "pages.sqlite3")),
+                                 encoder=get_encoder('hashing'))
+    recommender.fit([f"[Page no. {i}] chunk number {i} about topic {i % 7}" for i in range(20)])
+    yield recommender
+    SemanticSearch._instance = None
+
+
+def test_cached_path_records_the_embedding(recommender):
+    instrumentation.reset()
+    instrumentation.enable(record_events=False)
+    try:
+        generate_answer("what is topic 3?", FakeAI(), recommender, cache=AnswerCache())
+        totals = instrumentation.snapshot()
+    finally:
+        instrumentation.disable()
+        instrumentation.reset()
+    assert totals["counters"]["embeddings"] == 1
+    assert "embed" in totals["spans"]
+
+
+def test_encoder_change_drops_cached_answers(recommender):
+    ai = FakeAI()
+    cache = AnswerCache(semantic_threshold=0.5)
+    assert generate_answer("what is topic 3?", ai, recommender, cache=cache) == "answer 1"
+    assert generate_answer("what is topic 3?", ai, recommender, cache=cache) == "answer 1"
+
+    version = recommender.index_version
+    SemanticSearch(encoder=get_encoder('hashing', dim=256))
+    assert recommender.index_version > version
@@ -0,0 +1,66 @@
+# Description: This file contains the tests of resuming an interrupted ArxivAPI.harvest.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import json
+import logging
+from types import SimpleNamespace
+import pytest
+from arxiv_api import ArxivAPI
+
+
+class FakeClient:
+    """
+    Serves 'listing' from an offset like arxiv.Client.results, failing after 'fail_after' results.
+    """
+    page_size = 2
+
+    def __init__(self, listing):
+        self.listing = listing
+        self.fail_after = None
+
+    def results(self, search, offset=0):
+        for n, entry_id in enumerate(self.listing[offset:]):
+            if self.fail_after is not None and n == self.fail_after:
+                raise ConnectionError("connection reset")
+            yield SimpleNamespace(entry_id=entry_id)
+
+
+def make_api(listing):
+    api = ArxivAPI()
+    api.client = FakeClient(listing)
+    return api
+
+
+def harvest_ids(api, checkpoint_path, n=None):
+    ids = []
+    harvest = api.harvest(query="cat:cs.LG", checkpoint_path=checkpoint_path)
+    for result in harvest:
+        ids.append(result.entry_id)
+        if len(ids) == n:
+            harvest.close()
+    return ids
+
+
+def test_resume_after_shifted_listing(tmp_path, caplog):
+    checkpoint_path = str(tmp_path / "harvest.json")
+    api = make_api(list("abcdef"))
+    api.client.fail_after = 4
+    with pytest.raises(ConnectionError):
+        harvest_ids(api, checkpoint_path)
+
+    # 'b' was withdrawn, so 'e' now sits before the checkpoint offset. The consumer stops
+    # while processing 'f', which is yielded again on resume.
+    api.client.listing = list("acdefg")
+    api.client.fail_after = None
+    assert harvest_ids(api, checkpoint_path, n=2) == ["e", "f"]
+    with open(checkpoint_path) as f:
+        state = json.load(f)
+    assert (state["offset"], state["last_entry_id"]) == (4, "e")
+
+    # The listing did not change since, so the harvest continues without a gap or duplicate.
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        assert harvest_ids(api, checkpoint_path) == ["f", "g"]
+    assert "listing changed" not in caplog.text
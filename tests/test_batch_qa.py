@@ -0,0 +1,87 @@
+# Description: This file contains the tests of the concurrency, retry and rate limits of the BatchAnswerer.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import time
+import threading
+from batch_qa import BatchAnswerer, TokenBucket
+
+
+class FakeAI:
+    """
+    Answers like PySparkAI.chat after 'delays[n]' seconds for the n-th call
+    (the last delay for later calls), failing the calls listed in 'failures'.
+    """
+
+    def __init__(self, delays=(0.0,), failures=()):
+        self.delays = delays
+        self.failures = set(failures)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def chat(self, messages, temperature=0.7, max_tokens=None):
+        with self.lock:
+            n = self.calls
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delays[min(n, len(self.delays) - 1)])
+            if n in self.failures:
+                raise ConnectionError(f"call {n} failed")
+            return {'choices': [{'message': "an answer"}]}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def answer_concurrently(answerer, n):
+    threads = [threading.Thread(target=answerer.answer_prompt, args=("a question", 8)) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_timed_out_requests_count_against_the_concurrency():
+    # The first four calls hang past the timeout, the retries answer at once.
+    ai = FakeAI(delays=(0.3, 0.3, 0.3, 0.3, 0.0))
+    answerer = BatchAnswerer(ai, None, concurrency=2, timeout=0.05, backoff=0.0)
+    answer_concurrently(answerer, 4)
+    assert ai.max_in_flight <= 2
+    assert answerer.stats["failures"] == 0
+
+
+def test_retry_count():
+    answerer = BatchAnswerer(FakeAI(failures={0, 1}), None, max_retries=3, backoff=0.0)
+    assert answerer.answer_prompt("a question", 8) == "an answer"
+    assert answerer.stats["requests"] == 3
+    assert answerer.stats["retries"] == 2
+
+    answerer = BatchAnswerer(FakeAI(failures=range(10)), None, max_retries=2, backoff=0.0)
+    assert answerer.answer_prompt("a question", 8).startswith("API Error")
+    assert answerer.stats["requests"] == 3
+    assert answerer.stats["failures"] == 1
+
+
+def test_token_bucket_pacing():
+    bucket = TokenBucket(6000)
+    start = time.monotonic()
+    assert bucket.acquire(6000) == 0.0
+    # The bucket is empty and refills 100 tokens per second.
+    bucket.acquire(30)
+    assert 0.25 <= time.monotonic() - start < 1.0
+
+
+def test_failed_requests_return_their_answer_tokens():
+    answerer = BatchAnswerer(FakeAI(failures=range(10)), None, tokens_per_minute=600,
+                             max_retries=4, backoff=0.0)
+    # Each attempt reserves the prompt and 200 answer tokens; only the prompt is kept.
+    start = time.monotonic()
+    answerer.answer_prompt("a question", 200)
+    assert time.monotonic() - start < 0.5
+    assert answerer.stats["rate_limited_seconds"] == 0.0
+    assert answerer.limiter.tokens > 500
@@ -0,0 +1,129 @@
+# Description: This file contains the tests of the incremental corpus refresh.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import shutil
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+import pytest
+from benchmark import make_synthetic_pdf
+from corpus_refresh import CorpusRefresher
+from corpus_index import CorpusIndex
+from encoders import get_encoder
+from pdf_semantic_search import SemanticSearch
+
+
+NOW = datetime.now(timezone.utc)
+
+
+def make_result(number, version, updated, pdf_path):
+    return SimpleNamespace(entry_id=f"http://arxiv.org/abs/1111.000{number}v{version}", updated=updated,
+                           published=NOW - timedelta(days=30), title=f"Paper {number}",
+                           authors=[SimpleNamespace(name="Author")], primary_category="cs.LG",
+                           categories=["cs.LG"], pdf_url=pdf_path)
+
+
+class FakeArxivAPI:
+    """
+    Serves the latest version of every paper of 'papers', filtered like ArxivAPI.query_updated.
+    """
+
+    def __init__(self, papers):
+        self.papers = papers
+
+    def query_updated(self, since, query=None, id_list=None, max_results=None):
+        results = [r for r in self.papers.values() if since is None or r.updated >= since]
+        if id_list:
+            results = [r for r in results if r.entry_id.split('/abs/')[-1].split('v')[0] in id_list]
+        return results
+
+
+class FakeDownloader:
+    """
+    The PDF URLs of the fake results are local paths.
+    """
+
+    def download(self, url, fresh=False):
+        return url
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    SemanticSearch._instance = None
+    for i in range(3):
+        make_synthetic_pdf(str(tmp_path / f"p{i}.pdf"), pages=2, seed=i)
+    yield tmp_path
+    SemanticSearch._instance = None
+
+
+def make_refresher(papers, index_dir="corpus"):
+    recommender = SemanticSearch(encoder=get_encoder('hashing'))
+    recommender.corpus = CorpusIndex()
+    return CorpusRefresher(recommender, index_dir=index_dir, arxiv_api=FakeArxivAPI(papers),
+                           downloader=FakeDownloader(), extract_workers=1)
+
+
+def test_version_bump_without_loaded_corpus(workdir):
+    papers = {n: make_result(n, 1, NOW - timedelta(days=10), f"p{n}.pdf") for n in range(2)}
+    report = make_refresher(papers).refresh(id_list=["1111.0000", "1111.0001"])
+    assert len(report["new"]) == 2
+    old_segment = [e["segment"] for e in make_refresher(papers).manifest.papers.values()
+                   if e["entry_id"].endswith("1111.0001v1")][0]
+
+    # A new process: the corpus index is empty and the paper gets a new version.
+    papers[1] = make_result(1, 2, NOW, "p2.pdf")
+    refresher = make_refresher(papers)
+    report = refresher.refresh()
+
+    assert report["updated"] == ["http://arxiv.org/abs/1111.0001v2"]
+    entry = refresher.manifest.get("1111.0001")
+    assert entry["version"] == 2
+    assert os.path.isdir(os.path.join("corpus", entry["segment"]))
+    assert not os.path.exists(os.path.join("corpus", old_segment))
+    assert refresher.recommender.corpus.documents.keys() == {"http://arxiv.org/abs/1111.0001v2"}
+
+    # Nothing changed since, so the next refresh does nothing.
+    report = make_refresher(papers).refresh()
+    assert report["pipeline"] is None
+
+
+def test_version_bump_with_loaded_corpus(workdir):
+    papers = {0: make_result(0, 1, NOW - timedelta(days=10), "p0.pdf")}
+    make_refresher(papers).refresh(id_list=["1111.0000"])
+
+    papers[0] = make_result(0, 2, NOW, "p1.pdf")
+    refresher = make_refresher(papers)
+    assert refresher.load_corpus() == 1
+    refresher.refresh()
+    assert list(refresher.recommender.corpus.documents) == ["http://arxiv.org/abs/1111.0000v2"]
+
+
+def test_same_version_content_change(workdir):
+    papers = {0: make_result(0, 1, NOW - timedelta(days=10), "p0.pdf")}
+    make_refresher(papers).refresh(id_list=["1111.0000"])
+    old_entry = dict(make_refresher(papers).manifest.get("1111.0000"))
+
+    # Same version and URL, but the PDF behind it was replaced.
+    shutil.copy("p1.pdf", "p0.pdf")
+    papers[0] = make_result(0, 1, NOW, "p0.pdf")
+    refresher = make_refresher(papers)
+    report = refresher.refresh()
+
+    entry = refresher.manifest.get("1111.0000")
+    assert report["updated"] == ["http://arxiv.org/abs/1111.0000v1"]
+    assert entry["pdf_hash"] != old_entry["pdf_hash"]
+    assert entry["segment"] != old_entry["segment"]
+    assert not os.path.exists(os.path.join("corpus", old_entry["segment"]))
+
+
+def test_metadata_only_update(workdir):
+    papers = {0: make_result(0, 1, NOW - timedelta(days=10), "p0.pdf")}
+    make_refresher(papers).refresh(id_list=["1111.0000"])
+
+    papers[0] = make_result(0, 1, NOW, "p0.pdf")
+    report = make_refresher(papers).refresh()
+    assert report["metadata_only"] == ["http://arxiv.org/abs/1111.0000v1"]
+    assert report["pipeline"] is None
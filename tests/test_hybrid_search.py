@@ -0,0 +1,39 @@
+# Description: This file contains the tests of the hybrid BM25 and dense search.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import pytest
+from encoders import get_encoder
+from embedding_cache import EmbeddingCache
+from text_cache import PageTextCache
+from pdf_semantic_search import SemanticSearch
+
+
+@pytest.fixture
+def recommender(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    SemanticSearch._instance = None
+    recommender = SemanticSearch(cache=EmbeddingCache(str(tmp_path / "embeddings")),
+                                 text_cache=PageTextCache(str(tmp_path / "pages.sqlite3")),
+                                 encoder=get_encoder('hashing'))
+    recommender.fit([f"[Page no. {i}] chunk number {i} about topic {i % 7}" for i in range(40)]
+                    + ["[Page no. 41] a chunk about transformers"])
+    yield recommender
+    SemanticSearch._instance = None
+
+
+@pytest.mark.parametrize("fusion", ["rrf", "linear", "dense"])
+def test_hybrid_returns_k_with_few_lexical_hits(recommender, fusion):
+    # Only one chunk contains 'transformers', the rest comes from the dense candidates.
+    neighbors = recommender.search("transformers", return_data=False, k=5, mode='hybrid',
+                                   candidates=10, fusion=fusion)
+    assert len(neighbors) == 5
+    assert len(set(neighbors.tolist())) == 5
+    if fusion != 'dense':
+        assert neighbors[0] == 40
+
+
+def test_hybrid_without_lexical_hits(recommender):
+    neighbors = recommender.search("unrelated words", return_data=False, k=5, mode='hybrid', candidates=10)
+    assert len(neighbors) == 5
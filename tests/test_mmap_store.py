@@ -0,0 +1,35 @@
+# Description: This file contains the tests of opening memory-mapped indexes.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import numpy as np
+from encoders import get_encoder
+from embedding_cache import EmbeddingCache
+from text_cache import PageTextCache
+from pdf_semantic_search import SemanticSearch
+from search_engine import normalize
+
+
+def test_open_int8_index_embeddings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    SemanticSearch._instance = None
+    try:
+        recommender = SemanticSearch(cache=EmbeddingCache(str(tmp_path / "embeddings")),
+                                     text_cache=PageTextCache(str(tmp_path / "pages.sqlite3")),
+                                     encoder=get_encoder('hashing'))
+        recommender.fit([f"[Page no. {i}] chunk number {i} about topic {i % 7}" for i in range(30)])
+        vectors = normalize(recommender.embeddings)
+        recommender.save_index(str(tmp_path / "index"), dtype='int8')
+
+        recommender.open_index(str(tmp_path / "index"))
+        # The embeddings are the dequantized vectors, not the int8 codes.
+        np.testing.assert_allclose(recommender.embeddings[:5], vectors[:5], atol=0.01)
+        assert recommender.embeddings[:1].dtype == np.float32
+
+        # Saving the opened index again keeps the vectors.
+        recommender.save_index(str(tmp_path / "again"), dtype='int8')
+        recommender.open_index(str(tmp_path / "again"))
+        np.testing.assert_allclose(recommender.embeddings[:5], vectors[:5], atol=0.02)
+    finally:
+        SemanticSearch._instance = None
@@ -0,0 +1,156 @@
+# Description: This file contains the tests of the PDFDownloader against a local HTTP server.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from pdf_downloader import PDFDownloader
+
+
+class PaperServer(ThreadingHTTPServer):
+    """
+    Serves 'files' over keep-alive connections, with Range requests, redirects
+    ('redirects'), error statuses ('statuses') and bodies cut off after half
+    their length ('truncate', once per path). Every request and connection is counted.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), PaperHandler)
+        self.files = {}
+        self.redirects = {}
+        self.statuses = {}
+        self.truncate = set()
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class PaperHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Range")))
+        if self.path in server.redirects:
+            self.send_response(302)
+            self.send_header("Location", server.redirects[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path in server.statuses or self.path not in server.files:
+            self.send_response(server.statuses.get(self.path, 404))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = server.files[self.path]
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if self.path in server.truncate:
+            server.truncate.discard(self.path)
+            self.wfile.write(body[start:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    server = PaperServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    return PDFDownloader(str(tmp_path / "download"), cache_dir=str(tmp_path / "cache"), retries=3)
+
+
+def pdf_bytes(n):
+    return b"%PDF-1.4\n" + bytes(range(256)) * (n + 1)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_resume_with_range(server, downloader):
+    server.files["/pdf/1"] = pdf_bytes(40)
+    server.truncate.add("/pdf/1")
+    path = downloader.download(server.url("/pdf/1"))
+    assert read(path) == server.files["/pdf/1"]
+    assert server.requests == [("/pdf/1", None), ("/pdf/1", f"bytes={len(server.files['/pdf/1']) // 2}-")]
+    assert downloader.stats["resumed"] == 1
+
+
+def test_redirect(server, downloader):
+    server.files["/pdf/2v1"] = pdf_bytes(3)
+    server.redirects["/pdf/2"] = "/pdf/2v1"
+    path = downloader.download(server.url("/pdf/2"))
+    assert os.path.basename(path) == "2.pdf"
+    assert read(path) == server.files["/pdf/2v1"]
+    assert [p for p, _ in server.requests] == ["/pdf/2", "/pdf/2v1"]
+
+
+def test_cache_hit_without_network(server, downloader, tmp_path):
+    server.files["/pdf/3"] = pdf_bytes(3)
+    downloader.download(server.url("/pdf/3"))
+    requests = len(server.requests)
+
+    # A new downloader, e.g. in the next run, finds the file in the content-addressed cache.
+    again = PDFDownloader(str(tmp_path / "other"), cache_dir=str(tmp_path / "cache"))
+    path = again.download(server.url("/pdf/3"))
+    assert read(path) == server.files["/pdf/3"]
+    assert len(server.requests) == requests
+    assert again.stats["cache_hits"] == 1
+
+
+def test_connection_reuse(server, downloader):
+    for n in range(3):
+        server.files[f"/pdf/{n}"] = pdf_bytes(n)
+        downloader.download(server.url(f"/pdf/{n}"))
+    assert len(server.requests) == 3
+    assert server.connections == 1
+
+
+def test_fresh_fetches_again(server, downloader):
+    server.files["/pdf/4"] = pdf_bytes(4)
+    downloader.download(server.url("/pdf/4"))
+    server.files["/pdf/4"] = pdf_bytes(5)
+    assert read(downloader.download(server.url("/pdf/4"))) == pdf_bytes(4)
+    assert read(downloader.download(server.url("/pdf/4"), fresh=True)) == pdf_bytes(5)
+    assert len(server.requests) == 2
+
+
+@pytest.mark.parametrize("status, attempts", [(404, 1), (410, 1), (429, 3), (503, 3)])
+def test_permanent_errors_are_not_retried(server, downloader, status, attempts):
+    server.statuses["/pdf/5"] = status
+    assert downloader.download(server.url("/pdf/5")) is None
+    assert len(server.requests) == attempts
+    assert downloader.stats["failures"] == 1
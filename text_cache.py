@@ -0,0 +1,197 @@
+# Description: This file contains the PageTextCache class used to persist the extracted text of PDF pages.
+# Author: Shibo Li, MiQroEra Inc.
+# Date: 2023-09-02
+# Version: 1.0
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from embedding_cache import EmbeddingCache
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PageTextCache:
+    """
+    This class is used to store the extracted text of PDF pages in a SQLite
+    database, so that a PDF is parsed at most once per page.
+
+    Pages are stored one row each, compressed with zlib, under the key
+    '<file hash>_<settings hash>', so any page range can be served from the
+    cache and only the pages which are not cached yet have to be parsed.
+    When the cache grows over max_bytes, the least recently used documents
+    are evicted as a whole.
+    """
+
+    def __init__(self, db_path="cache/pages.sqlite3", max_bytes=256 * 1024 * 1024, level=6):
+        """
+        Open or create the cache database.
+        :param db_path: The path to the SQLite database.
+        :param max_bytes: The maximum total size of the compressed text in bytes.
+        :param level: The zlib compression level.
+        """
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.level = level
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hashes = {}
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS documents "
+                              "(key TEXT PRIMARY KEY, page_count INTEGER NOT NULL, accessed_at REAL NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS pages "
+                              "(key TEXT NOT NULL, page INTEGER NOT NULL, data BLOB NOT NULL, "
+                              "size INTEGER NOT NULL, PRIMARY KEY (key, page))")
+
+    def file_hash(self, path):
+        """
+        Returns the content hash of a file. The hash is remembered for the
+        file's path, modification time and size, so an unchanged file is read only once.
+        :param path: The path to the file.
+        :return: The hex digest of the file content.
+        """
+        st = os.stat(path)
+        stamp = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        digest = self._hashes.get(stamp)
+        if digest is None:
+            digest = self._hashes[stamp] = EmbeddingCache.file_hash(path)
+        return digest
+
+    def document_key(self, path, settings):
+        """
+        Build the cache key of a PDF.
+        :param path: The path to the PDF.
+        :param settings: A dictionary of the extraction settings the text depends on.
+        :return: The cache key.
+        """
+        settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return f"{self.file_hash(path)}_{settings_hash}"
+
+    def page_count(self, key):
+        """
+        Returns the number of pages of a cached PDF, or None if the PDF has not been seen.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT page_count FROM documents WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_pages(self, key, pages):
+        """
+        Look up pages of a PDF in the cache.
+        :param key: The cache key built by document_key.
+        :param pages: The page numbers, starting from 1.
+        :return: A dictionary from each cached page number to its text.
+        """
+        pages = list(pages)
+        found = {}
+        with self.lock:
+            # SQLite limits the number of parameters of a statement.
+            for i in range(0, len(pages), 500):
+                part = pages[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT page, data FROM pages WHERE key = ? AND page IN ({','.join('?' * len(part))})",
+                    (key, *part)).fetchall()
+                for page, data in rows:
+                    found[page] = zlib.decompress(data).decode("utf-8")
+            if found:
+                with self.conn:
+                    self.conn.execute("UPDATE documents SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.hits += len(found)
+            self.misses += len(pages) - len(found)
+        return found
+
+    def put_pages(self, key, page_count, texts):
+        """
+        Store the text of pages of a PDF.
+        :param key: The cache key built by document_key.
+        :param page_count: The total number of pages of the PDF.
+        :param texts: A dictionary from page number to text.
+        :return: None
+        """
+        rows = []
+        for page, text in texts.items():
+            data = zlib.compress(text.encode("utf-8"), self.level)
+            rows.append((key, page, data, len(data)))
+        try:
+            with self.lock, self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO documents (key, page_count, accessed_at) VALUES (?, ?, ?)",
+                                  (key, page_count, time.time()))
+                self.conn.executemany("INSERT OR REPLACE INTO pages (key, page, data, size) VALUES (?, ?, ?, ?)",
+                                      rows)
+        except sqlite3.Error as e:
+            logger.error(f"An error occurred while writing the page text cache: {e}")
+            return
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used documents until the cache fits in max_bytes.
+        """
+        with self.lock, self.conn:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            documents = self.conn.execute(
+                "SELECT d.key, COALESCE(SUM(p.size), 0) FROM documents d LEFT JOIN pages p ON p.key = d.key "
+                "GROUP BY d.key ORDER BY d.accessed_at").fetchall()
+            for key, size in documents:
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+                self.conn.execute("DELETE FROM documents WHERE key = ?", (key,))
+                total -= size
+                self.evictions += 1
+
+    def invalidate(self, key=None, file_hash=None):
+        """
+        Remove documents from the cache.
+        :param key: Remove the document with this key.
+        :param file_hash: Remove all entries of the PDF with this content hash.
+        :return: The number of removed documents.
+        """
+        if key is None and file_hash is None:
+            raise ValueError("Either 'key' or 'file_hash' must be given.")
+        where, value = ("key = ?", key) if key is not None else ("key LIKE ?", file_hash + "_%")
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM pages WHERE {where}", (value,))
+            return self.conn.execute(f"DELETE FROM documents WHERE {where}", (value,)).rowcount
+
+    def clear(self):
+        """
+        Remove everything from the cache.
+        :return: The number of removed documents.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pages")
+            return self.conn.execute("DELETE FROM documents").rowcount
+
+    def stats(self):
+        """
+        Returns the statistics of the cache, with the hits and misses counted in pages.
+        """
+        with self.lock:
+            documents = self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            pages, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "documents": documents,
+            "pages": pages,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }